@@ -191,7 +191,7 @@ def runstrategy():
         # ram key_id=args.keyid,
         # ram secret_key=args.secretkey,
         # ram paper=not args.live,
-        host="192.168.0.71",
+        host=args.host,
     )
 
     store = StoreCls(**storekwargs)
@@ -326,6 +326,11 @@ def parse_args(pargs=None):
                         required=False, action='store_true',
                         help='Display all info received from source')
 
+    parser.add_argument('--host', default='192.168.0.71',
+                        required=False, action='store',
+                        help=('MetaTrader terminal host, use 127.0.0.1 with '
+                              '"mql5_zmq_backtrader fake-terminal"'))
+
     parser.add_argument('--keyid', default=None,
                         required=False, action='store',
                         help='MT5 API key id')
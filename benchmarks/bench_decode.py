@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Per-message cost of receiving and decoding terminal messages.
+
+Payloads are built with the fake terminal (live candles, trade transactions
+and HISTORY replies) and pushed through an inproc PUSH/PULL pair. Each one is
+received with pyzmq's `recv_json` (the former path) and with
+`recv(copy=False)` followed by every JSON decoder available in
+`mql5_zmq_backtrader.mt5store.JSON_DECODERS`.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_decode.py --messages 100000
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import time
+
+import zmq
+
+from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+from mql5_zmq_backtrader.mt5store import JSON_DECODERS
+
+
+def payloads(history_bars):
+    terminal = MTraderFakeTerminal(symbols=['EURUSD'])
+    t = terminal.bar_open(int(time.time()), 'M1')
+    candle = terminal.candle('EURUSD', t, 'M1')
+    item = {'id': 100000001, 'symbol': 'EURUSD', 'comment': None}
+
+    return [
+        ('live candle', terminal.live_message('EURUSD', 'M1', candle)),
+        ('trade event', terminal.transaction(
+            'TRADE_ACTION_DEAL', item, 'TRADE_RETCODE_DONE', 0.1,
+            candle[4], otype='ORDER_TYPE_BUY', deal=100000002)),
+        ('history x{}'.format(history_bars), {
+            'symbol': 'EURUSD', 'timeframe': 'M1',
+            'data': terminal.candles('EURUSD', 'M1',
+                                     t - 60 * (history_bars - 1), t)}),
+    ]
+
+
+def bench(push, pull, raw, count, recv):
+    for _ in range(count):
+        push.send(raw)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        recv(pull)
+    return (time.perf_counter() - start) / count
+
+
+def run(args):
+    context = zmq.Context()
+    push = context.socket(zmq.PUSH)
+    pull = context.socket(zmq.PULL)
+    push.SNDHWM = pull.RCVHWM = 0
+    push.bind('inproc://bench')
+    pull.connect('inproc://bench')
+
+    methods = [('recv_json', lambda s: s.recv_json())]
+    for name, decode in JSON_DECODERS.items():
+        methods.append(('recv(copy=False) + ' + name,
+                        lambda s, decode=decode:
+                        decode(s.recv(copy=False).buffer)))
+
+    print('{:<16} {:>8}  {:<32} {:>12}'.format(
+        'payload', 'bytes', 'method', 'us/message'))
+    for label, msg in payloads(args.history_bars):
+        raw = json.dumps(msg).encode('utf-8')
+        count = args.messages if len(raw) < 4096 else args.messages // 100
+        baseline = None
+        for name, recv in methods:
+            cost = bench(push, pull, raw, count, recv) * 1e6
+            baseline = baseline or cost
+            print('{:<16} {:>8}  {:<32} {:>12.2f} ({:.2f}x)'.format(
+                label, len(raw), name, cost, baseline / cost))
+
+    push.close(linger=0)
+    pull.close(linger=0)
+    context.term()
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark JSON decoding of terminal messages')
+
+    parser.add_argument('--messages', default=100000, type=int,
+                        help='Small messages received per method')
+
+    parser.add_argument('--history-bars', default=5000, type=int,
+                        help='Bars in the HISTORY reply payload')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Peak memory of holding a long history in the feed queue.
+
+One year of M1 candles is received as HISTORY window replies (JSON) and kept
+in the history queue the way `MTraderStore.candles()` does, either as one
+Python list per candle in a `queue.Queue` (the former path) or as one
+compact block of decoded bars per window. Each mode runs in a fresh
+interpreter and reports its peak RSS.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/bench_history_memory.py --days 365
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import math
+import queue
+import resource
+import subprocess
+import sys
+import time
+
+
+def payloads(days, chunk):
+    """HISTORY replies of `chunk` M1 candles covering `days`"""
+    t0 = 1577836800
+    bars = days * 1440
+    for start in range(0, bars, chunk):
+        candles = list()
+        for i in range(start, min(start + chunk, bars)):
+            price = 1.1 + 0.01 * math.sin(i / 500.0)
+            candles.append([t0 + 60 * i, round(price, 5),
+                            round(price + 0.0002, 5),
+                            round(price - 0.0002, 5),
+                            round(price + 0.0001, 5), 100 + i % 50])
+        yield json.dumps({'symbol': 'EURUSD', 'timeframe': 'M1',
+                          'data': candles}).encode('utf-8')
+
+
+def load(mode, days, chunk):
+    from mql5_zmq_backtrader.mt5bars import block_len, candles_to_block
+    from mql5_zmq_backtrader.mt5store import get_json_decoder
+
+    decode = get_json_decoder()
+    q = queue.Queue()
+    bars = 0
+    start = time.perf_counter()
+    for payload in payloads(days, chunk):
+        candles = decode(payload)['data']
+        if mode == 'lists':
+            for c in candles:
+                q.put(c)
+            bars += len(candles)
+        else:
+            block = candles_to_block(candles)
+            q.put(block)
+            bars += block_len(block)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    print(json.dumps({'mode': mode, 'bars': bars, 'seconds': elapsed,
+                      'rss_kb': rss}))
+
+
+def baseline():
+    # interpreter with the modules imported, nothing loaded
+    import mql5_zmq_backtrader.mt5bars  # noqa: F401
+    import mql5_zmq_backtrader.mt5store  # noqa: F401
+    print(json.dumps({'mode': 'baseline', 'rss_kb': resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def run(args):
+    results = dict()
+    for mode in ('baseline', 'lists', 'blocks'):
+        out = subprocess.check_output(
+            [sys.executable, __file__, '--mode', mode,
+             '--days', str(args.days), '--chunk', str(args.chunk)])
+        results[mode] = json.loads(out.decode('utf-8').splitlines()[-1])
+
+    base = results['baseline']['rss_kb']
+    print('{:<8} {:>10} {:>14} {:>12} {:>10}'.format(
+        'mode', 'bars', 'peak RSS MB', 'bytes/bar', 'seconds'))
+    for mode in ('lists', 'blocks'):
+        r = results[mode]
+        print('{:<8} {:>10} {:>14.1f} {:>12.1f} {:>10.2f}'.format(
+            mode, r['bars'], r['rss_kb'] / 1024.0,
+            (r['rss_kb'] - base) * 1024.0 / r['bars'], r['seconds']))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark memory of the history queue')
+
+    parser.add_argument('--days', default=365, type=int,
+                        help='Days of M1 candles to load')
+
+    parser.add_argument('--chunk', default=10000, type=int,
+                        help='Candles per HISTORY reply')
+
+    parser.add_argument('--mode', default=None,
+                        choices=['baseline', 'lists', 'blocks'],
+                        help='Run a single mode in this interpreter')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode == 'baseline':
+        baseline()
+    elif args.mode:
+        load(args.mode, args.days, args.chunk)
+    else:
+        run(args)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Memory of a long broker session against the fake terminal.
+
+Market orders are sent through `MTraderBroker` in batches over several
+symbols, and their positions are closed once filled. The order
+notifications are consumed the way cerebro does and the fills are counted
+from them: the completed orders and the closing deals, notified as external
+fills of the feed named after the symbol. `tracemalloc`
+tracks the memory allocated by the process, the order book sizes are
+reported along with it. With compaction the traced memory stays flat once
+the retention is over.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/soak_broker_memory.py --fills 1000000
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import time
+import tracemalloc
+
+import backtrader as bt
+
+from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+from mql5_zmq_backtrader.mt5store import MTraderStore
+
+
+def wait(orders, status, timeout=10.0):
+    deadline = time.time() + timeout
+    while any(o.status != status for o in orders):
+        if time.time() > deadline:
+            raise RuntimeError('orders not {} after {}s'.format(
+                bt.Order.Status[status], timeout))
+        time.sleep(0.0005)
+
+
+def soak(fills, symbols=8, batch=32, retention=1.0, report=None):
+    """Run `fills` fills, print the traced memory and the order book sizes
+    every `report` fills. Return the printed rows"""
+    names = ['SYM{}'.format(i) for i in range(symbols)]
+    terminal = MTraderFakeTerminal(symbols=names, rate=0).start()
+    MTraderStore._singleton = None
+    store = MTraderStore(host='127.0.0.1', order_retention=retention)
+    store.debug = False
+    broker = store.getbroker()
+    broker.start()
+
+    # feeds with a single bar, only the broker is run
+    cerebro = bt.Cerebro()
+    datas = list()
+    now = bt.date2num(datetime.datetime.utcnow())
+    for name in names:
+        data = bt.DataBase(dataname=name)
+        cerebro.adddata(data, name=name)  # matched with deal symbols
+        data._start()
+        data.forward()
+        data.lines.datetime[0] = now
+        datas.append(data)
+        store.datas.append(data)  # registered by a started feed
+
+    rows = list()
+    tracemalloc.start()
+    done = 0
+    due = report
+    start = time.time()
+    try:
+        while done < fills:
+            orders = [broker.sell(None, datas[i % symbols], 0.1,
+                                  exectype=bt.Order.Market)
+                      for i in range(batch)]
+            wait(orders, bt.Order.Completed)
+            for order in orders:
+                broker.cancel(order)  # closes the position
+            wait(orders, bt.Order.Canceled)
+
+            # what cerebro does every cycle
+            broker.next()
+            while True:
+                order = broker.get_notification()
+                if order is None:
+                    break
+                if order.status == bt.Order.Completed:
+                    done += 1
+            store.get_notifications()
+
+            if report and done >= due:
+                due += report
+                row = dict(fills=done, seconds=time.time() - start,
+                           traced=tracemalloc.get_traced_memory()[0],
+                           orders=len(broker.orders),
+                           registry=len(store._orders),
+                           notifs=len(broker.notifs),
+                           dropped=broker.notifs_dropped)
+                rows.append(row)
+                print('{fills:>10} {seconds:>9.1f} {traced:>14} '
+                      '{orders:>8} {registry:>9} {notifs:>7} '
+                      '{dropped:>7}'.format(**row))
+    finally:
+        tracemalloc.stop()
+        store.stop()
+        store.q_orderclose.put(None)
+        store.oapi.close()
+        terminal.stop()
+        MTraderStore._singleton = None
+    return rows
+
+
+def run(args):
+    print('{:>10} {:>9} {:>14} {:>8} {:>9} {:>7} {:>7}'.format(
+        'fills', 'seconds', 'traced bytes', 'orders', 'registry', 'notifs',
+        'dropped'))
+    rows = soak(args.fills, args.symbols, args.batch, args.retention,
+                max(args.fills // 20, 2 * args.batch))
+
+    # growth after the first tenth, once the buffers are warm
+    warm = rows[len(rows) // 10]
+    last = rows[-1]
+    print('growth: {:.2f} bytes/fill over {} fills'.format(
+        (last['traced'] - warm['traced']) /
+        max(1, last['fills'] - warm['fills']), last['fills'] - warm['fills']))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Soak test of the broker memory')
+
+    parser.add_argument('--fills', default=1000000, type=int,
+                        help='Fills to simulate, two per order')
+
+    parser.add_argument('--symbols', default=8, type=int,
+                        help='Symbols the orders are spread over')
+
+    parser.add_argument('--batch', default=32, type=int,
+                        help='Orders sent at once')
+
+    parser.add_argument('--retention', default=1.0, type=float,
+                        help='Seconds final orders are kept')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -9,3 +9,4 @@ __version__ = '0.1.0'
 from .mt5store import *
 from .mt5broker import *
 from .mt5data import *
+from .mt5asyncapi import *
@@ -3,14 +3,62 @@ import sys
 import click
 
 
-@click.command()
-def main(args=None):
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(ctx, args=None):
     """Console script for mql5_zmq_backtrader."""
+    if ctx.invoked_subcommand is not None:
+        return 0
+
     click.echo("Replace this message by putting your code into "
                "mql5_zmq_backtrader.cli.main")
     click.echo("See click documentation at https://click.palletsprojects.com/")
     return 0
 
 
+@main.command('fake-terminal')
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='Address to bind, use * for all interfaces.')
+@click.option('--symbol', 'symbols', multiple=True, default=['EURUSD'],
+              show_default=True, help='Symbol to stream, can be repeated.')
+@click.option('--timeframe', default='M1', show_default=True,
+              help='Granularity of the streamed candles.')
+@click.option('--rate', default=1.0, show_default=True,
+              help='Live candles per second and per symbol.')
+@click.option('--tick-rate', default=0.0, show_default=True,
+              help='Live ticks per second and per symbol.')
+@click.option('--events-rate', default=0.0, show_default=True,
+              help='External trade transactions per second.')
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds before a request reply is sent.')
+@click.option('--jitter', default=0.0, show_default=True,
+              help='Extra random reply latency in seconds.')
+@click.option('--balance', default=10000.0, show_default=True,
+              help='Starting account balance.')
+@click.option('--seed', default=None, type=int,
+              help='Seed for the random latency and events.')
+def fake_terminal(host, symbols, timeframe, rate, tick_rate, events_rate,
+                  latency, jitter, balance, seed):
+    """Serve a fake MetaTrader 5 terminal for offline testing."""
+    from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+
+    terminal = MTraderFakeTerminal(
+        host=host, symbols=symbols, timeframe=timeframe, rate=rate,
+        tick_rate=tick_rate, events_rate=events_rate, latency=latency,
+        jitter=jitter, balance=balance, seed=seed)
+
+    click.echo('Fake terminal on {} ports {}-{}, streaming {} {}'.format(
+        host, terminal.SYS_PORT, terminal.EVENTS_PORT,
+        ', '.join(symbols), timeframe))
+    try:
+        terminal.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    click.echo(', '.join('{}: {}'.format(k, v)
+                         for k, v in sorted(terminal.stats.items())))
+    return 0
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
@@ -0,0 +1,273 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+import collections
+import itertools
+import json
+import time
+import traceback
+
+import zmq
+import zmq.asyncio
+
+from mql5_zmq_backtrader.mt5store import MTraderAPI, get_json_decoder
+
+
+class MTraderAsyncAPI(object):
+    """
+    asyncio flavour of `MTraderAPI` built on `zmq.asyncio`.
+
+    Requests go through a DEALER socket and any number of them may be
+    awaited concurrently from a single event loop. Replies are matched back
+    by request id. A terminal not echoing the id (`echo_ids`, learnt from
+    the first reply) gets one request at a time, as with `MTraderAPI`. The
+    live candles and trade events are exposed as async iterators.
+
+    Usage::
+
+        api = MTraderAsyncAPI('localhost')
+        balance = await api.construct_and_send(action='BALANCE')
+
+        async for candle in api.live_stream():
+            ...
+    """
+
+    # Abandoned request ids remembered for their late replies, as in
+    # `MTraderAPI`
+    ABANDONED_MAX = MTraderAPI.ABANDONED_MAX
+
+    def __init__(self, host=None, context=None, decoder=None,
+                 echo_ids=None):
+        self.HOST = host or 'localhost'
+        self.SYS_PORT = 15555       # REP/DEALER port
+        self.DATA_PORT = 15556      # PUSH/PULL port
+        self.LIVE_PORT = 15557      # PUSH/PULL port
+        self.EVENTS_PORT = 15558    # PUSH/PULL port
+
+        # Reply timeout in miliseconds
+        self.DATA_TIMEOUT = 10000
+
+        self.decode = get_json_decoder(decoder)
+        self.echo_ids = echo_ids
+        self._request_ids = itertools.count(1)
+        self._pending = collections.OrderedDict()  # request id -> future
+        self._outbox = collections.deque()  # (future, payload) to send
+        self._inflight = 0  # requests sent and not answered yet
+        # ids of requests given up in flight, their late reply is not
+        # counted out of `_inflight` again
+        self._abandoned = collections.OrderedDict()
+        self._tasks = list()
+        self._streams = list()
+
+        self._own_context = context is None
+        self.context = context or zmq.asyncio.Context()
+        try:
+            self.sys_socket = self.context.socket(zmq.DEALER)
+            self.sys_socket.connect(
+                'tcp://{}:{}'.format(self.HOST, self.SYS_PORT))
+
+            self.data_socket = self.context.socket(zmq.PULL)
+            self.data_socket.connect(
+                'tcp://{}:{}'.format(self.HOST, self.DATA_PORT))
+        except zmq.ZMQError:
+            raise zmq.ZMQBindError("E: Binding ports ERROR")
+
+    def _start_readers(self):
+        # Started on first use, when an event loop is known to run
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._t_replies()),
+                           asyncio.ensure_future(self._t_receipts())]
+
+    async def _t_replies(self):
+        """Hand every reply on the Data socket to the future of its request.
+
+        A terminal which does not echo the request id answers in order, so
+        such replies go to the oldest request still waiting.
+        """
+        while True:
+            frame = await self.data_socket.recv(copy=False)
+            try:
+                msg = self.decode(frame.buffer)
+            except ValueError:
+                print("E: Malformed JSON message: %s" % frame.bytes[:200])
+                continue
+            if not isinstance(msg, dict):
+                print("E: Malformed reply from server: %s" %
+                      frame.bytes[:200])
+                continue
+
+            try:
+                self._deliver(msg)
+                self._send_requests()
+            except Exception:
+                # a bad reply must not stop the reader
+                traceback.print_exc()
+
+    def _deliver(self, msg):
+        request_id = msg.pop('requestId', None)
+        if request_id is None:
+            self.echo_ids = False
+        elif self.echo_ids is None:
+            self.echo_ids = True
+
+        if request_id in self._abandoned:
+            # late reply to a request already counted out
+            del self._abandoned[request_id]
+            return
+        self._inflight = max(0, self._inflight - 1)
+        if request_id is None and self._pending:
+            request_id = next(iter(self._pending))
+
+        # else a late reply to an abandoned request
+        future = self._pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(msg)
+
+    async def _t_receipts(self):
+        """Drop the "OK" receipts sent by the terminal for every request"""
+        while True:
+            await self.sys_socket.recv_multipart()
+
+    def submit(self, **kwargs) -> asyncio.Future:
+        """Construct a request dictionary from default and send it to server
+        without waiting. The reply is delivered to the returned future"""
+        self._start_readers()
+        request = MTraderAPI.build_request(**kwargs)
+
+        request_id = next(self._request_ids)
+        request['requestId'] = request_id
+        future = asyncio.get_event_loop().create_future()
+        future.request_id = request_id
+        self._pending[request_id] = future
+        self._outbox.append((future, json.dumps(request).encode('utf-8')))
+        self._send_requests()
+        return future
+
+    def _send_requests(self):
+        while self._outbox:
+            if self._inflight and not self.echo_ids:
+                return  # replies matched by order, wait for the answer
+
+            future, payload = self._outbox.popleft()
+            if future.done():
+                continue  # abandoned before being sent
+            future.sent_at = time.time()
+            self._inflight += 1
+            # the empty delimiter frame makes the DEALER talk to a REP
+            self.sys_socket.send_multipart([b'', payload])
+
+    def _forget(self, future):
+        """Stop waiting for a reply, a late one will be discarded"""
+        if self._pending.get(future.request_id) is not future:
+            return
+        if getattr(future, 'sent_at', None) is None:
+            del self._pending[future.request_id]
+        elif not self.echo_ids:
+            # the reply comes before the next ones, keep its place and give
+            # it up DATA_TIMEOUT later, as a lost reply
+            asyncio.get_event_loop().call_later(
+                self.DATA_TIMEOUT / 1000.0, self._give_up, future)
+        else:
+            del self._pending[future.request_id]
+            self._inflight = max(0, self._inflight - 1)
+            self._abandon(future.request_id)
+
+    def _give_up(self, future):
+        if self._pending.get(future.request_id) is future:
+            del self._pending[future.request_id]
+            self._inflight = max(0, self._inflight - 1)
+            if self.echo_ids:
+                self._abandon(future.request_id)
+            self._send_requests()
+
+    def _abandon(self, request_id):
+        """Remember a request counted out of `_inflight` before its reply
+        came"""
+        abandoned = self._abandoned
+        abandoned[request_id] = None
+        while len(abandoned) > self.ABANDONED_MAX:
+            abandoned.popitem(last=False)
+
+    async def construct_and_send(self, timeout=None, **kwargs) -> dict:
+        """Construct a request dictionary from default, send it to server
+        and wait up to `timeout` seconds (default `DATA_TIMEOUT`) for the
+        reply. None is returned on timeout.
+
+        Cancelling the awaiting task abandons the request, its reply will be
+        discarded when it arrives.
+        """
+        if timeout is None:
+            timeout = self.DATA_TIMEOUT / 1000.0
+
+        future = self.submit(**kwargs)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._forget(future)
+
+    def live_stream(self):
+        """Async iterator over the candles pushed on the Live port"""
+        return self._stream(self.LIVE_PORT)
+
+    def events_stream(self):
+        """Async iterator over the trade transactions on the Events port"""
+        return self._stream(self.EVENTS_PORT)
+
+    def _stream(self, port):
+        stream = MTraderAsyncStream(self.context, self.HOST, port,
+                                    self.decode)
+        self._streams.append(stream)
+        return stream
+
+    def close(self):
+        """Stop the readers, close the sockets and terminate the context"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = list()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._outbox.clear()
+        for stream in self._streams:
+            stream.close()
+
+        self.sys_socket.close(linger=0)
+        self.data_socket.close(linger=0)
+        if self._own_context:
+            self.context.term()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class MTraderAsyncStream(object):
+    """Async iterator over the JSON messages of a terminal PUSH port"""
+
+    def __init__(self, context, host, port, decode=None):
+        self.decode = decode or get_json_decoder()
+        try:
+            self.socket = context.socket(zmq.PULL)
+            self.socket.connect('tcp://{}:{}'.format(host, port))
+        except zmq.ZMQError:
+            raise zmq.ZMQBindError("E: Stream port connection ERROR")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            frame = await self.socket.recv(copy=False)
+        except zmq.ZMQError:
+            if self.socket.closed:
+                raise StopAsyncIteration
+            raise
+        return self.decode(frame.buffer)
+
+    def close(self):
+        self.socket.close(linger=0)
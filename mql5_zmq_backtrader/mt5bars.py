@@ -0,0 +1,276 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from array import array
+from bisect import bisect_left, bisect_right
+import calendar
+from datetime import datetime
+import functools
+import math
+
+try:
+    import numpy as np
+except ImportError:  # candles are then decoded one at a time
+    np = None
+
+
+# Values per bar in a block: date2num time, open, high, low, close, volume
+BAR_FIELDS = 6
+
+# Values per tick in a block: epoch seconds, bid, ask, last, volume
+TICK_FIELDS = 5
+
+
+@functools.lru_cache(maxsize=86400)
+def _day_fraction(secs):
+    # date2num adds hour, minute and second fractions with fsum. Any day
+    # number of the binade [2**19, 2**20) (years 1435 to 2871) has the same
+    # float spacing, the rounded fraction is then valid for all of them
+    return math.fsum((524288.0, secs // 3600 / 24.0,
+                      secs % 3600 // 60 / 1440.0, secs % 60 / 86400.0)) - \
+        524288.0
+
+
+def ts2num(t):
+    """`date2num(datetime.utcfromtimestamp(t))` without the datetime"""
+    days, secs = divmod(int(t), 86400)
+    return 719163.0 + days + _day_fraction(secs)
+
+
+def candles_to_block(candles, last=float('-inf')):
+    """Decode the candles of a HISTORY payload at once.
+
+    Returns a flat float64 block, `BAR_FIELDS` values per bar: date2num
+    time, open, high, low, close and volume. A NumPy array when available,
+    an `array('d')` otherwise, 48 bytes per bar either way.
+
+    Bars which are not strictly after `last` and the preceding ones are
+    dropped, leaving ascending unique times.
+    """
+    if last != last:  # nan, nothing loaded yet
+        last = float('-inf')
+
+    if np is None:
+        block = array('d')
+        for candle in candles:
+            dt = ts2num(candle[0])
+            if dt > last:
+                last = dt
+                block.append(dt)
+                block.extend(candle[1:])
+        return block
+
+    bars = np.array(candles, dtype=np.float64).reshape(-1, BAR_FIELDS)
+    if len(bars):
+        days, secs = np.divmod(bars[:, 0].astype(np.int64), 86400)
+        uniq, inverse = np.unique(secs, return_inverse=True)
+        fractions = np.array([_day_fraction(int(x)) for x in uniq])
+        bars[:, 0] = (719163.0 + days) + fractions[inverse.ravel()]
+
+        # dedup and monotonicity: keep times above everything before them
+        dts = bars[:, 0]
+        before = np.maximum.accumulate(np.concatenate(([last], dts[:-1])))
+        keep = dts > before
+        if not keep.all():
+            bars = bars[keep]
+    return bars.ravel()
+
+
+def ticks_to_block(ticks, last=float('-inf')):
+    """Decode the ticks of a HISTORY payload at once.
+
+    Ticks are [time_msc, bid, ask, last, volume], the last two may be
+    missing. Returns a flat float64 block, `TICK_FIELDS` values per tick:
+    epoch seconds, bid, ask, last and volume. Ticks before `last` or before
+    the preceding ones are dropped, several may share a time.
+    """
+    if np is None:
+        block = array('d')
+        for tick in ticks:
+            t = tick[0] / 1000.0
+            if t >= last:
+                last = t
+                block.append(t)
+                block.extend(tick[1:TICK_FIELDS])
+                block.extend([0.0] * (TICK_FIELDS - len(tick)))
+        return block
+
+    if not len(ticks):
+        return np.zeros(0)
+    width = len(ticks[0])
+    if any(len(tick) != width for tick in ticks):  # pad the short ones
+        ticks = [(list(tick) + [0.0] * TICK_FIELDS)[:TICK_FIELDS]
+                 for tick in ticks]
+    width = min(len(ticks[0]), TICK_FIELDS)
+    rows = np.zeros((len(ticks), TICK_FIELDS))
+    rows[:, :width] = np.array([tick[:width] for tick in ticks],
+                               dtype=np.float64)
+    rows[:, 0] /= 1000.0
+
+    ts = rows[:, 0]
+    before = np.maximum.accumulate(np.concatenate(([last], ts[:-1])))
+    keep = ts >= before
+    if not keep.all():
+        rows = rows[keep]
+    return rows.ravel()
+
+
+def num2ts(dt):
+    """Epoch second of a date2num time, the inverse of `ts2num`"""
+    return int(round((dt - 719163.0) * 86400.0))
+
+
+def msc2num(t):
+    """date2num of epoch second `t` with milliseconds"""
+    secs = math.floor(t)
+    return ts2num(secs) + (t - secs) / 86400.0
+
+
+def block_len(block, fields=BAR_FIELDS):
+    """Number of bars in a block"""
+    return len(block) // fields
+
+
+def block_bar(block, i, fields=BAR_FIELDS):
+    """Bar `i` of a block as a list of floats"""
+    return block[i * fields:(i + 1) * fields].tolist()
+
+
+def block_column(block, field, lo=0, hi=None, fields=BAR_FIELDS):
+    """Values of `field` for bars [lo, hi) of a block"""
+    hi = block_len(block, fields) if hi is None else hi
+    return block[lo * fields + field:hi * fields:fields]
+
+
+def block_range(block, begin=float('-inf'), end=float('inf'), after=None):
+    """Bars [lo, hi) of a block with a time in [begin, end], and after
+    `after` when given"""
+    dts = block_column(block, 0)
+    lo = bisect_left(dts, begin)
+    if after is not None and after == after:
+        lo = max(lo, bisect_right(dts, after))
+    return lo, max(lo, bisect_right(dts, end))
+
+
+class TickBarBuilder(object):
+    """
+    Incremental OHLCV bars of `seconds` built from ticks.
+
+    Bars open at multiples of `seconds` since the epoch and carry their open
+    time, like MetaTrader candles. A bar is complete when a tick of a later
+    bar arrives or, with `flush`, once its time is over. Ticks without
+    volume count as one (tick volume).
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.bar = None  # [open time, open, high, low, close, volume]
+        self.done = float('-inf')  # end of the last completed bar
+
+    def update(self, t, price, volume=0.0):
+        """Add a tick at epoch second `t`, return the bar it completed"""
+        done = None
+        bar = self.bar
+        start = t - t % self.seconds
+        if start < self.done:
+            return None  # late tick of a completed bar
+        if bar is not None and start != bar[0]:
+            if start < bar[0]:
+                return None
+            done, bar = bar, None
+            self.done = start
+
+        volume = volume or 1.0
+        if bar is None:
+            self.bar = [start, price, price, price, price, volume]
+        else:
+            if price > bar[2]:
+                bar[2] = price
+            elif price < bar[3]:
+                bar[3] = price
+            bar[4] = price
+            bar[5] += volume
+        return done
+
+    def flush(self, now):
+        """Return the bar being built if epoch second `now` is past its
+        end"""
+        bar = self.bar
+        if bar is not None and now >= bar[0] + self.seconds:
+            self.bar = None
+            self.done = bar[0] + self.seconds
+            return bar
+        return None
+
+
+# Seconds per unit of the MetaTrader granularities but months
+_UNIT_SECONDS = {'M': 60, 'H': 3600, 'D': 86400, 'W': 604800}
+
+# 1970-01-01 was a Thursday, MetaTrader weeks start on Sunday
+_WEEK_OFFSET = 4 * 86400
+
+
+def period_bounds(t, granularity):
+    """Open time of the bar of `granularity` ('M5', 'H1', 'D1', 'W1',
+    'MN1' ...) containing epoch second `t` and of the next bar"""
+    if granularity == 'MN1':
+        d = datetime.utcfromtimestamp(t)
+        year, month = divmod(d.year * 12 + d.month, 12)
+        return (calendar.timegm((d.year, d.month, 1, 0, 0, 0)),
+                calendar.timegm((year, month + 1, 1, 0, 0, 0)))
+
+    seconds = _UNIT_SECONDS[granularity[0]] * int(granularity[1:])
+    offset = _WEEK_OFFSET if granularity[0] == 'W' else 0
+    begin = (t + offset) // seconds * seconds - offset
+    return begin, begin + seconds
+
+
+class BarAggregator(object):
+    """
+    Incremental OHLCV bars of a MetaTrader `granularity` built from the
+    bars of a finer one, `base` seconds long (M1 candles by default).
+
+    Bars carry their open time like the terminal candles. A bar is complete
+    once a finer bar of a later one arrives or, with `flush`, once its time
+    is over. Finer bars not after the last one added are ignored.
+    """
+
+    def __init__(self, granularity, base=60):
+        self.granularity = granularity
+        self.base = base
+        self.bar = None  # [open time, open, high, low, close, volume]
+        self.end = None  # open time of the next bar
+        self.last = float('-inf')  # open time of the last finer bar
+
+    def update(self, t, o, h, low, c, v):
+        """Add the finer bar opened at epoch second `t`, return the bar it
+        completed"""
+        if t <= self.last:
+            return None
+        self.last = t
+
+        done = None
+        bar = self.bar
+        if bar is not None and t >= self.end:
+            done, bar = bar, None
+
+        if bar is None:
+            begin, self.end = period_bounds(t, self.granularity)
+            self.bar = [begin, o, h, low, c, v]
+        else:
+            if h > bar[2]:
+                bar[2] = h
+            if low < bar[3]:
+                bar[3] = low
+            bar[4] = c
+            bar[5] += v
+        return done
+
+    def flush(self, now):
+        """Return the bar being built if epoch second `now` is past its
+        end"""
+        bar = self.bar
+        if bar is not None and now >= self.end:
+            self.bar = None
+            return bar
+        return None
@@ -2,6 +2,8 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import collections
+import threading
+import time
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.utils.py3 import with_metaclass
@@ -43,13 +45,31 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
 
         Set to `False` during instantiation to disregard any existing
         position
+
+      - `max_notifs` (default: `10000`): Order notifications kept until
+        delivered. Beyond it the oldest ones are dropped and counted in
+        `notifs_dropped`
+
+    Orders in a final state (completed, cancelled, rejected, expired,
+    margin) are forgotten `order_retention` seconds (see `MTraderStore`)
+    after it, out of a working bracket. Completed market orders are kept
+    while their position is open, cancelling them closes it. Later events
+    about forgotten orders are ignored.
+
+    `getcash` and `getvalue` never wait for the terminal. They return the
+    balance and equity of the store's last refresh, the open positions
+    marked to the last price of their feeds since then.
     """
     # TODO: close positions
 
     params = (
         ('use_positions', True),
+        ('max_notifs', 10000),
     )
 
+    _FINAL = (Order.Completed, Order.Canceled, Order.Rejected, Order.Expired,
+              Order.Margin)
+
     def __init__(self, **kwargs):
         super(MTraderBroker, self).__init__()
 
@@ -57,6 +77,9 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
 
         self.orders = collections.OrderedDict()  # orders by order id
         self.notifs = collections.deque()  # holds orders which are notified
+        self.notifs_dropped = 0
+        self.compacted = 0  # final orders forgotten
+        self._finished = collections.deque()  # (time, ref) of final orders
 
         self.opending = collections.defaultdict(list)  # pending transmission
         self.brackets = dict()  # confirmed brackets
@@ -64,6 +87,11 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         self.startingcash = self.cash = 0.0
         self.startingvalue = self.value = 0.0
         self.positions = collections.defaultdict(Position)
+        # profit and loss of the positions when the equity was refreshed,
+        # plus the fills since, against a zero price, by symbol
+        self._marks = dict()
+        self._marks_seq = None  # balance refresh the marks start from
+        self._marks_lock = threading.Lock()
         
         self.addcommissioninfo(self, MTraderCommInfo(mult=1.0, stocklike=False))
 
@@ -121,8 +149,42 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         return cash
 
     def getvalue(self, datas=None):
-        self.value = self.o.get_value()
-        return self.value
+        value, seq = self.o.get_value_update()
+        prices = self._prices()
+        with self._marks_lock:
+            if self._marks_seq != seq:  # refreshed, mark from here
+                self._marks_seq = seq
+                self._marks = {
+                    symbol: prices[symbol][1].profitandloss(
+                        pos.size, prices[symbol][0], 0.0)
+                    for symbol, pos in list(self.positions.items())
+                    if pos.size and symbol in prices}
+
+            for symbol, mark in self._marks.items():
+                if symbol in prices:
+                    price, comminfo = prices[symbol]
+                    value += comminfo.profitandloss(
+                        self.positions[symbol].size, 0.0, price) + mark
+
+        self.value = value
+        return value
+
+    def _prices(self):
+        # last close and commission info of the feeds by symbol
+        return {data._dataname: (data.close[0], self.getcommissioninfo(data))
+                for data in self.o.datas if len(data)}
+
+    def _mark(self, data, size, price):
+        # a fill after the last refresh, its profit is marked from `price`
+        comminfo = self.getcommissioninfo(data)
+        symbol = data._dataname
+        with self._marks_lock:
+            psize = self.positions[symbol].size - size  # before the fill
+            mark = self._marks.get(symbol)
+            if mark is None:
+                mark = comminfo.profitandloss(psize, price, 0.0)
+            self._marks[symbol] = \
+                mark + comminfo.profitandloss(size, price, 0.0)
 
     def getposition(self, data, clone=True):
         # return self.o.getposition(data._dataname, clone=clone)
@@ -133,32 +195,42 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         return pos
 
     def orderstatus(self, order):
-        o = self.orders[order.ref]
+        o = self.orders.get(order.ref, order)  # forgotten once final
         return o.status
 
     def _submit(self, oref):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         order.submit(self)
         self.notify(order)
 
     def _reject(self, oref):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         order.reject(self)
         self.notify(order)
 
     def _accept(self, oref):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         order.accept()
         self.notify(order)
 
     def _cancel(self, oref):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         order.cancel()
         self.notify(order)
         self._bracketize(order, cancel=True)
 
     def _expire(self, oref):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         order.expire()
         self.notify(order)
         self._bracketize(order, cancel=True)
@@ -191,6 +263,7 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
 
         pos = self.getposition(data, clone=False)
         pos.update(size, price)
+        self._mark(data, size, price)
 
         if size < 0:
             order = SellOrder(data=data,
@@ -214,7 +287,9 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         self.notify(order)
 
     def _fill(self, oref, size, price, reason, **kwargs):
-        order = self.orders[oref]
+        order = self.orders.get(oref)
+        if order is None:
+            return
         if not order.alive():  # can be a bracket
             pref = getattr(order.parent, 'ref', order.ref)
             if pref not in self.brackets:
@@ -241,6 +316,7 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         data = order.data
         pos = self.getposition(data, clone=False)
         psize, pprice, opened, closed = pos.update(size, price)
+        self._mark(data, size, price)
         comminfo = self.getcommissioninfo(data)
 
         closedvalue = closedcomm = 0.0
@@ -332,8 +408,17 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         return self.o.order_cancel(order)
 
     def notify(self, order):
+        if len(self.notifs) >= self.p.max_notifs:
+            if not self.notifs_dropped:
+                print('W: Order notifications are not consumed, dropping '
+                      'the oldest ones')
+            self.notifs.popleft()
+            self.notifs_dropped += 1
         self.notifs.append(order.clone())
 
+        if order.status in self._FINAL:
+            self._finished.append((time.time(), order.ref))
+
     def get_notification(self):
         if not self.notifs:
             return None
@@ -341,4 +426,31 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
         return self.notifs.popleft()
 
     def next(self):
-        self.notifs.append(None)  # mark notification boundary
\ No newline at end of file
+        self.notifs.append(None)  # mark notification boundary
+        self._compact()
+
+    def _compact(self, now=None):
+        """Forget the orders final for longer than the retention"""
+        now = time.time() if now is None else now
+        limit = now - self.o._orders.retention
+        finished = self._finished
+        for _ in range(len(finished)):
+            if finished[0][0] > limit:
+                break
+            _, oref = finished.popleft()
+            order = self.orders.get(oref)
+            if order is None:
+                continue  # final twice, a position closed after its fill
+
+            if getattr(order.parent, 'ref', oref) in self.brackets:
+                finished.append((now, oref))  # the bracket is still working
+                continue
+
+            record = self.o._orders.get(oref)
+            if record is not None and record.state == 'open':
+                finished.append((now, oref))  # stands for an open position
+                continue
+
+            del self.orders[oref]
+            self.opending.pop(oref, None)
+            self.compacted += 1
\ No newline at end of file
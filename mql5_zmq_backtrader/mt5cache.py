@@ -0,0 +1,265 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from bisect import bisect_left, bisect_right
+from array import array
+import mmap
+import os
+import struct
+import threading
+
+
+class CandleSeries(object):
+    """
+    Candles of a symbol and granularity in a memory-mapped columnar file.
+
+    The file starts with a fixed header followed by the time, open, high,
+    low, close and volume columns, `capacity` 8 bytes records each. Times
+    are ascending and unique. `cover` is the time range already downloaded
+    from the terminal, which may hold no bars at its ends (weekends).
+
+    Bars are only added before `cover` or after it, so the cached range
+    stays contiguous.
+    """
+    _HEADER = struct.Struct('<8sQQqq')  # magic, count, capacity, cover
+    _MAGIC = b'MT5BARS1'
+    _COLUMNS = ('q', 'd', 'd', 'd', 'd', 'd')  # time, open ... volume
+    _MIN_CAPACITY = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            self._create(path, self._MIN_CAPACITY, [], None)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.count, self.capacity, begin, end = \
+            self._HEADER.unpack_from(self._map)
+        if magic != self._MAGIC:
+            self._unmap()
+            raise ValueError('{} is not a candle cache file'.format(
+                self.path))
+        self.cover = (begin, end) if begin <= end else None
+
+        self._cols = list()
+        for i, fmt in enumerate(self._COLUMNS):
+            start = self._HEADER.size + i * self.capacity * 8
+            view = memoryview(self._map)[start:start + self.capacity * 8]
+            self._cols.append(view.cast(fmt))
+        self.times = self._cols[0]
+
+    def _unmap(self):
+        for view in getattr(self, '_cols', ()):
+            view.release()
+        self._cols = list()
+        self.times = None
+        self._map.close()
+        self._file.close()
+
+    @classmethod
+    def _create(cls, path, capacity, columns, cover):
+        """Write a new file with `columns` (lists of values) atomically"""
+        count = len(columns[0]) if columns else 0
+        begin, end = cover or (1, 0)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls._HEADER.pack(cls._MAGIC, count, capacity, begin, end))
+            for i, fmt in enumerate(cls._COLUMNS):
+                values = columns[i] if columns else []
+                f.write(struct.pack('<{}{}'.format(count, fmt), *values))
+                f.write(b'\0' * (capacity - count) * 8)
+        os.replace(tmp, path)
+
+    def close(self):
+        self._unmap()
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, begin, end):
+        times = self.times[:self.count]
+        lo = 0 if begin is None else bisect_left(times, begin)
+        hi = self.count if end is None else bisect_right(times, end)
+        return lo, hi
+
+    def chunks(self, begin=None, end=None, size=10000):
+        """Yield the candles [t, o, h, l, c, v] with a time in [begin, end]
+        in lists of up to `size`"""
+        lo, hi = self._index(begin, end)
+        for start in range(lo, hi, size):
+            stop = min(start + size, hi)
+            yield [list(c) for c in
+                   zip(*(col[start:stop].tolist() for col in self._cols))]
+
+    def _write_header(self):
+        begin, end = self.cover or (1, 0)
+        self._HEADER.pack_into(self._map, 0, self._MAGIC, self.count,
+                               self.capacity, begin, end)
+
+    def append(self, candles, cover_end, cover_begin=None):
+        """Add the candles after the covered range and extend it up to
+        `cover_end`. `cover_begin` starts the range of an empty series"""
+        if self.cover is not None:
+            cover_begin = self.cover[0]
+            candles = [c for c in candles if c[0] > self.cover[1]]
+        elif cover_begin is None:
+            if not candles:
+                return
+            cover_begin = candles[0][0]
+
+        if not candles:
+            cover_end = max(cover_end, cover_begin - 1)
+            if self.cover is not None:
+                cover_end = max(cover_end, self.cover[1])
+            self.cover = (cover_begin, cover_end)
+            self._write_header()
+            return
+
+        if self.count + len(candles) > self.capacity:
+            capacity = self.capacity
+            while capacity < self.count + len(candles):
+                capacity *= 2
+            self._rewrite([], capacity)
+
+        n = self.count
+        for i, col in enumerate(self._cols):
+            for j, c in enumerate(candles):
+                col[n + j] = c[i]
+
+        # data before header, an interrupted write is not seen
+        self.count += len(candles)
+        self.cover = (min(cover_begin, candles[0][0]),
+                      max(cover_end, candles[-1][0]))
+        self._write_header()
+
+    def prepend(self, candles, cover_begin):
+        """Add the candles before the covered range and extend it down to
+        `cover_begin`"""
+        if self.cover is None:
+            if candles:
+                self.append(candles, candles[-1][0], cover_begin)
+            return
+
+        candles = [c for c in candles if c[0] < self.cover[0]]
+        if candles:
+            capacity = self.capacity
+            while capacity < self.count + len(candles):
+                capacity *= 2
+            self._rewrite(candles, capacity)
+        self.cover = (min(cover_begin, self.cover[0]), self.cover[1])
+        self._write_header()
+
+    def _rewrite(self, head, capacity):
+        columns = [[c[i] for c in head] + col[:self.count].tolist()
+                   for i, col in enumerate(self._cols)]
+        cover = self.cover
+        self._unmap()
+        self._create(self.path, capacity, columns, cover)
+        self._open()
+        self.cover = cover
+
+
+class MemorySeries(object):
+    """
+    In-memory `CandleSeries`, candles held in `array` columns for the
+    lifetime of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cover = None
+        self._cols = [array(fmt) for fmt in CandleSeries._COLUMNS]
+        self.times = self._cols[0]
+
+    def __len__(self):
+        return len(self.times)
+
+    def close(self):
+        pass
+
+    def chunks(self, begin=None, end=None, size=10000):
+        """Yield the candles [t, o, h, l, c, v] with a time in [begin, end]
+        in lists of up to `size`"""
+        lo = 0 if begin is None else bisect_left(self.times, begin)
+        hi = len(self) if end is None else bisect_right(self.times, end)
+        for start in range(lo, hi, size):
+            stop = min(start + size, hi)
+            yield [list(c) for c in
+                   zip(*(col[start:stop].tolist() for col in self._cols))]
+
+    def append(self, candles, cover_end, cover_begin=None):
+        """Add the candles after the covered range and extend it up to
+        `cover_end`. `cover_begin` starts the range of an empty series"""
+        if self.cover is not None:
+            cover_begin = self.cover[0]
+            candles = [c for c in candles if c[0] > self.cover[1]]
+            cover_end = max(cover_end, self.cover[1])
+        elif cover_begin is None:
+            if not candles:
+                return
+            cover_begin = candles[0][0]
+
+        for i, col in enumerate(self._cols):
+            col.extend(c[i] for c in candles)
+        if candles:
+            cover_begin = min(cover_begin, candles[0][0])
+            cover_end = max(cover_end, candles[-1][0])
+        self.cover = (cover_begin, max(cover_end, cover_begin - 1))
+
+    def prepend(self, candles, cover_begin):
+        """Add the candles before the covered range and extend it down to
+        `cover_begin`"""
+        if self.cover is None:
+            if candles:
+                self.append(candles, candles[-1][0], cover_begin)
+            return
+
+        candles = [c for c in candles if c[0] < self.cover[0]]
+        if candles:
+            for i, col in enumerate(self._cols):
+                self._cols[i] = array(col.typecode,
+                                      [c[i] for c in candles]) + col
+            self.times = self._cols[0]
+        self.cover = (min(cover_begin, self.cover[0]), self.cover[1])
+
+
+class CandleCache(object):
+    """
+    On-disk candle cache, one `CandleSeries` file per symbol and
+    granularity in `directory`. Without a directory the candles are only
+    kept in memory (`MemorySeries`).
+
+    Usage::
+
+        cache = CandleCache('~/.cache/mt5')
+        series = cache.series('EURUSD', 'M1')
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory and os.path.expanduser(directory)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def series(self, symbol, granularity):
+        """The cached candles of `symbol` at `granularity`"""
+        key = (symbol, granularity)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None and not self.directory:
+                series = self._series[key] = MemorySeries()
+            elif series is None:
+                path = os.path.join(self.directory, '{}_{}.bars'.format(
+                    symbol.replace(os.sep, '_'), granularity))
+                series = self._series[key] = CandleSeries(path)
+        return series
+
+    def close(self):
+        with self._lock:
+            for series in self._series.values():
+                series.close()
+            self._series.clear()
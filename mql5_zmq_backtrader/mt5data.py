@@ -1,13 +1,21 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import collections
 from datetime import datetime
+import math
+import time
 
 from backtrader.feed import DataBase
-from backtrader import date2num, num2date
-from backtrader.utils.py3 import queue, with_metaclass
+from backtrader import TimeFrame, num2date
+from backtrader.utils.py3 import with_metaclass
 
 from mql5_zmq_backtrader import mt5store
+from mql5_zmq_backtrader.mt5bars import (BAR_FIELDS, TICK_FIELDS,
+                                         BarAggregator, TickBarBuilder,
+                                         block_bar, block_column, block_len,
+                                         block_range, msc2num, num2ts,
+                                         period_bounds, ts2num)
 
 
 class MetaMTraderData(DataBase.__class__):
@@ -17,13 +25,17 @@ class MetaMTraderData(DataBase.__class__):
         super(MetaMTraderData, cls).__init__(name, bases, dct)
 
         # Register with the store
-        mt5store.MTraderStore.DataCls = cls
+        if cls._FIELDS == TICK_FIELDS:
+            mt5store.MTraderStore.TickDataCls = cls
+        else:
+            mt5store.MTraderStore.DataCls = cls
 
 
 class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
     """MTrader Data Feed.
 
-    TODO: implement tick data. Main problem is that Backtrader is not tick oriented.
+    Ticks are served by `MTraderTickData`, see `MTraderStore.getdata`.
+
     TODO: test backfill_from
 
     Params:
@@ -38,8 +50,11 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
 
       - `backfill` (default: `True`)
 
-        Perform backfilling after a disconnection/reconnection cycle. The gap
-        duration will be used to download the smallest possible amount of data
+        Perform backfilling after a disconnection/reconnection cycle. Only
+        the bars between the last one loaded and the first live one after
+        the reconnection are downloaded. Each gap is recorded in `gaps`
+        with its `gap` (seconds without data), the `bars` backfilled and
+        the `elapsed` seconds it took
 
       - `backfill_from` (default: `None`)
 
@@ -56,6 +71,43 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
 
         Reconnect when network connection is down
 
+      - `live_qsize` (default: `0`)
+
+        Maximum number of live messages waiting for the strategy, `0` means
+        unbounded
+
+      - `live_overflow` (default: `block`)
+
+        What to do when the live queue is full: `block` stops reading the
+        live socket, `dropoldest` discards the oldest messages and `latest`
+        keeps only the last bar. Shed messages are counted in
+        `qlive.dropped` and `qlive.merged`
+
+      - `live_conflate` (default: `False`)
+
+        With `live_overflow='latest'` and a single live feed, let the live
+        socket keep only its last message too (ZMQ `CONFLATE`). A
+        disconnection may then go unnoticed
+
+      - `derive` (default: `False`)
+
+        Build the bars from the M1 candles of the symbol instead of
+        requesting the timeframe from the terminal. The M1 history is
+        downloaded once and the M1 live stream received once for all the
+        deriving feeds of a symbol (with a `fromdate`). A bar is loaded once
+        its last minute arrived
+
+      - `warmup` (default: `False`)
+
+        Without `fromdate` and `todate`, download just the bars needed by
+        the minimum period of the strategies using the feed plus
+        `warmup_margin`, then go live. The download starts with the first
+        bar requested by cerebro, once the strategies exist
+
+      - `warmup_margin` (default: `10`)
+
+        Bars downloaded on top of the minimum period with `warmup`
+
     """
     params = (
         ('historical', False),   # do backfilling at the start
@@ -63,17 +115,26 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
         ('backfill_from', None),  # additional data source to do backfill from
         ('include_last', False),
         ('reconnect', True),
+        ('live_qsize', 0),
+        ('live_overflow', 'block'),
+        ('live_conflate', False),
+        ('derive', False),
+        ('warmup', False),
+        ('warmup_margin', 10),
     )
 
     _store = mt5store.MTraderStore
 
+    # Values per bar in the history blocks
+    _FIELDS = BAR_FIELDS
+
     # States for the Finite State Machine in _load
     _ST_FROM, _ST_START, _ST_LIVE, _ST_HISTORBACK, _ST_OVER = range(5)
 
     def islive(self):
         """True notifies `Cerebro` that `preloading` and `runonce`
-        should be deactivated"""
-        return True
+        should be deactivated. A historical only feed can be preloaded"""
+        return not self.p.historical
 
     def __init__(self, **kwargs):
         self.o = self._store(**kwargs)
@@ -92,18 +153,30 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
 
         # Create attributes as soon as possible
         self._statelivereconn = False  # if reconnecting in live state
-        self.qlive = self.o.q_livedata
+        self._gapwait = False  # reconnected, first live bar not seen yet
+        self._gapmsg = None  # first live bar held while backfilling
+        self._gap = None  # backfill being done
+        self.gaps = collections.deque(maxlen=100)
+        self.qlive = collections.deque()
+        self.qhist = None  # history being downloaded
 
         #ram
         self.contractdetails = None
 
         self._state = self._ST_OVER
 
-        # Kickstart store and get queue to wait on
-        self.o.start(data=self)
+        # bars of the timeframe built from M1 candles
+        self._derived = None
+        frame = (self._timeframe, self._compression)
+        if self._terminal_frame() == (TimeFrame.Minutes, 1) != frame:
+            self._derived = BarAggregator(self.o.get_granularity(*frame))
+
+        # Kickstart store and get queue to wait on, it receives the live
+        # messages for this symbol and granularity only
+        self.qlive = self.o.start(data=self)
 
         # Check if the granularity is supported
-        data_tf = self.o.get_granularity(self._timeframe, self._compression)
+        data_tf = self.o.get_granularity(*self._terminal_frame())
         if data_tf is None:
             self.put_notification(self.NOTSUPPORTED_TF)
             self._state = self._ST_OVER
@@ -121,26 +194,135 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
             self._start_finish()
             # initial state for _load
             self._state = self._ST_START
-            self._st_start()
+            if not self._warmup():
+                self._st_start()
+
+    def _terminal_frame(self):
+        """Timeframe and compression of the data requested from the
+        terminal"""
+        if self.p.derive:
+            return TimeFrame.Minutes, 1
+        return self._timeframe, self._compression
+
+    def _warmup(self):
+        """True if the history is sized by the strategies, known once they
+        are created: the download waits for the first `_load`"""
+        return bool(self.p.warmup and not self.p.historical and
+                    self.fromdate == float('-inf') and
+                    self.todate == float('inf'))
+
+    def _warmup_bars(self):
+        """Bars needed by the strategies using this feed and the margin,
+        None when no strategy uses it"""
+        minperiods = [minperiod
+                      for strat in getattr(self._env, 'runningstrats', ())
+                      for data, minperiod in zip(strat.datas,
+                                                 strat._minperiods)
+                      if data is self]
+        if not minperiods:
+            return None
+        return max(minperiods) + self.p.warmup_margin
 
     def _st_start(self):
-        self.put_notification(self.DELAYED)
+        count = self._warmup_bars() if self._warmup() else None
+        if count is not None:
+            self._st_historback(self._history_last(count))
+            return True
 
         date_begin = num2date(
             self.fromdate) if self.fromdate > float('-inf') else None
         date_end = num2date(
             self.todate) if self.todate < float('inf') else None
 
-        self.qhist = self.o.candles(self.p.dataname, date_begin, date_end, self._timeframe,
-                                    self._compression, self.p.include_last)
+        self._st_historback(self._history(date_begin, date_end))
+        return True
+
+    def _st_historback(self, qhist):
+        """Load the history downloaded in the `qhist` queue"""
+        self.put_notification(self.DELAYED)
+
+        self._hist = ()  # block of decoded bars being loaded
+        self._histlen = self._histpos = 0
+        self.qhist = qhist
 
         self._state = self._ST_HISTORBACK
 
-        return True
+    def _history(self, date_begin, date_end, closed=False):
+        """Start the history download, return the queue of its blocks.
+        `closed` ranges end before the present, their last bar included"""
+        if self._derived is not None:
+            # the forming M1 candle would be taken for a closed one
+            return self.o.candles(self.p.dataname, date_begin, date_end,
+                                  TimeFrame.Minutes, 1, closed, shared=True)
+        return self.o.candles(self.p.dataname, date_begin, date_end,
+                              self._timeframe, self._compression,
+                              closed or self.p.include_last)
+
+    def _history_last(self, count):
+        """Start the download of the last `count` closed bars, return the
+        queue of its blocks"""
+        if self._derived is not None:
+            # whole periods, fewer bars when some hold no candle
+            granularity = self._derived.granularity
+            begin, end = period_bounds(int(time.time()), granularity)
+            begin = period_bounds(begin - count * (end - begin),
+                                  granularity)[0]
+            return self._history(datetime.utcfromtimestamp(begin), None)
+        return self.o.last_candles(self.p.dataname, count, self._timeframe,
+                                   self._compression)
+
+    def preload(self):
+        """Load the whole history at once.
+
+        Without filters, backfill source or input timezone the candles are
+        appended straight to the line buffers, bypassing the bar by bar
+        `load` machinery.
+        """
+        lines = list(self.lines)
+        if (self._state != self._ST_HISTORBACK or self._derived is not None or
+                self._filters or self._ffilters or self._tzinput or
+                any(line.mode != line.UnBounded for line in lines)):
+            return super(MTraderData, self).preload()
+
+        named = [self.lines.datetime, self.lines.open, self.lines.high,
+                 self.lines.low, self.lines.close, self.lines.volume]
+        # openinterest and any extra line of subclasses last
+        lines = named + [line for line in lines
+                         if not any(line is n for n in named)]
+        last = self.lines.datetime[0] if len(self) else None
+        n = 0
+        while True:
+            block = self.qhist.get()
+            if block is None or not len(block):
+                break
+
+            lo, hi = block_range(block, self.fromdate, self.todate, last)
+            if hi > lo:
+                zeros = bytes(8 * (hi - lo))
+                for i, line in enumerate(lines):
+                    if i < BAR_FIELDS:
+                        column = block_column(block, i, lo, hi).tobytes()
+                    else:
+                        column = zeros
+                    line.array.frombytes(column)
+                last = block[(hi - 1) * BAR_FIELDS]
+                n += hi - lo
+
+        for line in lines:
+            line.idx += n
+            line.lencount += n
+
+        self.put_notification(self.DISCONNECTED)
+        self._state = self._ST_OVER
+
+        self._last()
+        self.home()
 
     def stop(self):
         '''Stops and tells the store to stop'''
         super(MTraderData, self).stop()
+        if self.qhist is not None:
+            self.qhist.close()  # the download may still be running
         self.o.stop()
 
     def haslivedata(self):
@@ -151,36 +333,42 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
             return False
 
         while True:
-            if self._state == self._ST_LIVE:
-                try:
-                    msg = self.qlive.get()
-                except queue.Empty:
-                    return None
-
-                if msg:
-                    if msg['status'] == 'DISCONNECTED':
-                        self.put_notification(self.DISCONNECTED)
-
-                        if not self.p.backfill:
-                            self._state = self._ST_OVER
-
-                        self._statelivereconn = True
-                        continue
+            if self._state == self._ST_OVER:
+                return False
+
+            elif self._state == self._ST_LIVE:
+                if self._gapmsg is not None:
+                    # gap backfilled, back to the live bars
+                    msg, self._gapmsg = self._gapmsg, None
+                    if self._load_live(msg):
+                        return True
+                    continue
 
-                    elif msg['status'] == 'CONNECTED' and self._statelivereconn:
-                        self.put_notification(self.CONNECTED)
-                        self._statelivereconn = False
+                msg = self.qlive.get(self._live_timeout())
+                if msg is None:
+                    return self._live_idle()
 
-                        if len(self) > 1:
-                            self.fromdate = self.lines.datetime[-1]
+                if self._live_status(msg):
+                    continue
 
-                        self._st_start()
+                if self._gapwait:
+                    self._gapwait = False
+                    if self._backfill(msg):
                         continue
 
-                    if self._load_history(msg['data']):
-                        return True  # loading worked
+                if self._load_live(msg):
+                    return True  # loading worked
 
             elif self._state == self._ST_HISTORBACK:
+                if self._histpos < self._histlen:
+                    # bars are decoded and ascending
+                    bar = block_bar(self._hist, self._histpos, self._FIELDS)
+                    self._histpos += 1
+                    if self._load_bar(bar):
+                        return True
+                    continue  # time already seen
+
+                # current window consumed, windows arrive in order
                 msg = self.qhist.get()
                 if msg is None:
                     # Situation not managed. Simply bail out
@@ -188,18 +376,31 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
                     self._state = self._ST_OVER
                     return False  # error management cancelled the queue
 
-                if msg:
-                    if self._load_history(msg):
-                        return True  # loading worked
-
-                    continue  # not loaded ... date may have been seen
+                if len(msg):
+                    self._hist = msg
+                    self._histlen = block_len(msg, self._FIELDS)
+                    self._histpos = 0
+                    continue
                 else:
                     # End of histdata
                     if self.p.historical:  # only historical
+                        if self._flush_derived():
+                            return True
+
                         self.put_notification(self.DISCONNECTED)
                         self._state = self._ST_OVER
                         return False  # end of historical
 
+                if self._gap is not None:
+                    self._gap['elapsed'] = time.time() - self._gap['elapsed']
+                    self._gap['bars'] = len(self) - self._gap['bars']
+                    self.gaps.append(self._gap)
+                    if self.o.debug:
+                        print('Backfilled {}: {gap}s gap, {bars} bars in '
+                              '{elapsed:.3f}s'.format(self.p.dataname,
+                                                      **self._gap))
+                    self._gap = None
+
                 # Live is also wished - go for it
                 self._state = self._ST_LIVE
                 self.put_notification(self.LIVE)
@@ -225,16 +426,126 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
                     self._state = self._ST_OVER
                     return False
 
+    def _live_timeout(self):
+        """Seconds to wait for a live message"""
+        return self._qcheck
+
+    def _live_idle(self):
+        """No live message arrived in time, True if a bar was loaded
+        anyway, None otherwise"""
+        return None
+
+    def _live_status(self, msg):
+        """Act on the connection status carried by a live message, True if
+        nothing else is to be done with it"""
+        if not msg:
+            return True
+
+        if msg['status'] == 'DISCONNECTED':
+            self.put_notification(self.DISCONNECTED)
+
+            if not self.p.backfill:
+                self._state = self._ST_OVER
+
+            self._statelivereconn = True
+            return True
+
+        elif msg['status'] == 'CONNECTED' and self._statelivereconn:
+            self.put_notification(self.CONNECTED)
+            self._statelivereconn = False
+
+            if len(self) <= 1:
+                self._st_start()  # nothing loaded yet, start over
+                return True
+
+            # the gap is known with the first live bar, maybe this one
+            self._gapwait = True
+            return not msg.get('data')
+
+        return False
+
+    def _last_time(self):
+        """Epoch second of the last bar received from the terminal"""
+        if self._derived is not None:
+            return self._derived.last
+        return num2ts(self.lines.datetime[-1])
+
+    def _hold_live(self, msg):
+        """Epoch second of a live message and what to load it from
+        later"""
+        return msg['data'][0], msg
+
+    def _backfill(self, msg):
+        """Download the bars missed between the last one loaded and the
+        live `msg`, which is loaded afterwards. False if nothing is
+        missing"""
+        first, held = self._hold_live(msg)
+        last = self._last_time()
+        begin, end = self._gap_range(last, first)
+        if end < begin:
+            return False
+
+        self._gapmsg = held
+        self._gap = dict(gap=first - last, bars=len(self),
+                         elapsed=time.time())
+        self._st_historback(self._history(datetime.utcfromtimestamp(begin),
+                                          datetime.utcfromtimestamp(end),
+                                          closed=True))
+        return True
+
+    def _gap_range(self, last, first):
+        """Seconds [begin, end] to download between the `last` time loaded
+        and the `first` live one"""
+        return int(last) + 1, int(math.ceil(first)) - 1
+
+    def _load_live(self, msg):
+        return self._load_history(msg['data'])
+
     def _load_history(self, ohlcv):
         time_stamp, _open, _high, _low, _close, _volume = ohlcv
-        d_time = datetime.utcfromtimestamp(time_stamp)
+        return self._load_bar((ts2num(time_stamp), _open, _high, _low, _close,
+                               _volume))
+
+    def _derive(self, bar):
+        """Add an M1 bar to the derived one, return the latter once
+        complete"""
+        t = num2ts(bar[0])
+        done = self._derived.update(t, *bar[1:BAR_FIELDS])
+        if done is None:
+            done = self._derived.flush(t + 60)
+        if done is not None:
+            done[0] = ts2num(done[0])
+        return done
+
+    def _flush_derived(self):
+        """Load the derived bar whose time is over by the end of a
+        historical download, missing its last minute"""
+        if self._derived is None:
+            return False
 
-        dt = date2num(d_time)
+        now = time.time()
+        if self.todate < float('inf'):
+            now = min(now, num2ts(self.todate) + 60)
+        bar = self._derived.flush(now)
+        if bar is None:
+            return False
+        bar[0] = ts2num(bar[0])
+        return self._put_bar(bar)
+
+    def _load_bar(self, bar):
+        if self._derived is not None:
+            bar = self._derive(bar)
+            if bar is None:
+                return False
+        return self._put_bar(bar)
+
+    def _put_bar(self, bar):
+        dt, _open, _high, _low, _close, _volume = bar
         # time already seen
         if dt <= self.lines.datetime[-1]:
             return False
 
-        self.lines.datetime[0] = date2num(d_time)
+        self.lines.datetime[0] = dt
         self.lines.open[0] = _open
         self.lines.high[0] = _high
         self.lines.low[0] = _low
@@ -242,3 +553,176 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
         self.lines.volume[0] = _volume
         self.lines.openinterest[0] = 0.0
         return True
+
+
+class MTraderTickData(MTraderData):
+    """MTrader tick data feed, see `MTraderData` for the common params.
+
+    Created by the store for `timeframe=bt.TimeFrame.Ticks`. Every tick is
+    loaded as a bar with open, high, low and close at the last price (the
+    bid for symbols without one), the tick volume and the `bid` and `ask`
+    lines. Ticks sharing a time are all loaded.
+
+    With `timeframe=bt.TimeFrame.Seconds` and a `compression` of 1, 5, 15
+    or 30 the ticks are aggregated into bars of that many seconds, as with
+    `bar_seconds`. History is backfilled from the tick history.
+
+    Live ticks are written by the store in a preallocated ring buffer
+    (`mt5store.TickRing`) and read from it in place.
+
+    Params:
+
+      - `ring_size` (default: `65536`)
+
+        Live ticks buffered for the strategy. When it falls further behind
+        the oldest are dropped and counted in `qlive.dropped`
+
+      - `bar_seconds` (default: `0`)
+
+        Aggregate the ticks into OHLCV bars of that many seconds, which the
+        feed then reports as its timeframe. Bars open at multiples of
+        `bar_seconds` since the epoch, carry their open time like the
+        terminal candles and are loaded once a tick of the next bar arrives
+        or, live, `flush_delay` seconds after their end
+
+      - `flush_delay` (default: `0.1`)
+
+        Seconds given to the last ticks of a live bar to arrive once its time
+        is over. Later ticks of the bar are ignored
+
+    """
+    lines = ('bid', 'ask')
+
+    params = (
+        ('ring_size', 65536),
+        ('bar_seconds', 0),
+        ('flush_delay', 0.1),
+    )
+
+    _FIELDS = TICK_FIELDS
+
+    def _terminal_frame(self):
+        return TimeFrame.Ticks, 1
+
+    def start(self):
+        self._lasttick = float('-inf')  # epoch seconds of the last tick
+        self._bars = None
+        self._quote = (float('nan'), float('nan'))
+        seconds = self.p.bar_seconds
+        if not seconds and self._timeframe == TimeFrame.Seconds:
+            # raise for the compressions the feed does not build
+            self.o.get_granularity(self._timeframe, self._compression)
+            seconds = self._compression
+        if seconds:
+            self._bars = TickBarBuilder(seconds)
+            self._timeframe = TimeFrame.Seconds
+            self._compression = seconds
+        super(MTraderTickData, self).start()
+
+    def _history(self, date_begin, date_end, closed=False):
+        return self.o.ticks(self.p.dataname, date_begin, date_end)
+
+    def _history_last(self, count):
+        # bars of known length, the terminal default for plain ticks
+        begin = None
+        if self._bars is not None:
+            seconds = self._bars.seconds
+            now = int(time.time())
+            begin = datetime.utcfromtimestamp(
+                now - now % seconds - count * seconds)
+        return self._history(begin, None)
+
+    def preload(self):
+        # blocks hold ticks, not bars: load them one by one
+        return DataBase.preload(self)
+
+    def _live_timeout(self):
+        # wake up in time to flush the bar being built
+        timeout = self._qcheck
+        bar = self._bars and self._bars.bar
+        if bar:
+            due = bar[0] + self._bars.seconds + self.p.flush_delay
+            timeout = max(0.0, min(timeout, due - time.time()))
+        return timeout
+
+    def _live_idle(self):
+        if self._bars is None:
+            return None
+        bar = self._bars.flush(time.time() - self.p.flush_delay)
+        if bar is None:
+            return None
+        self._load_tickbar(bar, self._quote)
+        return True
+
+    def _live_status(self, msg):
+        # ticks arrive as ring slots, status messages as they are
+        if not isinstance(msg, dict):
+            return False
+        return super(MTraderTickData, self)._live_status(msg)
+
+    def _load_live(self, msg):
+        if isinstance(msg, dict):
+            return False
+        if isinstance(msg, tuple):  # held while backfilling
+            return self._load_tick(*msg)
+        ring = self.qlive
+        return self._load_tick(ring.time[msg], ring.bid[msg], ring.ask[msg],
+                               ring.last[msg], ring.volume[msg])
+
+    def _last_time(self):
+        return self._lasttick
+
+    def _backfill(self, msg):
+        if isinstance(msg, dict):  # no tick, wait for one
+            self._gapwait = True
+            return False
+        self._gapfrom = self._lasttick
+        return super(MTraderTickData, self)._backfill(msg)
+
+    def _gap_range(self, last, first):
+        # ticks share seconds, those outside the gap are skipped in _load_bar
+        return int(last), int(first)
+
+    def _hold_live(self, msg):
+        ring = self.qlive
+        tick = (ring.time[msg], ring.bid[msg], ring.ask[msg], ring.last[msg],
+                ring.volume[msg])
+        return tick[0], tick
+
+    def _load_bar(self, bar):
+        if len(bar) == TICK_FIELDS:
+            if self._gapmsg is not None and \
+                    not self._gapfrom < bar[0] < self._gapmsg[0]:
+                return False  # loaded before the gap or held after it
+            return self._load_tick(*bar)
+        return super(MTraderTickData, self)._load_bar(bar)
+
+    def _load_tick(self, t, bid, ask, last, volume):
+        if t < self._lasttick:
+            return False  # older than what was loaded
+        self._lasttick = t
+
+        price = last or bid
+        if self._bars is not None:
+            bar = self._bars.update(t, price, volume)
+            # the bar closes with the quote preceding the tick of the next
+            quote, self._quote = self._quote, (bid, ask)
+            if bar is None:
+                return False
+            return self._load_tickbar(bar, quote)
+
+        self.lines.datetime[0] = msc2num(t)
+        self.lines.open[0] = self.lines.high[0] = price
+        self.lines.low[0] = self.lines.close[0] = price
+        self.lines.volume[0] = volume
+        self.lines.openinterest[0] = 0.0
+        self.lines.bid[0] = bid
+        self.lines.ask[0] = ask
+        return True
+
+    def _load_tickbar(self, bar, quote):
+        bar[0] = ts2num(bar[0])
+        if not self._put_bar(bar):
+            return False
+        self.lines.bid[0], self.lines.ask[0] = quote
+        return True
@@ -0,0 +1,767 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import calendar
+import collections
+import heapq
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import zmq
+
+
+class MTraderFakeTerminal(object):
+    """
+    Pure Python stand-in for a MetaTrader 5 terminal running the MQL5 JSON API
+    expert. It binds the same four ports used by `MTraderAPI` so that the
+    store, broker and data feeds can be driven fully offline.
+
+      - SYS (REP semantics): every request is acknowledged with "OK"
+      - DATA (PUSH): the reply to every request
+      - LIVE (PUSH): synthetic candles for each symbol
+      - EVENTS (PUSH): trade transactions
+
+    Prices are a deterministic function of symbol and bar time, so history
+    downloads and the live stream always agree with each other. The live
+    clock runs `rate` bars per second and may get ahead of the wall clock,
+    history is served up to whichever is later. Order comments are kept as
+    strings of up to 31 characters, as by the terminal.
+
+    Params:
+
+      - `symbols`: symbols streamed on the live port
+      - `timeframe`: granularity of the streamed candles
+      - `rate`: live candles per second and per symbol (0 disables)
+      - `tick_rate`: live ticks per second and per symbol (0 disables). Tick
+        history is served on the same time grid, 4 ticks per second when
+        disabled
+      - `events_rate`: external trade transactions per second (0 disables)
+      - `latency`: seconds before a request reply is pushed on DATA
+      - `jitter`: extra random latency, uniformly drawn in [0, jitter]
+      - `balance`: starting account balance
+      - `history_bars`: bars returned by HISTORY when `fromDate` is missing
+      - `echo_ids`: copy the `requestId` of a request into its reply. Set
+        to `False` to behave like terminals which answer strictly in order
+    """
+
+    # Bar length in seconds for every MetaTrader granularity
+    _TIMEFRAMES = {
+        'M1': 60, 'M2': 120, 'M3': 180, 'M4': 240, 'M5': 300, 'M6': 360,
+        'M10': 600, 'M12': 720, 'M15': 900, 'M20': 1200, 'M30': 1800,
+        'H1': 3600, 'H2': 7200, 'H3': 10800, 'H4': 14400, 'H6': 21600,
+        'H8': 28800, 'H12': 43200, 'D1': 86400, 'W1': 604800,
+        'MN1': 2592000,
+    }
+
+    # 1970-01-01 was a Thursday, MetaTrader weeks start on Sunday
+    _WEEK_OFFSET = 4 * 86400
+
+    _MARKET_TYPES = ('ORDER_TYPE_BUY', 'ORDER_TYPE_SELL')
+
+    _PENDING_TYPES = (
+        'ORDER_TYPE_BUY_LIMIT', 'ORDER_TYPE_SELL_LIMIT',
+        'ORDER_TYPE_BUY_STOP', 'ORDER_TYPE_SELL_STOP',
+        'ORDER_TYPE_BUY_STOP_LIMIT', 'ORDER_TYPE_SELL_STOP_LIMIT',
+    )
+
+    def __init__(self, host='127.0.0.1', symbols=('EURUSD',), timeframe='M1',
+                 rate=1.0, tick_rate=0.0, events_rate=0.0, latency=0.0,
+                 jitter=0.0,
+                 balance=10000.0, history_bars=1000, seed=None,
+                 echo_ids=True):
+        if timeframe not in self._TIMEFRAMES:
+            raise ValueError('Unknown timeframe: {}'.format(timeframe))
+
+        self.HOST = host
+        self.SYS_PORT = 15555
+        self.DATA_PORT = 15556
+        self.LIVE_PORT = 15557
+        self.EVENTS_PORT = 15558
+
+        self.symbols = list(symbols)
+        self.timeframe = timeframe
+        self.rate = rate
+        self.tick_rate = tick_rate
+        self.tick_step = int(1000 / (tick_rate or 4.0))  # milliseconds
+        self.events_rate = events_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.history_bars = history_bars
+        self.echo_ids = echo_ids
+
+        self.balance = float(balance)
+        self.positions = dict()  # position ticket -> position
+        self.orders = dict()  # pending order ticket -> order
+
+        self._random = random.Random(seed)
+        self._tickets = itertools.count(100000001)
+        self._outbox = []  # heap of (due, sequence, expiry, socket, msg, stat)
+        self._sequence = itertools.count()
+
+        # Live stream clock starts at the last closed bar
+        tfsec = self._TIMEFRAMES[timeframe]
+        now = int(time.time())
+        self._livetime = dict(
+            (s, self.bar_open(now, timeframe) - tfsec) for s in self.symbols)
+        self._last = dict()  # symbol -> last streamed candle
+        self._disconnect = 0  # live candles to miss, see disconnect()
+        self._offline = 0
+        self._tick_disconnect = 0.0  # see disconnect_ticks()
+        self._ticks_offline = 0.0  # no live ticks until then
+        self._lose = 0  # replies to lose, see lose_replies()
+
+        self.stats = collections.Counter()
+
+        self.context = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    # -- synthetic prices ---------------------------------------------------
+
+    @staticmethod
+    def _noise(x):
+        """Cheap deterministic pseudo random number in [0, 1)"""
+        return (math.sin(x * 12.9898) * 43758.5453) % 1.0
+
+    def _base_price(self, symbol):
+        crc = zlib.crc32(symbol.encode())
+        return 1.0 + (crc % 10000) / 100.0, crc % 997
+
+    def price(self, symbol, t):
+        """Deterministic mid price of `symbol` at epoch second `t`"""
+        base, phase = self._base_price(symbol)
+        wave = (0.010 * math.sin(2.0 * math.pi * t / 259200.0 + phase) +
+                0.002 * math.sin(2.0 * math.pi * t / 18000.0 + phase) +
+                0.0005 * (self._noise(t + phase) - 0.5))
+        return round(base * (1.0 + wave), 5)
+
+    def bar_open(self, t, timeframe):
+        """Open time of the bar of `timeframe` containing epoch second `t`"""
+        if timeframe == 'MN1':
+            d = datetime.utcfromtimestamp(t)
+            return calendar.timegm((d.year, d.month, 1, 0, 0, 0))
+
+        tfsec = self._TIMEFRAMES[timeframe]
+        if timeframe == 'W1':
+            return ((t + self._WEEK_OFFSET) // tfsec) * tfsec - \
+                self._WEEK_OFFSET
+
+        return (t // tfsec) * tfsec
+
+    def bar_close(self, t, timeframe):
+        """Open time of the bar following the one opened at `t`"""
+        if timeframe == 'MN1':
+            d = datetime.utcfromtimestamp(t)
+            year, month = divmod(d.year * 12 + d.month, 12)
+            return calendar.timegm((year, month + 1, 1, 0, 0, 0))
+
+        return t + self._TIMEFRAMES[timeframe]
+
+    def candle(self, symbol, t, timeframe):
+        """Return the [time, open, high, low, close, volume] bar at `t`"""
+        t1 = self.bar_close(t, timeframe)
+        o = self.price(symbol, t)
+        c = self.price(symbol, t1)
+        spread = abs(c - o) + o * 0.0002
+        h = round(max(o, c) + spread * self._noise(t + 1.0), 5)
+        low = round(min(o, c) - spread * self._noise(t + 2.0), 5)
+        v = 10 + int(self._noise(t + 3.0) * 1000)
+        return [t, o, h, low, c, v]
+
+    def candles(self, symbol, timeframe, begin=None, end=None):
+        """Bars with an open time in [begin, end], both inclusive.
+
+        As with the real terminal the last bar may still be forming.
+        """
+        # the last streamed candle is closed, the next one forming
+        closes = [self.bar_close(t, self.timeframe)
+                  for t in self._livetime.values()]
+        now = max([int(time.time())] + closes)
+        if end is None or end > now:
+            end = now
+
+        if begin is None:
+            t = self.bar_open(end, timeframe)
+            for _ in range(self.history_bars - 1):
+                t = self._bar_before(t, timeframe)
+        else:
+            t = self.bar_open(begin, timeframe)
+            if t < begin:
+                t = self.bar_close(t, timeframe)
+
+        bars = list()
+        while t <= end:
+            bars.append(self.candle(symbol, t, timeframe))
+            t = self.bar_close(t, timeframe)
+
+        return bars
+
+    def tick(self, symbol, msc):
+        """Return the [time_msc, bid, ask, last, volume] tick at `msc`"""
+        mid = self.price(symbol, msc / 1000.0)
+        half = round(mid * 0.00005, 5)
+        volume = 1 + int(self._noise(msc + 4.0) * 10)
+        return [msc, round(mid - half, 5), round(mid + half, 5), mid, volume]
+
+    def ticks(self, symbol, begin=None, end=None):
+        """Ticks with a time in the seconds [begin, end], both inclusive.
+        Without `begin` the last `history_bars` ticks"""
+        now = int(time.time() * 1000)
+        stop = now if end is None else min(now, end * 1000 + 999)
+        stop -= stop % self.tick_step
+        if begin is None:
+            t = stop - (self.history_bars - 1) * self.tick_step
+        else:
+            t = -(-begin * 1000 // self.tick_step) * self.tick_step
+
+        return [self.tick(symbol, msc)
+                for msc in range(t, stop + 1, self.tick_step)]
+
+    def _bar_before(self, t, timeframe):
+        if timeframe == 'MN1':
+            return self.bar_open(t - 86400, timeframe)
+        return t - self._TIMEFRAMES[timeframe]
+
+    def _quote(self, symbol):
+        """Current (bid, ask) of symbol based on the last streamed candle"""
+        last = self._last.get(symbol)
+        if last is not None:
+            mid = last[4]
+        else:
+            mid = self.price(symbol, int(time.time()))
+        half = round(mid * 0.00005, 5)
+        return round(mid - half, 5), round(mid + half, 5)
+
+    # -- account ------------------------------------------------------------
+
+    def _profit(self, position):
+        bid, ask = self._quote(position['symbol'])
+        if position['type'] == 'POSITION_TYPE_BUY':
+            return (bid - position['open']) * position['volume']
+        return (position['open'] - ask) * position['volume']
+
+    def equity(self):
+        return self.balance + sum(self._profit(p)
+                                  for p in self.positions.values())
+
+    def margin(self):
+        return sum(p['open'] * p['volume']
+                   for p in self.positions.values()) / 100.0
+
+    # -- request handlers ---------------------------------------------------
+
+    def handle(self, request):
+        """Build the DATA reply for a decoded SYS request"""
+        action = request.get('action')
+        handler = getattr(self, '_on_' + str(action).lower(), None)
+        if handler is None:
+            return self._error('Wrong action: {}'.format(action))
+
+        return handler(request)
+
+    @staticmethod
+    def _error(description, retcode=None):
+        reply = {'error': True, 'description': description}
+        if retcode is not None:
+            reply['retcode'] = retcode
+        return reply
+
+    def _on_config(self, request):
+        return {'error': False}
+
+    def _on_reset(self, request):
+        return {'error': False}
+
+    def _on_account(self, request):
+        equity = self.equity()
+        margin = self.margin()
+        return {
+            'error': False,
+            'broker': 'Fake Broker Ltd.',
+            'currency': 'USD',
+            'server': 'Fake-Demo',
+            'trading_allowed': 1,
+            'bot_trading': 1,
+            'balance': self.balance,
+            'equity': equity,
+            'margin': margin,
+            'margin_free': equity - margin,
+            'margin_level': equity / margin * 100.0 if margin else 0.0,
+        }
+
+    def _on_balance(self, request):
+        equity = self.equity()
+        margin = self.margin()
+        return {
+            'balance': self.balance,
+            'equity': equity,
+            'margin': margin,
+            'margin_free': equity - margin,
+        }
+
+    def _on_positions(self, request):
+        return {'error': False, 'positions': list(self.positions.values())}
+
+    def _on_orders(self, request):
+        return {'error': False, 'orders': list(self.orders.values())}
+
+    def _on_history(self, request):
+        symbol = request.get('symbol')
+        timeframe = request.get('chartTF')
+        if not symbol:
+            return self._error('Wrong symbol')
+        if timeframe == 'TICK':
+            data = self.ticks(symbol, request.get('fromDate'),
+                              request.get('toDate'))
+            return {'symbol': symbol, 'timeframe': timeframe, 'data': data}
+        if timeframe not in self._TIMEFRAMES:
+            return self._error('Wrong timeframe: {}'.format(timeframe))
+
+        data = self.candles(symbol, timeframe,
+                            request.get('fromDate'), request.get('toDate'))
+        return {'symbol': symbol, 'timeframe': timeframe, 'data': data}
+
+    def _on_trade(self, request):
+        action_type = request.get('actionType')
+        symbol = request.get('symbol')
+
+        if action_type in self._MARKET_TYPES:
+            return self._market_order(request)
+
+        if action_type in self._PENDING_TYPES:
+            return self._pending_order(request)
+
+        if action_type == 'ORDER_CANCEL':
+            order = self.orders.pop(request.get('id'), None)
+            if order is None:
+                return self._error('TRADE_RETCODE_INVALID_ORDER', 10016)
+            self._event('TRADE_ACTION_REMOVE', order, 'TRADE_RETCODE_DONE',
+                        order['volume'], order['open'])
+            return self._trade_reply(order['id'], 0, order['volume'],
+                                     order['open'], symbol)
+
+        if action_type == 'POSITION_CLOSE_ID':
+            position = self.positions.pop(request.get('id'), None)
+            if position is None:
+                return self._error('TRADE_RETCODE_POSITION_CLOSED', 10036)
+            return self._close(position)
+
+        if action_type in ('POSITION_MODIFY', 'ORDER_MODIFY'):
+            book = self.positions if action_type[0] == 'P' else self.orders
+            item = book.get(request.get('id'))
+            if item is None:
+                return self._error('TRADE_RETCODE_INVALID', 10013)
+            item['stoploss'] = request.get('stoploss') or item['stoploss']
+            item['takeprofit'] = request.get('takeprofit') or \
+                item['takeprofit']
+            return self._trade_reply(item['id'], 0, item['volume'],
+                                     item['open'], item['symbol'])
+
+        return self._error('Wrong actionType: {}'.format(action_type), 10013)
+
+    def _ticket(self, request):
+        return {
+            'id': next(self._tickets),
+            'magic': request.get('magic') or 0,
+            'symbol': request.get('symbol'),
+            'time_setup': int(time.time()),
+            'stoploss': float(request.get('stoploss') or 0.0),
+            'takeprofit': float(request.get('takeprofit') or 0.0),
+            'volume': float(request.get('volume') or 0.0),
+            'comment': self._comment(request.get('comment')),
+        }
+
+    @staticmethod
+    def _comment(comment):
+        # the terminal keeps comments as strings of up to 31 characters
+        if comment is None:
+            return ''
+        if not isinstance(comment, str):
+            comment = json.dumps(comment)
+        return comment[:31]
+
+    def _market_order(self, request):
+        if not request.get('symbol') or not request.get('volume'):
+            return self._error('TRADE_RETCODE_INVALID', 10013)
+
+        bid, ask = self._quote(request['symbol'])
+        is_buy = request['actionType'] == 'ORDER_TYPE_BUY'
+
+        position = self._ticket(request)
+        position['type'] = 'POSITION_TYPE_BUY' if is_buy else \
+            'POSITION_TYPE_SELL'
+        position['open'] = ask if is_buy else bid
+        self.positions[position['id']] = position
+
+        deal = next(self._tickets)
+        self._event('TRADE_ACTION_DEAL', position, 'TRADE_RETCODE_DONE',
+                    position['volume'], position['open'],
+                    otype=request['actionType'], deal=deal)
+        return self._trade_reply(position['id'], deal, position['volume'],
+                                 position['open'], request['symbol'])
+
+    def _pending_order(self, request):
+        if not request.get('symbol') or not request.get('volume') or \
+                request.get('price') is None:
+            return self._error('TRADE_RETCODE_INVALID', 10013)
+
+        order = self._ticket(request)
+        order['type'] = request['actionType']
+        order['open'] = float(request['price'])
+        self.orders[order['id']] = order
+
+        self._event('TRADE_ACTION_PENDING', order, 'TRADE_RETCODE_PLACED',
+                    order['volume'], order['open'], otype=order['type'])
+        return self._trade_reply(order['id'], 0, order['volume'],
+                                 order['open'], request['symbol'])
+
+    def _close(self, position):
+        bid, ask = self._quote(position['symbol'])
+        is_buy = position['type'] == 'POSITION_TYPE_BUY'
+        price = bid if is_buy else ask
+        self.balance += self._profit(position)
+
+        order = dict(position, id=next(self._tickets))
+        deal = next(self._tickets)
+        otype = 'ORDER_TYPE_SELL' if is_buy else 'ORDER_TYPE_BUY'
+        self._event('TRADE_ACTION_DEAL', order, 'TRADE_RETCODE_DONE',
+                    position['volume'], price, otype=otype, deal=deal,
+                    position=position['id'])
+        return self._trade_reply(order['id'], deal, position['volume'],
+                                 price, position['symbol'])
+
+    def _fill_pending(self, symbol, candle):
+        """Trigger the pending orders of `symbol` crossed by `candle`"""
+        _, _, high, low, _, _ = candle
+        for order in [o for o in self.orders.values()
+                      if o['symbol'] == symbol]:
+            otype = order['type']
+            price = order['open']
+            is_buy = otype.startswith('ORDER_TYPE_BUY')
+            if otype.endswith('_LIMIT'):
+                crossed = low <= price if is_buy else high >= price
+            else:
+                crossed = high >= price if is_buy else low <= price
+
+            if not crossed:
+                continue
+
+            del self.orders[order['id']]
+            position = dict(order, type='POSITION_TYPE_BUY' if is_buy else
+                            'POSITION_TYPE_SELL')
+            self.positions[position['id']] = position
+            self._event('TRADE_ACTION_DEAL', order, 'TRADE_RETCODE_DONE',
+                        order['volume'], price,
+                        otype='ORDER_TYPE_BUY' if is_buy else
+                        'ORDER_TYPE_SELL', deal=next(self._tickets))
+
+    def _trade_reply(self, order, deal, volume, price, symbol):
+        bid, ask = self._quote(symbol) if symbol else (0.0, 0.0)
+        return {
+            'error': False,
+            'retcode': 10009,
+            'deal': deal,
+            'order': order,
+            'volume': volume,
+            'price': price,
+            'bid': bid,
+            'ask': ask,
+        }
+
+    # -- streams ------------------------------------------------------------
+
+    def _event(self, action, item, result, volume, price, otype=None,
+               deal=0, position=0):
+        """Push a trade transaction on the EVENTS port"""
+        transaction = self.transaction(action, item, result, volume, price,
+                                       otype, deal, position)
+        self._post(self.events_socket, transaction, 'events')
+
+    @staticmethod
+    def transaction(action, item, result, volume, price, otype=None,
+                    deal=0, position=0):
+        """Build the EVENTS message of a trade transaction on `item`"""
+        return {
+            'request': {
+                'action': action,
+                'order': item['id'],
+                'symbol': item['symbol'],
+                'volume': volume,
+                'price': price,
+                'stoplimit': 0.0,
+                'sl': item.get('stoploss', 0.0),
+                'tp': item.get('takeprofit', 0.0),
+                'deviation': 0,
+                'type': otype or item.get('type'),
+                'type_filling': 'ORDER_FILLING_FOK',
+                'type_time': 'ORDER_TIME_GTC',
+                'expiration': 0,
+                'comment': item.get('comment'),
+                'position': position,
+                'position_by': 0,
+            },
+            'result': {
+                'retcode': 10009 if result == 'TRADE_RETCODE_DONE' else 10008,
+                'result': result,
+                'deal': deal,
+                'order': item['id'],
+                'volume': volume,
+                'price': price,
+                'comment': '',
+                'request_id': 0,
+                'retcode_external': 0,
+            },
+        }
+
+    def _post(self, socket, msg, stat, delay=0.0):
+        """Queue `msg` to be pushed in `delay` seconds. Sending is retried
+        for a second in case the client is still connecting"""
+        due = time.time() + delay
+        heapq.heappush(self._outbox, (due, next(self._sequence), due + 1.0,
+                                      socket, msg, stat))
+
+    def _flush(self, now):
+        retry = list()
+        while self._outbox and self._outbox[0][0] <= now:
+            item = heapq.heappop(self._outbox)
+            _, seq, expiry, socket, msg, stat = item
+            try:
+                socket.send_json(msg, zmq.NOBLOCK)
+            except zmq.Again:
+                if now < expiry:
+                    retry.append((now + 0.01,) + item[1:])
+                else:
+                    self.stats['dropped'] += 1
+            else:
+                self.stats[stat] += 1
+
+        for item in retry:
+            heapq.heappush(self._outbox, item)
+
+    def _push(self, socket, msg, stat):
+        # Like the terminal, never block when nobody is listening
+        try:
+            socket.send_json(msg, zmq.NOBLOCK)
+        except zmq.Again:
+            self.stats['dropped'] += 1
+        else:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def live_message(symbol, timeframe, candle):
+        """Build the LIVE message carrying `candle`"""
+        return {
+            'status': 'CONNECTED',
+            'symbol': symbol,
+            'timeframe': timeframe,
+            'data': candle,
+        }
+
+    def disconnect(self, bars):
+        """Miss the next `bars` live candles of every symbol, as a terminal
+        losing its connection. DISCONNECTED is pushed first"""
+        self._disconnect = bars
+
+    def disconnect_ticks(self, seconds):
+        """Miss the live ticks of the next `seconds`, as a terminal losing
+        its connection. DISCONNECTED is pushed first"""
+        self._tick_disconnect = seconds
+
+    def lose_replies(self, count):
+        """Execute the next `count` requests without replying, as replies
+        lost on the way back"""
+        self._lose = count
+
+    def _stream_candles(self):
+        if self._disconnect:
+            self._offline, self._disconnect = self._disconnect, 0
+            for symbol in self.symbols:
+                self._push(self.live_socket, {
+                    'status': 'DISCONNECTED', 'symbol': symbol,
+                    'timeframe': self.timeframe}, 'statuses')
+
+        for symbol in self.symbols:
+            t = self.bar_close(self._livetime[symbol], self.timeframe)
+            self._livetime[symbol] = t
+            candle = self.candle(symbol, t, self.timeframe)
+            self._last[symbol] = candle
+
+            if not self._offline:
+                self._push(self.live_socket,
+                           self.live_message(symbol, self.timeframe, candle),
+                           'candles')
+            self._fill_pending(symbol, candle)
+
+        if self._offline:
+            self._offline -= 1
+
+    def _stream_ticks(self, now):
+        # the tick of the grid point reached, rounded as `now` may fall a
+        # hair short of it. Return its time in milliseconds
+        msc = int(round(now * 1000))
+        msc -= msc % self.tick_step
+        if self._tick_disconnect:
+            self._ticks_offline = now + self._tick_disconnect
+            self._tick_disconnect = 0.0
+            for symbol in self.symbols:
+                self._push(self.live_socket, {
+                    'status': 'DISCONNECTED', 'symbol': symbol,
+                    'timeframe': 'TICK'}, 'statuses')
+        if now < self._ticks_offline:
+            return msc
+
+        for symbol in self.symbols:
+            self._push(self.live_socket,
+                       self.live_message(symbol, 'TICK',
+                                         self.tick(symbol, msc)),
+                       'ticks')
+        return msc
+
+    def _stream_external_event(self):
+        symbol = self._random.choice(self.symbols)
+        bid, ask = self._quote(symbol)
+        is_buy = self._random.random() < 0.5
+        item = {'id': next(self._tickets), 'symbol': symbol}
+        self._event('TRADE_ACTION_DEAL', item, 'TRADE_RETCODE_DONE',
+                    0.01, ask if is_buy else bid,
+                    otype='ORDER_TYPE_BUY' if is_buy else 'ORDER_TYPE_SELL',
+                    deal=next(self._tickets))
+
+    # -- server loop --------------------------------------------------------
+
+    def bind(self):
+        """Create the context and bind the four terminal ports"""
+        self.context = zmq.Context()
+        self.sys_socket = self.context.socket(zmq.ROUTER)
+        self.data_socket = self.context.socket(zmq.PUSH)
+        self.live_socket = self.context.socket(zmq.PUSH)
+        self.events_socket = self.context.socket(zmq.PUSH)
+
+        sockets = ((self.sys_socket, self.SYS_PORT),
+                   (self.data_socket, self.DATA_PORT),
+                   (self.live_socket, self.LIVE_PORT),
+                   (self.events_socket, self.EVENTS_PORT))
+        try:
+            for socket, port in sockets:
+                socket.setsockopt(zmq.LINGER, 0)
+                socket.bind('tcp://{}:{}'.format(self.HOST, port))
+        except zmq.ZMQError:
+            self.close()
+            raise
+
+    def close(self):
+        """Close all sockets and terminate the context"""
+        if self.context is None:
+            return
+        for name in ('sys_socket', 'data_socket', 'live_socket',
+                     'events_socket'):
+            socket = getattr(self, name, None)
+            if socket is not None:
+                socket.close(linger=0)
+        self.context.term()
+        self.context = None
+
+    def start(self):
+        """Bind the ports and serve from a background thread"""
+        self.bind()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and release the ports"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def serve_forever(self):
+        """Bind the ports and serve from the calling thread"""
+        self.bind()
+        try:
+            self._run()
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _receive_requests(self):
+        while True:
+            try:
+                frames = self.sys_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            envelope, payload = frames[:-1], frames[-1]
+            # the terminal acknowledges receipt before doing any work
+            self.sys_socket.send_multipart(envelope + [b'OK'])
+            self.stats['requests'] += 1
+
+            try:
+                request = json.loads(payload.decode('utf-8'))
+                reply = self.handle(request)
+            except ValueError:
+                request, reply = {}, self._error('Wrong request format')
+
+            if self._lose:
+                self._lose -= 1
+                self.stats['lost'] += 1
+                continue
+
+            # correlation id used by pipelined clients
+            if self.echo_ids and request.get('requestId') is not None:
+                reply['requestId'] = request['requestId']
+
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0.0, self.jitter)
+            self._post(self.data_socket, reply, 'replies', delay)
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.sys_socket, zmq.POLLIN)
+
+        now = time.time()
+        live_every = 1.0 / self.rate if self.rate else None
+        events_every = 1.0 / self.events_rate if self.events_rate else None
+        next_live = now + live_every if live_every else float('inf')
+        next_event = now + events_every if events_every else float('inf')
+        # ticks are pushed on their time grid, see tick_step
+        step = self.tick_step
+        next_tick = (int(now * 1000) // step + 1) * step / 1000.0 \
+            if self.tick_rate else float('inf')
+
+        while not self._stop.is_set():
+            due = min(next_live, next_event, next_tick,
+                      self._outbox[0][0] if self._outbox else now + 0.1)
+            timeout = max(0, min(100, int((due - time.time()) * 1000)))
+            if poller.poll(timeout):
+                self._receive_requests()
+
+            now = time.time()
+            self._flush(now)
+
+            while next_live <= now:
+                self._stream_candles()
+                next_live += live_every
+
+            if next_tick <= now:
+                # ticks are real time, missed ones are not made up
+                msc = self._stream_ticks(now)
+                next_tick = (msc + self.tick_step) / 1000.0
+
+            while next_event <= now:
+                self._stream_external_event()
+                next_event += events_every
@@ -2,10 +2,22 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import zmq
+from array import array
 import collections
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import itertools
+import json
+import re
 from datetime import datetime
+from socket import socketpair
 import threading
+import time
+import traceback
+import uuid
 
+from mql5_zmq_backtrader.mt5bars import (BAR_FIELDS, block_len,
+                                         candles_to_block, ticks_to_block)
+from mql5_zmq_backtrader.mt5cache import CandleCache
 from mql5_zmq_backtrader.adapter import PositionAdapter, OrderAdapter, BalanceAdapter
 
 import backtrader as bt
@@ -42,6 +54,47 @@ class StreamError(MTraderError):
         super(self.__class__, self).__init__(*args, **kwargs)
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_loads(buf):
+    return json.loads(str(buf, 'utf-8'))
+
+
+# Available JSON decoders, fastest first. Each one takes a bytes-like object
+# such as the memoryview of a received frame
+JSON_DECODERS = collections.OrderedDict()
+if orjson is not None:
+    JSON_DECODERS['orjson'] = orjson.loads
+if ujson is not None:
+    JSON_DECODERS['ujson'] = lambda buf: ujson.loads(bytes(buf))
+JSON_DECODERS['json'] = _json_loads
+
+
+def get_json_decoder(decoder=None):
+    """Return a function decoding JSON from a bytes-like object.
+
+    `decoder` may be a callable, the name of an entry of `JSON_DECODERS` or
+    None to pick the fastest one installed.
+    """
+    if decoder is None:
+        return next(iter(JSON_DECODERS.values()))
+    if callable(decoder):
+        return decoder
+    try:
+        return JSON_DECODERS[decoder]
+    except KeyError:
+        raise ValueError('JSON decoder not available: {}'.format(decoder))
+
+
 class MTraderAPI:
     """
     This class implements Python side for MQL5 JSON API
@@ -49,7 +102,12 @@ class MTraderAPI:
     """
     # TODO: unify error handling
 
-    def __init__(self, host=None):
+    # Abandoned request ids remembered for their late replies, the oldest
+    # are dropped past this (replies lost by the terminal)
+    ABANDONED_MAX = 1024
+
+    def __init__(self, host=None, pipelined=True, decoder=None,
+                 echo_ids=None):
         self.HOST = host or 'localhost'
         self.SYS_PORT = 15555       # REP/REQ port
         self.DATA_PORT = 15556      # PUSH/PULL port
@@ -61,101 +119,448 @@ class MTraderAPI:
         self.DATA_TIMEOUT = 10000
         self.REQUEST_RETRIES = 3  # Lazy Pirate implementation
         self.sequence = 0  # Lazy Pirate request sequence
+        # Max live messages drained and handed over in a single batch
+        self.LIVE_BATCH = 512
+
+        # A DEALER socket lets many requests be outstanding at once. Each
+        # request carries an id which the reply is matched back with. The
+        # replies of a terminal not echoing it (the MQL5 expert) can only be
+        # matched by their order, a single request is then in flight.
+        # `echo_ids` is None until the first reply tells
+        self.pipelined = pipelined
+        self.echo_ids = echo_ids
+        self._request_ids = itertools.count(1)
+        self._pending = collections.OrderedDict()  # request id -> future
+        self._inflight = 0  # requests sent and not answered yet
+        # requests abandoned in flight whose reply is still to be discarded
+        # when ids are not echoed, given up DATA_TIMEOUT later (lost reply)
+        self._tombstones = collections.deque()
+        # ids of requests given up in flight, already counted out of
+        # `_inflight` so that their late reply is not counted again
+        self._abandoned = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._sys_lock = threading.Lock()
+
+        # Work handed to the I/O thread: requests to send and calls to run
+        self._outbox = collections.deque()
+        self._calls = collections.deque()
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        # frames are decoded without copying them to an intermediate str
+        # when a fast decoder such as orjson is installed
+        self.decode = get_json_decoder(decoder)
+
+        self._on_live = None  # callbacks run in the I/O thread
+        self._on_event = None
+        self.round_trips = collections.deque(maxlen=1024)  # seconds
+        self._closing = False
+
         # initialise ZMQ context
         self.context = zmq.Context()
 
         # connect to server sockets
         try:
-            self.sys_socket = self.context.socket(zmq.REQ)
-            # set port timeout
-            self.sys_socket.RCVTIMEO = self.SYS_TIMEOUT
-            self.sys_socket.connect(
-                'tcp://{}:{}'.format(self.HOST, self.SYS_PORT))
-            # Lazy Pirate implementation
-            self.poll = zmq.Poller()
-            self.poll.register(self.sys_socket, zmq.POLLIN)
+            self.sys_socket = self._sys_connect()
 
             self.data_socket = self.context.socket(zmq.PULL)
-            # set port timeout
-            self.data_socket.RCVTIMEO = self.DATA_TIMEOUT
             self.data_socket.connect(
                 'tcp://{}:{}'.format(self.HOST, self.DATA_PORT))
         except zmq.ZMQError:
             raise zmq.ZMQBindError("E: Binding ports ERROR")
 
-    def _send_request(self, data: dict) -> None:
-        """Send request to server via ZeroMQ System socket
-        Lazy Pirate implementation.
-        """
-        # ram Caller's name
-        print("I: Caller 2 ", sys._getframe(2).f_code.co_name)
+        self.live = self.events = None  # sockets opened on subscription
+        self._live_options = {}
+        self._live_paused = False
 
+        # every socket is owned by a single I/O thread
+        self._io = threading.Thread(target=self._t_io, daemon=True)
+        self._io.start()
+
+    def _sys_connect(self):
+        socket = self.context.socket(zmq.DEALER if self.pipelined else zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect('tcp://{}:{}'.format(self.HOST, self.SYS_PORT))
+        return socket
+
+    def _wakeup(self):
+        if threading.current_thread() is self._io:
+            return  # the loop checks its work before polling again
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # the loop has already been woken up
+
+    def call_soon(self, func, *args):
+        """Run `func(*args)` in the I/O thread"""
+        self._calls.append((func, args))
+        self._wakeup()
+
+    def subscribe(self, live=None, events=None, live_options=None):
+        """Deliver the messages of the Live and/or Events port to the given
+        callbacks. Callbacks run in the I/O thread and must not block.
+
+        The live callback receives a list with every message ready on the
+        socket, up to `LIVE_BATCH`, the events callback one message at a
+        time.
+
+        `live_options` are ZMQ socket options for the Live socket, such as
+        ``{zmq.RCVHWM: 100}``. The socket is reopened when they change.
+        """
+        self.call_soon(self._subscribe, live, events, live_options)
+
+    def _subscribe(self, live, events, live_options=None):
+        if live is not None:
+            self._on_live = live
+            live_options = live_options or {}
+            if self.live is not None and live_options != self._live_options:
+                self._poller.unregister(self.live)
+                self.live.close(linger=0)
+                self.live = None
+
+            if self.live is None:
+                self._live_options = live_options
+                self.live = self.live_socket(self.context, live_options)
+                self._poller.register(self.live, zmq.POLLIN)
+                self._live_paused = False
+
+        if events is not None:
+            self._on_event = events
+            if self.events is None:
+                self.events = self.streaming_socket(self.context)
+                self._poller.register(self.events, zmq.POLLIN)
+
+    def pause_live(self):
+        """Stop reading the Live socket, to be called from the I/O thread"""
+        if self.live is not None and not self._live_paused:
+            self._poller.unregister(self.live)
+            self._live_paused = True
+
+    def resume_live(self):
+        """Read the Live socket again, to be called from the I/O thread"""
+        if self.live is not None and self._live_paused:
+            self._poller.register(self.live, zmq.POLLIN)
+            self._live_paused = False
+
+    def _send_request(self, data: dict) -> Future:
+        """Queue request to be sent to server via ZeroMQ System socket and
+        return the future its reply will be delivered to"""
+        future = Future()
+        with self._sys_lock:
+            # register and queue atomically to keep the send order
+            request_id = next(self._request_ids)
+            data['requestId'] = request_id
+            future.request_id = request_id
+            with self._pending_lock:
+                self._pending[request_id] = future
+            self._outbox.append(
+                (future, json.dumps(data).encode('utf-8')))
+
+        self._wakeup()
+        return future
+
+    def _pull_reply(self, future, timeout=None):
+        """Wait for the reply delivered to `future`, None on timeout"""
+        if threading.current_thread() is self._io:
+            raise MTraderError('E: Blocking request from the I/O thread')
+
+        if timeout is None:
+            timeout = self.DATA_TIMEOUT / 1000.0
         try:
-            # ram sequence = 0
-            retries_left = self.REQUEST_RETRIES
-            while retries_left:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self._forget(future)
+            return None
+
+    def _forget(self, future):
+        """Stop waiting for a reply, a late one will be discarded"""
+        with self._pending_lock:
+            future.cancel()  # not sent once cancelled
+            if future.request_id not in self._pending:
+                return
+            if getattr(future, 'sent_at', None) is None:
+                del self._pending[future.request_id]
+            elif not self.echo_ids:
+                # the reply comes before the next ones, keep its place
+                future.forgotten_at = time.time()
+                self._tombstones.append(future)
+            else:
+                del self._pending[future.request_id]
+                self._inflight = max(0, self._inflight - 1)
+                self._abandon(future.request_id)
+        self._wakeup()  # the next request may be sent
+
+    def _expire_tombstones(self):
+        """Give up the replies of abandoned requests still not received
+        DATA_TIMEOUT later, they are considered lost. Return the seconds
+        until the next one expires, None without any"""
+        tombstones = self._tombstones
+        with self._pending_lock:
+            while tombstones:
+                future = tombstones[0]
+                if self._pending.get(future.request_id) is not future:
+                    tombstones.popleft()  # its reply was discarded
+                    continue
+                left = future.forgotten_at + \
+                    self.DATA_TIMEOUT / 1000.0 - time.time()
+                if left > 0:
+                    return left
+                tombstones.popleft()
+                del self._pending[future.request_id]
+                self._inflight = max(0, self._inflight - 1)
+                # without ids a reply still arriving after this cannot be
+                # told apart from the reply to the next request
+                if self.echo_ids:
+                    self._abandon(future.request_id)
+        return None
+
+    def _abandon(self, request_id):
+        """Remember a request counted out of `_inflight` before its reply
+        came, called with `_pending_lock` held"""
+        abandoned = self._abandoned
+        abandoned[request_id] = None
+        while len(abandoned) > self.ABANDONED_MAX:
+            abandoned.popitem(last=False)
+
+    def _t_io(self):
+        """Single I/O loop polling the System, Data, Live and Events sockets.
+
+        Requests queued by other threads are sent from here, replies are
+        handed to the futures of their requests and stream messages to the
+        subscribed callbacks.
+        """
+        self._poller = poller = zmq.Poller()
+        poller.register(self._wake_r, zmq.POLLIN)
+        poller.register(self.sys_socket, zmq.POLLIN)
+        poller.register(self.data_socket, zmq.POLLIN)
+
+        self._awaiting = None  # Lazy Pirate: (payload, deadline, retries)
+
+        while not self._closing:
+            timeout = None
+            if self._awaiting is not None:
+                timeout = max(0, self._awaiting[1] - time.time()) * 1000
+            if self._tombstones and self._outbox:
+                left = self._expire_tombstones()
+                if left is not None:
+                    timeout = left * 1000 if timeout is None else \
+                        min(timeout, left * 1000)
+
+            socks = dict(poller.poll(timeout))
+            if self._wake_r in socks:
+                try:
+                    self._wake_r.recv(4096)
+                except (BlockingIOError, OSError):
+                    pass
+
+            try:
+                if self.sys_socket in socks:
+                    self._recv_receipts()
+                if self.data_socket in socks:
+                    self._recv_replies()
+                if self.live is not None and self.live in socks:
+                    self._recv_batch(self.live, self._on_live)
+                if self.events is not None and self.events in socks:
+                    self._recv_stream(self.events, self._on_event)
+
+                while self._calls:
+                    func, args = self._calls.popleft()
+                    func(*args)
+
+                self._send_requests()
+            except zmq.ZMQError as e:
+                if self._closing:
+                    break
+                print("W: Strange ZMQ behaviour during node-to-node message "
+                      "receiving, experienced {}".format(e))
+            except Exception:
+                # a failing callback must not stop the I/O thread
+                traceback.print_exc()
+
+        for socket in (self.sys_socket, self.data_socket, self.live,
+                       self.events):
+            if socket is not None:
+                socket.close(linger=0)
+
+    def _send_requests(self):
+        if self._tombstones:
+            self._expire_tombstones()
+        while self._outbox:
+            if not self.pipelined:
+                if self._awaiting is not None:
+                    self._lazy_pirate_check()
+                    if self._awaiting is not None:
+                        return  # REQ lock-step, wait for the receipt
+            if self._inflight and not self.echo_ids:
+                return  # replies matched by order, wait for the answer
+
+            future, payload = self._outbox.popleft()
+            with self._pending_lock:
+                if future.cancelled():
+                    continue  # abandoned before being sent
+                future.sent_at = time.time()
+                self._inflight += 1
+
+            if self.pipelined:
+                # the empty delimiter frame makes the DEALER talk to a REP
+                self.sys_socket.send_multipart([b'', payload])
+            else:
                 self.sequence += 1
-                request = str(self.sequence).encode()
                 print("I: Sending (%s)" % self.sequence)
-                print("data ", data)
-                self.sys_socket.send_json(data)
-
-                expect_reply = True
-                while expect_reply:
-                    socks = dict(self.poll.poll(self.SYS_TIMEOUT))
-                    if socks.get(self.sys_socket) == zmq.POLLIN:
-                        msg = self.sys_socket.recv_string()
-                        if not msg:
-                            break
-                        # terminal received the request
-                        if str(msg) == 'OK':
-                            print("I: Server replied %s" % msg)
-                            retries_left = 0
-                            expect_reply = False
-                        else:
-                            print("E: Malformed reply from server: %s" % msg)
-
-                    else:
-                        print("W: No response from server, retrying…")
-                        # Socket is confused. Close and remove it.
-                        self.sys_socket.setsockopt(zmq.LINGER, 0)
-                        self.sys_socket.close()
-                        self.poll.unregister(self.sys_socket)
-                        retries_left -= 1
-                        if retries_left == 0:
-                            print("E: Server seems to be offline, abandoning")
-                            break
-                        print("I: Reconnecting and resending (%s)" %
-                              self.sequence)
-                        # Create new connection
-                        self.sys_socket = self.context.socket(zmq.REQ)
-                        self.sys_socket.RCVTIMEO = self.SYS_TIMEOUT
-                        self.sys_socket.connect(
-                            'tcp://{}:{}'.format(self.HOST, self.SYS_PORT))
-                        self.poll.register(self.sys_socket, zmq.POLLIN)
-                        self.sys_socket.send_json(data)
-
-            # ram self.context.term()
-        except zmq.ZMQError:
-            raise zmq.NotDone("E: Sending request ERROR")
+                self.sys_socket.send(payload)
+                self._awaiting = (payload,
+                                  time.time() + self.SYS_TIMEOUT / 1000.0,
+                                  self.REQUEST_RETRIES)
+
+        if self._awaiting is not None:
+            self._lazy_pirate_check()
+
+    def _lazy_pirate_check(self):
+        """Lazy Pirate implementation: reconnect and resend when the terminal
+        does not acknowledge the request in time"""
+        payload, deadline, retries_left = self._awaiting
+        if time.time() < deadline:
+            return
+
+        print("W: No response from server, retrying…")
+        # Socket is confused. Close and remove it.
+        self._poller.unregister(self.sys_socket)
+        self.sys_socket.close(linger=0)
+        self.sys_socket = self._sys_connect()
+        self._poller.register(self.sys_socket, zmq.POLLIN)
+
+        retries_left -= 1
+        if retries_left == 0:
+            print("E: Server seems to be offline, abandoning")
+            self._awaiting = None
+            return
+
+        print("I: Reconnecting and resending (%s)" % self.sequence)
+        self.sys_socket.send(payload)
+        self._awaiting = (payload, time.time() + self.SYS_TIMEOUT / 1000.0,
+                          retries_left)
 
-    def _pull_reply(self):
-        # Get reply from server via Data socket with timeout
+    def _recv_receipts(self):
+        # terminal received the request
+        while True:
+            try:
+                frames = self.sys_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            if frames[-1] != b'OK':
+                print("E: Malformed reply from server: %s" % frames[-1])
+            elif not self.pipelined:
+                self._awaiting = None
+                return  # a REQ socket holds one receipt at a time
+
+    def _recv_replies(self):
+        """Hand every reply on the Data socket to the future of its request.
+
+        A terminal which does not echo the request id answers in order, so
+        such replies go to the oldest request still waiting.
+        """
+        while True:
+            try:
+                msg = self._recv_json(self.data_socket)
+            except zmq.Again:
+                return
+            if msg is None:
+                continue
+            if not isinstance(msg, dict):
+                print("W: Malformed reply from server: %r" % (msg,))
+                self._fail_oldest(MTraderError(
+                    'E: Malformed reply from server'))
+                continue
+
+            request_id = msg.pop('requestId', None)
+            if request_id is None:
+                self.echo_ids = False
+            elif self.echo_ids is None:
+                self.echo_ids = True
+
+            with self._pending_lock:
+                if request_id in self._abandoned:
+                    # late reply to a request already counted out
+                    del self._abandoned[request_id]
+                    continue
+                self._inflight = max(0, self._inflight - 1)
+                if request_id is None and self._pending:
+                    request_id = next(iter(self._pending))
+                future = self._pending.pop(request_id, None)
+
+            # else a late reply to an abandoned request
+            if future is not None and future.set_running_or_notify_cancel():
+                sent_at = getattr(future, 'sent_at', None)
+                if sent_at is not None:
+                    self.round_trips.append(time.time() - sent_at)
+                future.set_result(msg)
+
+    def _recv_stream(self, socket, callback):
+        while True:
+            try:
+                msg = self._recv_json(socket)
+            except zmq.Again:
+                return
+            if msg is not None and callback is not None:
+                callback(msg)
+
+    def _recv_batch(self, socket, callback):
+        # drain what is ready to hand it over with a single append
+        batch = list()
+        for _ in range(self.LIVE_BATCH):
+            try:
+                msg = self._recv_json(socket)
+            except zmq.Again:
+                break
+            if msg is not None:
+                batch.append(msg)
+
+        if batch and callback is not None:
+            callback(batch)
+
+    def _fail_oldest(self, exc):
+        """Fail the oldest request sent, its reply could not be read"""
+        with self._pending_lock:
+            self._inflight = max(0, self._inflight - 1)
+            future = None
+            if self._pending:
+                request_id = next(iter(self._pending))
+                if getattr(self._pending[request_id], 'sent_at',
+                           None) is not None:
+                    future = self._pending.pop(request_id)
+
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_exception(exc)
+
+    def _recv_json(self, socket):
+        """Receive a frame without blocking and decode it in place"""
+        frame = socket.recv(zmq.NOBLOCK, copy=False)
         try:
-            msg = self.data_socket.recv_json()
-        #ram except zmq.ZMQError:
-        #ram    raise zmq.NotDone('Data socket timeout ERROR')
-        except zmq.Again as e:
+            return self.decode(frame.buffer)
+        except ValueError:
+            print("E: Malformed JSON message: %s" % frame.bytes[:200])
             return None
-        except zmq.ZMQError as e:
-                logger.debug("W: Strange ZMQ behaviour during node-to-node message receiving, experienced {}".format(e))
-        return msg
 
-    def live_socket(self, context=None):
-        """Connect to socket in a ZMQ context"""
+    def close(self):
+        """Stop the I/O thread, close the sockets and terminate the ZMQ
+        context"""
+        self._closing = True
+        self._wakeup()
+        self._io.join()
+        self._wake_r.close()
+        self._wake_w.close()
+        self.context.term()
+
+    def live_socket(self, context=None, options=None):
+        """Connect to socket in a ZMQ context, `options` are set before
+        connecting"""
         try:
             context = context or zmq.Context.instance()
             socket = context.socket(zmq.PULL)
+            for option, value in (options or {}).items():
+                socket.setsockopt(option, value)
             socket.connect('tcp://{}:{}'.format(self.HOST, self.LIVE_PORT))
         except zmq.ZMQError:
             raise zmq.ZMQBindError("E: Live port connection ERROR")
@@ -171,8 +576,24 @@ class MTraderAPI:
             raise zmq.ZMQBindError("E: Data port connection ERROR")
         return socket
 
-    def construct_and_send(self, **kwargs) -> dict:
-        """Construct a request dictionary from default and send it to server"""
+    def construct_and_send(self, timeout=None, **kwargs) -> dict:
+        """Construct a request dictionary from default, send it to server
+        and wait up to `timeout` seconds (default `DATA_TIMEOUT`) for the
+        reply"""
+        # send dict to server
+        future = self.submit(**kwargs)
+
+        # return server reply
+        return self._pull_reply(future, timeout)
+
+    def submit(self, **kwargs) -> Future:
+        """Construct a request dictionary from default and send it to server
+        without waiting. The reply is delivered to the returned future"""
+        return self._send_request(self.build_request(**kwargs))
+
+    @staticmethod
+    def build_request(**kwargs) -> dict:
+        """Construct a request dictionary from default"""
 
         # default dictionary
         request = {
@@ -200,11 +621,431 @@ class MTraderAPI:
             else:
                 raise KeyError('E: Unknown key in **kwargs ERROR')
 
-        # send dict to server
-        self._send_request(request)
+        return request
 
-        # return server reply
-        return self._pull_reply()
+
+class LiveQueue(object):
+    """Live messages of a data feed.
+
+    Batches are appended by the I/O thread and messages taken one at a time
+    by the feed. Unbounded, a deque append/popleft pair needs no lock.
+
+    With `maxsize` the queue is bounded and `overflow` tells what to do
+    when the feed falls behind:
+
+      - ``block``: stop reading the live socket until the feed has consumed
+        half of the queue. Messages then wait in the socket, its HWM decides
+        what happens next. The last batch may overshoot `maxsize`
+      - ``dropoldest``: discard the oldest messages, counted in `dropped`
+      - ``latest``: keep only the last message per symbol and timeframe,
+        replaced ones are counted in `merged`. `maxsize` is not used.
+        Messages without a bar (connection status) are all kept in place
+
+    With `conflate` the Live socket may keep only its last message too,
+    see `MTraderStore._live_options`.
+    """
+    OVERFLOWS = ('block', 'dropoldest', 'latest')
+
+    def __init__(self, maxsize=0, overflow='block', conflate=False):
+        if overflow not in self.OVERFLOWS:
+            raise ValueError('Unknown live queue overflow {!r}, use one of {}'
+                             .format(overflow, ', '.join(self.OVERFLOWS)))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.conflate = conflate
+        self.bounded = bool(maxsize) or overflow == 'latest'
+        self.dropped = 0
+        self.merged = 0
+        self.paused = False
+        # called when a blocking queue gets full and has room again
+        self.on_full = self.on_space = None
+
+        if overflow == 'latest':
+            self._msgs = collections.OrderedDict()
+            self._statuses = itertools.count()  # keys of status messages
+        else:
+            self._msgs = collections.deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def put_batch(self, batch):
+        full = False
+        if not self.bounded:
+            self._msgs.extend(batch)
+        elif self.overflow == 'latest':
+            with self._lock:
+                for msg in batch:
+                    if not msg.get('data'):
+                        # a status is not replaced by the next bar
+                        self._msgs[next(self._statuses)] = msg
+                        continue
+                    key = (msg.get('symbol'), msg.get('timeframe'))
+                    if self._msgs.pop(key, None) is not None:
+                        self.merged += 1
+                    self._msgs[key] = msg
+        else:
+            with self._lock:
+                self._msgs.extend(batch)
+                excess = len(self._msgs) - self.maxsize
+                if excess > 0 and self.overflow == 'dropoldest':
+                    for _ in range(excess):
+                        self._msgs.popleft()
+                    self.dropped += excess
+                elif excess >= 0 and not self.paused:
+                    self.paused = full = True
+
+        self._ready.set()
+        if full and self.on_full is not None:
+            self.on_full(self)
+
+    def _pop(self):
+        if not self.bounded:
+            return self._msgs.popleft()
+
+        space = False
+        with self._lock:
+            if self.overflow == 'latest':
+                try:
+                    return self._msgs.popitem(last=False)[1]
+                except KeyError:
+                    raise IndexError('pop from an empty live queue')
+
+            msg = self._msgs.popleft()
+            if self.paused and len(self._msgs) <= self.maxsize // 2:
+                self.paused = False
+                space = True
+
+        if space and self.on_space is not None:
+            self.on_space(self)
+        return msg
+
+    def get(self, timeout=None):
+        """Return the oldest message waiting up to `timeout` seconds for
+        one, None if nothing arrived"""
+        try:
+            return self._pop()
+        except IndexError:
+            pass
+
+        self._ready.clear()
+        if self._msgs or self._ready.wait(timeout):
+            try:
+                return self._pop()
+            except IndexError:
+                pass
+        return None
+
+
+class TickRing(object):
+    """
+    Live ticks of a feed in a preallocated ring buffer.
+
+    The I/O thread writes the time (epoch seconds), bid, ask, last and
+    volume of every tick into fixed columns, nothing is allocated per tick.
+    `get` hands out the slot of the next tick to read. A reader falling
+    `capacity` ticks behind loses the oldest ones, counted in `dropped`.
+
+    Connection status messages are kept apart, with the number of ticks
+    written before them, and handed out as they are once those ticks are
+    read. The first tick after a DISCONNECTED also yields its CONNECTED
+    status, without the tick, which goes into the ring.
+    """
+    bounded = False  # the Live socket is not bounded for ticks
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        zeros = bytes(8 * capacity)
+        self.time = array('d', zeros)
+        self.bid = array('d', zeros)
+        self.ask = array('d', zeros)
+        self.last = array('d', zeros)
+        self.volume = array('d', zeros)
+        self.head = 0  # ticks written, only moved by the I/O thread
+        self.tail = 0  # ticks read, only moved by the reader
+        self.dropped = 0
+        self.statuses = collections.deque()  # (ticks before, message)
+        self._status = 'CONNECTED'  # last status written
+        self._ready = threading.Event()
+
+    def __len__(self):
+        return self.head - self.tail + len(self.statuses)
+
+    def put_batch(self, batch):
+        head, capacity = self.head, self.capacity
+        statuses = []
+        for msg in batch:
+            tick = msg.get('data')
+            status = msg.get('status', self._status)
+            if not tick or status != self._status:
+                self._status = status
+                statuses.append((head, dict(
+                    (k, v) for k, v in msg.items() if k != 'data')))
+                if not tick:
+                    continue
+
+            i = head % capacity
+            n = len(tick)
+            self.time[i] = tick[0] / 1000.0
+            self.bid[i] = tick[1]
+            self.ask[i] = tick[2]
+            self.last[i] = tick[3] if n > 3 else 0.0
+            self.volume[i] = tick[4] if n > 4 else 0.0
+            head += 1
+
+        self.head = head
+        # after the head, the reader never sees a status ahead of its ticks
+        self.statuses.extend(statuses)
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """Return the next status message or the slot of the next tick,
+        waiting up to `timeout` seconds. None if nothing arrived"""
+        if not len(self):
+            self._ready.clear()
+            if not len(self) and not self._ready.wait(timeout):
+                return None
+
+        behind = self.head - self.tail - self.capacity
+        if behind > 0:
+            self.dropped += behind
+            self.tail += behind
+
+        if self.statuses and self.statuses[0][0] <= self.tail:
+            return self.statuses.popleft()[1]
+        if self.head == self.tail:
+            return None
+
+        slot = self.tail % self.capacity
+        self.tail += 1
+        return slot
+
+
+class HistoryQueue(queue.Queue):
+    """
+    History blocks downloaded ahead of a data feed.
+
+    With `maxsize` the download thread waits for the feed to take a block
+    before putting the next one: at most `maxsize` windows wait decoded on
+    top of the one being loaded and the requests in flight. `waited` adds
+    up the seconds spent waiting, during which the feed and not the terminal
+    was holding the download back.
+
+    `close` discards the blocks and turns later puts into no-ops, for feeds
+    stopped before the end of their history.
+    """
+
+    def __init__(self, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.closed = False
+        self.waited = 0.0
+
+    def _wait_room(self):
+        # not_full is held
+        if self.closed or not 0 < self.maxsize <= self._qsize():
+            return
+        start = time.time()
+        while not self.closed and 0 < self.maxsize <= self._qsize():
+            self.not_full.wait()
+        self.waited += time.time() - start
+
+    def put(self, item, unlock=None):
+        """Put `item` once there is room for it. `unlock`, a lock held by
+        the caller, is released while waiting"""
+        if unlock is not None and self.full():
+            unlock.release()
+            try:
+                with self.not_full:
+                    self._wait_room()
+            finally:
+                unlock.acquire()
+
+        with self.not_full:
+            self._wait_room()
+            if self.closed:
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.queue.clear()
+            self.not_full.notify_all()
+
+
+class OrderWorkers(object):
+    """
+    Order requests sent by a pool of `workers` threads.
+
+    Requests of the same symbol are sent one after the other in submission
+    order, those of different symbols concurrently. `send(item)` is called
+    for every request. The queue wait and send latency of the last ones
+    are kept in `stats`, dicts with the symbol, `wait` and `latency` in
+    seconds.
+    """
+
+    def __init__(self, send, workers=4, name='order'):
+        self.send = send
+        self.stats = collections.deque(maxlen=1000)
+        self._pending = dict()  # symbol -> deque of (queued at, item)
+        self._ready = collections.deque()  # symbols no worker is sending
+        self._cond = threading.Condition()
+        self._stopping = False
+
+        self._threads = list()
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._t_worker, daemon=True,
+                                 name='{}-{}'.format(name, i))
+            t.start()
+            self._threads.append(t)
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(items) for items in self._pending.values())
+
+    def put(self, symbol, item):
+        with self._cond:
+            items = self._pending.get(symbol)
+            if items is None:
+                # no request of the symbol queued nor being sent
+                items = self._pending[symbol] = collections.deque()
+                self._ready.append(symbol)
+                self._cond.notify()
+            items.append((time.time(), item))
+
+    def stop(self):
+        """Let the workers exit once the queued requests are sent"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def _t_worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopping:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                symbol = self._ready.popleft()
+                queued, item = self._pending[symbol].popleft()
+
+            start = time.time()
+            try:
+                self.send(item)
+            except Exception:
+                traceback.print_exc()
+            end = time.time()
+            self.stats.append(dict(symbol=symbol, wait=start - queued,
+                                   latency=end - start))
+
+            with self._cond:
+                if self._pending[symbol]:
+                    self._ready.append(symbol)  # next one of the symbol
+                    self._cond.notify()
+                else:
+                    del self._pending[symbol]
+
+
+class OrderRecord(object):
+    """An order sent to the terminal: backtrader ref, MT5 ticket, symbol,
+    MT5 order type and state"""
+    __slots__ = ('oref', 'oid', 'symbol', 'otype', 'state')
+
+    def __init__(self, oref, oid, symbol, otype, state='accepted'):
+        self.oref = oref
+        self.oid = oid
+        self.symbol = symbol
+        self.otype = otype
+        self.state = state
+
+    def __repr__(self):
+        return 'OrderRecord({!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.oref, self.oid, self.symbol, self.otype, self.state)
+
+
+class OrderRegistry(object):
+    """
+    Orders sent to the terminal, indexed by backtrader ref and MT5 ticket.
+
+    Orders finished (completed, cancelled, closed) are forgotten
+    `retention` seconds later, the oldest first, counted in `evicted`.
+    Filled market orders are 'open' until their position is closed.
+    Every operation takes constant time whatever the number of orders
+    seen. Changes are made under a lock, orders are added, filled and
+    cancelled from different threads.
+    """
+
+    FINAL = ('completed', 'cancelled', 'closed')
+
+    def __init__(self, retention=86400.0):
+        self.retention = retention
+        self.evicted = 0
+        self._byref = dict()
+        self._byticket = dict()
+        self._finished = collections.deque()  # (time, oref) by time
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._byref)
+
+    def __contains__(self, oref):
+        return oref in self._byref
+
+    def add(self, oref, oid, symbol, otype):
+        record = OrderRecord(oref, oid, symbol, otype)
+        with self._lock:
+            self._byref[oref] = record
+            self._byticket[oid] = record
+            self._evict(time.time())
+        return record
+
+    def get(self, oref):
+        """Record of backtrader order `oref`, None if unknown"""
+        return self._byref.get(oref)
+
+    def by_ticket(self, oid):
+        """Record of MT5 ticket `oid`, None if unknown"""
+        return self._byticket.get(oid)
+
+    def update(self, oref, state):
+        """Set the `state` of order `oref`, which is still working"""
+        with self._lock:
+            record = self._byref.get(oref)
+            if record is not None and record.state not in self.FINAL:
+                record.state = state
+
+    def finish(self, oref, state):
+        """Set the final `state` of order `oref`, it is evicted once the
+        retention is over"""
+        with self._lock:
+            record = self._byref.get(oref)
+            if record is None or record.state in self.FINAL:
+                return
+            record.state = state
+            now = time.time()
+            self._finished.append((now, oref))
+            self._evict(now)
+
+    def evict(self, now=None):
+        """Forget the orders finished more than `retention` seconds ago"""
+        with self._lock:
+            self._evict(time.time() if now is None else now)
+
+    def _evict(self, now):
+        limit = now - self.retention
+        finished = self._finished
+        while finished and finished[0][0] <= limit:
+            _, oref = finished.popleft()
+            record = self._byref.pop(oref, None)
+            if record is None:
+                continue
+            if self._byticket.get(record.oid) is record:
+                del self._byticket[record.oid]
+            self.evicted += 1
 
 
 class MetaSingleton(MetaParams):
@@ -225,8 +1066,17 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
     """
     Singleton class wrapping to control the connections to MetaTrader.
 
-    Balance update occurs at the beginning and after each
-    transaction registered by '_t_streaming_events'.
+    Balance update occurs at the beginning, then in a background thread
+    every `BALANCE_TTL` seconds and shortly after the trade transactions
+    registered by '_transaction'.
+
+    All sockets are served by the single I/O thread of `MTraderAPI`. Live
+    candles are handed to the data feeds through a deque and trade events
+    are processed as they arrive.
+
+    Downloaded history is kept in `cachedir` when given, see `CandleCache`.
+    Shared history (feeds deriving their bars from M1 candles) is otherwise
+    kept in memory.
     """
 
     # TODO: implement stop_limit
@@ -234,15 +1084,53 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
 
     BrokerCls = None  # broker class will autoregister
     DataCls = None  # data class will auto register
+    TickDataCls = None  # tick data class will auto register
 
     params = ()
 
+    # Order ids kept waiting for their order creation reply
+    _UNMATCHED_SIZE = 1024
+
+    # Attempts after a TRADE request failed in transit, the delay between
+    # them starts at ORDER_BACKOFF seconds and doubles
+    ORDER_RETRIES = 3
+    ORDER_BACKOFF = 0.5
+
+    # Seconds between balance refreshes. A trade event refreshes it
+    # BALANCE_DEBOUNCE seconds later, once for a burst of events
+    BALANCE_TTL = 5.0
+    BALANCE_DEBOUNCE = 0.25
+
+    # Long HISTORY downloads are split in windows of this many bars, up to
+    # HISTORY_INFLIGHT windows are requested at once
+    HISTORY_CHUNK = 10000
+    HISTORY_INFLIGHT = 4
+    # Decoded windows read ahead of a feed, on top of the one it loads
+    HISTORY_PREFETCH = 2
+    # Times the range of last_candles is doubled looking for enough bars
+    HISTORY_EXTEND = 6
+    # Seconds of tick history per HISTORY request
+    TICK_WINDOW = 900
+
     # The Unix epoch (or Unix time or POSIX time or Unix timestamp)
     _DTEPOCH = datetime(1970, 1, 1)
 
+    # Seconds per unit of compression, months are rounded up
+    _TIMEFRAME_SECONDS = {
+        bt.TimeFrame.Minutes: 60,
+        bt.TimeFrame.Days: 86400,
+        bt.TimeFrame.Weeks: 7 * 86400,
+        bt.TimeFrame.Months: 31 * 86400,
+    }
+
     # MTrader supported granularities
     _GRANULARITIES = {
-        # (bt.TimeFrame.Ticks, 1): 'Ticks',
+        (bt.TimeFrame.Ticks, 1): 'TICK',
+        # built from the ticks by the tick data feed
+        (bt.TimeFrame.Seconds, 1): 'TICK',
+        (bt.TimeFrame.Seconds, 5): 'TICK',
+        (bt.TimeFrame.Seconds, 15): 'TICK',
+        (bt.TimeFrame.Seconds, 30): 'TICK',
         (bt.TimeFrame.Minutes, 1): 'M1',
         (bt.TimeFrame.Minutes, 2): 'M2',
         (bt.TimeFrame.Minutes, 3): 'M3',
@@ -266,6 +1154,10 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         (bt.TimeFrame.Months, 1): 'MN1',
     }
 
+    # MT5 types of the market orders, a filled one stands for its position
+    # until it is closed by cancelling the order
+    _MARKET_TYPES = ('ORDER_TYPE_BUY', 'ORDER_TYPE_SELL')
+
     # Order type matching with MetaTrader 5
     _ORDEREXECS = {
         # Market Buy order
@@ -290,7 +1182,11 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
 
     @classmethod
     def getdata(cls, *args, **kwargs):
-        """Returns `DataCls` with args, kwargs"""
+        """Returns `DataCls` with args, kwargs, `TickDataCls` for
+        `TimeFrame.Ticks` and `TimeFrame.Seconds`"""
+        if kwargs.get('timeframe') in (bt.TimeFrame.Ticks,
+                                       bt.TimeFrame.Seconds):
+            return cls.TickDataCls(*args, **kwargs)
         return cls.DataCls(*args, **kwargs)
 
     @classmethod
@@ -298,7 +1194,8 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         """Returns broker with *args, **kwargs from registered `BrokerCls`"""
         return cls.BrokerCls(*args, **kwargs)
 
-    def __init__(self, host='localhost'):
+    def __init__(self, host='localhost', pipelined=True, decoder=None,
+                 cachedir=None, order_workers=4, order_retention=86400.0):
         super(MTraderStore, self).__init__()
 
         self.notifs = collections.deque()  # store notifications for cerebro
@@ -307,16 +1204,34 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         self.broker = None  # broker instance
         self.datas = list()  # datas that have registered over start
 
-        self._orders = collections.OrderedDict()  # map order.ref to oid
-        self._ordersrev = collections.OrderedDict()  # map oid to order.ref
-        self._orders_type = dict()  # keeps order types
+        # orders sent by ref and ticket, finished ones kept for a while
+        self._orders = OrderRegistry(order_retention)
+        # transactions received before the order id was returned
+        self._unmatched = collections.OrderedDict()
+        self._orders_lock = threading.Lock()
+        # threads sending orders, in order per symbol
+        self.order_workers = order_workers
 
-        self.oapi = MTraderAPI(host)
+        self.oapi = MTraderAPI(host, pipelined=pipelined, decoder=decoder)
+        # prefix of the client order ids, unique per session
+        self._session = uuid.uuid4().hex[:8]
+
+        # history already downloaded is read from disk when set
+        self.cache = CandleCache(cachedir) if cachedir else None
+        # candles shared by several feeds, downloaded once
+        self.shared = self.cache or CandleCache()
 
         self._cash = 0.0
         self._value = 0.0
+        self.balance_updates = 0  # successful balance refreshes
+        self._balance_lock = threading.Lock()
+        self._balance_due = threading.Event()  # set by trade events
+        self._balance_stop = False
 
-        self.q_livedata = queue.Queue()
+        # live queues of the data feeds by (symbol, granularity)
+        self._live_routes = dict()
+        self.live_unrouted = 0  # live messages no feed subscribed to
+        self._live_full = set()  # blocking queues waiting for the feed
 
         self._cancel_flag = False
 
@@ -332,10 +1247,15 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
             self._env = data._env
             # For datas simulate a queue with None to kickstart co
             self.datas.append(data)
+            qlive = self.register_live(data)
+            self.oapi.subscribe(live=self._on_livedata,
+                                live_options=self._live_options())
 
             if self.broker is not None:
                 self.broker.data_started(data)
 
+            return qlive
+
         elif broker is not None:
             self.broker = broker
             self.broker_threads()
@@ -344,8 +1264,10 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
     def stop(self):
         # signal end of thread
         if self.broker is not None:
-            self.q_ordercreate.put(None)
+            self.q_ordercreate.stop()
             self.q_orderclose.put(None)
+            self._balance_stop = True
+            self._balance_due.set()
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -369,7 +1291,8 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         granularity = self._GRANULARITIES.get((timeframe, compression), None)
         if granularity is None:
             raise ValueError("W: Metatrader 5 doesn't support frame %s with compression %s" %
-                             (bt.TimeFrame.getname(timeframe), compression))
+                             (bt.TimeFrame.getname(timeframe, compression),
+                              compression))
         return granularity
 
     def get_cash(self):
@@ -378,63 +1301,138 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
     def get_value(self):
         return self._value
 
+    def get_value_update(self):
+        """Return the equity and the count of balance refreshes it comes
+        from, read together"""
+        with self._balance_lock:
+            return self._value, self.balance_updates
+
     def get_balance(self):
+        """Read the account balance and equity, blocking. Return whether
+        they were updated"""
         try:
             bal = self.oapi.construct_and_send(action="BALANCE")
+            # no reply (None) or no balance in it
+            cash, value = float(bal["balance"]), float(bal["equity"])
         except Exception as e:
             self.put_notification(e)
-        # TODO: error handling
-        # if bal['error']:
-        #     self.put_notification(bal)
-        #     continue
-        try:
-            self._cash = float(bal["balance"])
-            self._value = float(bal["equity"])
-        except KeyError as e:
-            #ram
-            self.put_notification(e)
-            pass
+            return False
+
+        with self._balance_lock:
+            self._cash, self._value = cash, value
+            self.balance_updates += 1
+        return True
+
+    def _t_balance(self):
+        # Refresh the balance every BALANCE_TTL seconds and after trade
+        # events, neither the I/O thread nor next() wait for the reply
+        due = self._balance_due
+        while not self._balance_stop:
+            if due.wait(self.BALANCE_TTL):
+                time.sleep(self.BALANCE_DEBOUNCE)  # merge a burst of events
+                due.clear()
+            if self._balance_stop or self.oapi._closing:
+                break
+            self.get_balance()
 
     def streaming_events(self):
-        t = threading.Thread(target=self._t_livedata, daemon=True)
-        t.start()
-
-        t = threading.Thread(target=self._t_streaming_events, daemon=True)
-        t.start()
-
-    def _t_livedata(self):
-        # create socket connection for the Thread
-        socket = self.oapi.live_socket()
-        while True:
-            try:
-                last_candle = socket.recv_json()
-            except zmq.ZMQError:
-                raise zmq.NotDone("Live data ERROR")
-
-            self.q_livedata.put(last_candle)
+        self.oapi.subscribe(live=self._on_livedata, events=self._transaction)
 
-    def _t_streaming_events(self):
-        # create socket connection for the Thread
-        socket = self.oapi.streaming_socket()
-        while True:
-            try:
-                transaction = socket.recv_json()
-            except zmq.ZMQError:
-                raise zmq.NotDone("E: Streaming data ERROR")
+    def register_live(self, data):
+        """Return the queue receiving the live messages of `data`"""
+        granularity = self._GRANULARITIES.get(data._terminal_frame())
+        if granularity == 'TICK':
+            q = TickRing(data.p.ring_size)
+        else:
+            q = LiveQueue(data.p.live_qsize, data.p.live_overflow,
+                          data.p.live_conflate)
+        if getattr(q, 'overflow', None) == 'block' and q.maxsize:
+            q.on_full = self._on_livefull
+            q.on_space = self._on_livespace
+            # resumed at half size, smaller batches keep it within 1.5x
+            self.oapi.LIVE_BATCH = min(self.oapi.LIVE_BATCH,
+                                       max(1, (q.maxsize + 1) // 2))
+        key = (data.p.dataname, granularity)
+        # copy on write, the routes are read from the I/O thread
+        routes = dict(self._live_routes)
+        routes[key] = routes.get(key, []) + [q]
+        self._live_routes = routes
+        return q
 
-            self._transaction(transaction)
+    def _live_options(self):
+        """Receive side ZMQ options of the Live socket matching the queues:
+        bounded queues bound the socket too and a single feed keeping only
+        the latest bar, asking to conflate, needs no more than the last
+        message. Conflating may lose connection status messages"""
+        queues = [q for qs in self._live_routes.values() for q in qs]
+        options = dict()
+        if queues and all(q.bounded for q in queues):
+            options[zmq.RCVHWM] = sum(q.maxsize or 1 for q in queues)
+        if len(queues) == 1 and \
+                getattr(queues[0], 'overflow', None) == 'latest' and \
+                queues[0].conflate:
+            options[zmq.CONFLATE] = 1
+        return options
+
+    def _on_livefull(self, q):
+        # I/O thread: stop reading while any blocking queue is full
+        self._live_full.add(q)
+        self.oapi.pause_live()
+
+    def _on_livespace(self, q):
+        # feed thread: resume from the I/O thread
+        self.oapi.call_soon(self._resume_live, q)
+
+    def _resume_live(self, q):
+        self._live_full.discard(q)
+        if not self._live_full:
+            self.oapi.resume_live()
+
+    def _on_livedata(self, batch):
+        # Invoked from the I/O thread. Split the batch per feed, messages
+        # without symbol (connection status) go to every feed
+        routes = self._live_routes
+        split = dict()
+        for msg in batch:
+            key = (msg.get('symbol'), msg.get('timeframe'))
+            queues = routes.get(key)
+            if queues is None:
+                if key[0] is not None:
+                    self.live_unrouted += 1
+                    continue
+                queues = [q for qs in routes.values() for q in qs]
+
+            for q in queues:
+                try:
+                    split[q].append(msg)
+                except KeyError:
+                    split[q] = [msg]
+
+        for q, msgs in split.items():
+            q.put_batch(msgs)
 
     def broker_threads(self):
-        self.q_ordercreate = queue.Queue()
-        t = threading.Thread(target=self._t_order_create, daemon=True)
-        t.start()
+        self.q_ordercreate = OrderWorkers(self._order_send,
+                                          self.order_workers)
 
         self.q_orderclose = queue.Queue()
         t = threading.Thread(target=self._t_order_cancel, daemon=True)
         t.start()
 
+        t = threading.Thread(target=self._t_balance, daemon=True)
+        t.start()
+
     def order_create(self, order, stopside=None, takeside=None, **kwargs):
-        """Creates an order"""
+        """Creates an order.
+
+        A `comment` given in `kwargs` must be a dict, it is merged into the
+        comment carrying the client id of the order.
+        """
+        comment = kwargs.pop('comment', None) or {}
+        if not isinstance(comment, dict):
+            raise ValueError("W: Order comment must be a dict, not: %r" %
+                             (comment,))
+
         okwargs = dict()
         okwargs['action'] = 'TRADE'
 
@@ -463,7 +1461,10 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         # if order.exectype == bt.Order.StopTrail:
         #     okwargs['distance'] = order.trailamount
 
-        okwargs['comment'] = dict()
+        # client order id, finds the order again if the reply is lost. It
+        # comes first, the terminal cuts comments to 31 characters
+        okwargs['comment'] = collections.OrderedDict(
+            [('cid', self._client_id(order.ref))])
 
         if stopside is not None and stopside.price is not None:
             okwargs['stoploss'] = stopside.price
@@ -480,7 +1481,9 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
             print(KeyError)
 
         okwargs.update(**kwargs)  # anything from the user
-        self.q_ordercreate.put((order.ref, okwargs,))
+        for key, value in comment.items():
+            okwargs['comment'].setdefault(key, value)
+        self.q_ordercreate.put(okwargs['symbol'], (order.ref, okwargs,))
 
         # notify orders of being submitted
         self.broker._submit(order.ref)
@@ -491,38 +1494,113 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
 
         return order
 
-    def _t_order_create(self):
-        while True:
-            msg = self.q_ordercreate.get()
-            if msg is None:
-                break
-
-            oref, okwargs = msg
+    def _order_send(self, msg):
+        # called by the order workers
+        oref, okwargs = msg
 
-            try:
-                o = self.oapi.construct_and_send(**okwargs)
-            except Exception as e:
-                self.put_notification(e)
+        try:
+            o = self._order_request(okwargs, self._client_id(oref))
+            if o is None:
                 self.broker._reject(oref)
                 return
 
             if self.debug:
                 print(o)
 
-            if o['error']:
-                self.put_notification(o['description'])
+            if o.get('error') or not o.get('order'):
+                self.put_notification(o.get('description'))
                 self.broker._reject(oref)
                 return
+            oid = o['order']
+        except Exception as e:
+            # the order must not stay submitted forever
+            traceback.print_exc()
+            self.put_notification('Order {} not sent: {}'.format(oref, e))
+            self.broker._reject(oref)
+            return
+
+        # submitted before its transactions can be matched, a fill
+        # must not be followed by the submission
+        self.broker._submit(oref)
+
+        with self._orders_lock:
+            self._orders.add(oref, oid, okwargs['symbol'],
+                             okwargs['actionType'])
+            early = self._unmatched.pop(oid, ())
+
+        # transactions are processed in the I/O thread
+        for request, reply in early:
+            self.oapi.call_soon(
+                self._process_transaction, oid, request, reply)
+
+    def _client_id(self, oref):
+        """Client id of order `oref`, sent in the comment of its request"""
+        return '{}-{}'.format(self._session, oref)
+
+    def _order_request(self, okwargs, cid):
+        """Send a TRADE request and return the reply, None if it could not
+        be sent.
+
+        Requests failing in transit are sent again up to `ORDER_RETRIES`
+        times, after a growing delay. The order may have been placed and
+        only the reply lost: it is first looked for by its client id, and
+        not sent again if it exists.
+        """
+        retries = self.ORDER_RETRIES
+        delay = self.ORDER_BACKOFF
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+                oid = self._find_order(cid)
+                if oid is None:
+                    error = 'order lookup failed'
+                    continue  # still unreachable, sending could double it
+                if oid:
+                    return {'error': False, 'order': oid}
+
+            try:
+                reply = self.oapi.construct_and_send(**okwargs)
+            except Exception as e:
+                error = e
             else:
-                oid = o['order']
+                if reply is not None:
+                    return reply
+                error = 'no reply'
+
+            print('W: TRADE request {} failed ({}), attempt {} of {}'.format(
+                cid, error, attempt + 1, retries + 1))
 
-            self._orders[oref] = oid
-            self.broker._submit(oref)
+        self.put_notification('Order {} not sent: {}'.format(cid, error))
+        return None
 
-            # keeps orders types
-            self._orders_type[oref] = okwargs['actionType']
-            # maps ids to backtrader order
-            self._ordersrev[oid] = oref
+    def _find_order(self, cid):
+        """Ticket of the pending order or position of client id `cid`, 0
+        if there is none and None if the terminal did not answer"""
+        for action, key in (('ORDERS', 'orders'), ('POSITIONS', 'positions')):
+            try:
+                reply = self.oapi.construct_and_send(action=action)
+            except Exception:
+                return None
+            if reply is None or reply.get('error'):
+                return None
+
+            for item in reply.get(key) or ():
+                if self._has_cid(item.get('comment'), cid):
+                    return item['id']
+        return 0
+
+    @staticmethod
+    def _has_cid(comment, cid):
+        """Whether an order `comment` carries client id `cid`, as sent or
+        as the string the terminal keeps, cut to 31 characters"""
+        if isinstance(comment, dict):
+            return comment.get('cid') == cid
+        if not comment or not isinstance(comment, str):
+            return False
+        # the client id comes first, it is not cut: "{"cid": "1a2b3c4d-12"
+        return re.search(r'(?<![\w-]){}(?![\w-])'.format(re.escape(cid)),
+                         comment) is not None
 
     def order_cancel(self, order):
         self.q_orderclose.put(order.ref)
@@ -534,59 +1612,288 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
             if oref is None:
                 break
 
-            oid = self._orders.get(oref, None)
-            if oid is None:
-                continue  # the order is no longer there
-
-            # get symbol name
-            order = self.broker.orders[oref]
-            symbol = order.data._dataname
-            # get order type
-            order_type = self._orders_type.get(oref, None)
+            record = self._orders.get(oref)
+            if record is None or record.state in ('cancelled', 'closed'):
+                continue  # the order or its position is no longer there
+            oid = record.oid
 
             try:
-                if order_type in ['ORDER_TYPE_BUY', 'ORDER_TYPE_SELL']:
-                    self.close_position(oid, symbol)
+                if record.otype in self._MARKET_TYPES:
+                    self.close_position(oid, record.symbol)
                 else:
-                    self.cancel_order(oid, symbol)
+                    self.cancel_order(oid, record.symbol)
             except Exception as e:
                 self.put_notification(
                     "Order not cancelled: {}, {}".format(oid, e))
                 continue
 
+            self._orders.finish(oref, 'cancelled')
             self._cancel_flag = True
             self.broker._cancel(oref)
 
-    def candles(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False):
+    def candles(self, dataname, dtbegin, dtend, timeframe, compression,
+                include_first=False, shared=False):
+        """Download the candles of [dtbegin, dtend] in the background.
+
+        Long ranges are split in windows of `HISTORY_CHUNK` bars, up to
+        `HISTORY_INFLIGHT` of them requested concurrently. Each window is put
+        in the returned queue once it and the preceding ones arrived, as a
+        compact block of decoded bars (see `mt5bars.candles_to_block`).
+        `{}` marks the end and None a failed download.
+
+        The download runs at most `HISTORY_PREFETCH` windows ahead of the
+        feed (see `HistoryQueue`), the next ones being requested while the
+        feed loads the current one.
+
+        With a cache only the ranges before and after the cached one are
+        downloaded, and then added to it. `shared` candles are always
+        cached, at least in memory, for the other feeds requesting them.
+        """
         tf = self.get_granularity(timeframe, compression)
 
         begin = end = None
         if dtbegin:
             begin = int((dtbegin - self._DTEPOCH).total_seconds())
         if dtend:
-            end = int((dtbegin - self._DTEPOCH).total_seconds())
+            end = int((dtend - self._DTEPOCH).total_seconds())
+
+        span = self.HISTORY_CHUNK * compression * \
+            self._TIMEFRAME_SECONDS[timeframe]
 
         if self.debug:
-            print('Fetching: {}, Timeframe: {}, Fromdate: {}'.format(
-                dataname, tf, dtbegin))
-
-        data = self.oapi.construct_and_send(action="HISTORY", actionType="DATA", symbol=dataname,
-                                            chartTF=tf, fromDate=begin, toDate=end)
-        candles = data['data']
-        # Remove last unclosed candle
-        if not include_first:
-            try:
-                del candles[-1]
-            except:
-                pass
+            print('Fetching: {}, Timeframe: {}, Fromdate: {}, Todate: {}'
+                  .format(dataname, tf, dtbegin, dtend))
+
+        q = HistoryQueue(self.HISTORY_PREFETCH)
+        t = threading.Thread(target=self._t_candles,
+                             args=(q, dataname, tf, begin, end, span,
+                                   include_first,
+                                   self.shared if shared else self.cache),
+                             daemon=True)
+        t.start()
+        return q
 
-        q = queue.Queue()
-        for c in candles:
-            q.put(c)
+    def last_candles(self, dataname, count, timeframe, compression):
+        """Download the last `count` closed candles in the background.
 
+        The range is guessed from the bar length and doubled backwards, up
+        to `HISTORY_EXTEND` times, until enough candles arrived (there are
+        none on weekends and holidays). The blocks are put in the returned
+        queue in time order once all arrived, `{}` marks the end and None a
+        failed download.
+        """
+        tf = self.get_granularity(timeframe, compression)
+        seconds = compression * self._TIMEFRAME_SECONDS[timeframe]
+
+        if self.debug:
+            print('Fetching: {}, Timeframe: {}, Last: {}'.format(
+                dataname, tf, count))
+
+        q = HistoryQueue(self.HISTORY_PREFETCH)
+        t = threading.Thread(target=self._t_last_candles,
+                             args=(q, dataname, tf, count, seconds),
+                             daemon=True)
+        t.start()
+        return q
+
+    def _t_last_candles(self, q, dataname, tf, count, seconds):
+        blocks = list()  # oldest first
+        bars = 0
+        span = (count + 1) * seconds  # and the forming one
+        begin, end = int(time.time()) - span, None
+        for _ in range(self.HISTORY_EXTEND + 1):
+            part = HistoryQueue()
+            if not self._download(
+                    part, dataname, tf,
+                    self._history_windows(begin, end,
+                                          self.HISTORY_CHUNK * seconds),
+                    False):
+                q.put(None)
+                return
+
+            blocks[:0] = list(part.queue)
+            bars += sum(block_len(block) for block in part.queue)
+            if bars >= count:
+                break
+            end, span = begin - 1, span * 2
+            begin = end + 1 - span
+
+        # drop the oldest bars beyond count
+        extra = max(0, bars - count)
+        for block in blocks:
+            n = block_len(block)
+            if extra >= n:
+                extra -= n
+                continue
+            q.put(block[extra * BAR_FIELDS:])
+            extra = 0
         q.put({})
+
+    @staticmethod
+    def _history_windows(begin, end, span):
+        """Split [begin, end] in consecutive inclusive windows of `span`
+        seconds. An open begin or end is left to the terminal"""
+        if begin is None:
+            return [(begin, end)]
+
+        stop = end if end is not None else int(time.time())
+        windows = list()
+        while begin + span <= stop:
+            windows.append((begin, begin + span - 1))
+            begin += span
+        windows.append((begin, end))
+        return windows
+
+    def _t_candles(self, q, dataname, tf, begin, end, span, include_first,
+                   cache):
+        series = None
+        if cache is not None and begin is not None:
+            series = cache.series(dataname, tf)
+
+        if series is None:
+            if self._download(q, dataname, tf,
+                              self._history_windows(begin, end, span),
+                              include_first):
+                q.put({})
+            return
+
+        # released while the feed catches up: other feeds of the series
+        # may be loaded by the same thread. The cache only grows meanwhile
+        lock = series.lock
+        with lock:
+            # an empty cache is all tail
+            first, last = series.cover or (begin, begin - 1)
+
+            if begin < first:
+                head = list()
+                if not self._download(
+                        q, dataname, tf,
+                        self._history_windows(begin, first - 1, span),
+                        include_first, lambda candles, _: head.extend(candles),
+                        until=end, unlock=lock):
+                    return
+                series.prepend(head, begin)
+
+            # chunk by chunk from the time reached, the cache may be remapped
+            t, hi = max(begin, first), last if end is None else min(end, last)
+            while not q.closed:
+                candles = next(series.chunks(t, hi, self.HISTORY_CHUNK), None)
+                if not candles:
+                    break
+                q.put(candles_to_block(candles), unlock=lock)
+                t = candles[-1][0] + 1
+
+            if end is None or end > last:
+                if not self._download(
+                        q, dataname, tf,
+                        self._history_windows(last + 1, end, span),
+                        include_first,
+                        lambda candles, covered: series.append(
+                            candles, covered, begin),
+                        since=begin, unlock=lock):
+                    return
+
+        if self.debug:
+            print('Cached: {}, Timeframe: {}, Bars: {}'.format(
+                dataname, tf, len(series)))
+        q.put({})
+
+    def ticks(self, dataname, dtbegin, dtend):
+        """Download the ticks of [dtbegin, dtend] in the background.
+
+        Windows of `TICK_WINDOW` seconds are fetched like candles and put in
+        the returned queue as blocks of `mt5bars.TICK_FIELDS` values per
+        tick. `{}` marks the end and None a failed download.
+        """
+        begin = end = None
+        if dtbegin:
+            begin = int((dtbegin - self._DTEPOCH).total_seconds())
+        if dtend:
+            end = int((dtend - self._DTEPOCH).total_seconds())
+
+        if self.debug:
+            print('Fetching ticks: {}, Fromdate: {}, Todate: {}'.format(
+                dataname, dtbegin, dtend))
+
+        def fetch():
+            windows = self._history_windows(begin, end, self.TICK_WINDOW)
+            if self._download(q, dataname, 'TICK', windows, True,
+                              decode=ticks_to_block):
+                q.put({})
+
+        q = HistoryQueue(self.HISTORY_PREFETCH)
+        threading.Thread(target=fetch, daemon=True).start()
         return q
 
+    def _download(self, q, dataname, tf, windows, include_first,
+                  on_window=None, since=None, until=None,
+                  decode=candles_to_block, unlock=None):
+        """Put the candles of every window in `q` (a `HistoryQueue`) in
+        order, only those in [since, until] when given. `unlock` is released
+        while waiting for room in `q`.
+
+        `on_window(candles, covered)` receives the closed candles of each
+        window and the time up to which the range is known. On failure None
+        is put in `q` and False returned, as when `q` is closed.
+        """
+        windows = collections.deque(windows)
+        inflight = collections.deque()  # (window, future) in range order
+
+        def request(window):
+            return self.oapi.submit(action='HISTORY', actionType='DATA',
+                                    symbol=dataname, chartTF=tf,
+                                    fromDate=window[0], toDate=window[1])
+
+        while windows or inflight:
+            if q.closed:  # the feed is gone
+                for _, future in inflight:
+                    self.oapi._forget(future)
+                return False
+
+            while windows and len(inflight) < self.HISTORY_INFLIGHT:
+                window = windows.popleft()
+                inflight.append((window, request(window)))
+
+            window, future = inflight.popleft()
+            data = self.oapi._pull_reply(future)
+            if data is None:
+                print('W: HISTORY window {} timed out, retrying'.format(
+                    window))
+                data = self.oapi._pull_reply(request(window))
+
+            if data is None or data.get('error'):
+                print('E: HISTORY download of {} failed: {}'.format(
+                    dataname, data))
+                for _, future in inflight:
+                    self.oapi._forget(future)
+                q.put(None)
+                return False
+
+            candles = data.get('data') or []
+            # the last candle of a range reaching the present is not closed
+            present = not windows and not inflight and \
+                (window[1] is None or window[1] >= time.time())
+            closed = candles[:-1] if present else candles
+
+            if on_window is not None:
+                if present:
+                    covered = closed[-1][0] if closed else window[0] - 1
+                else:
+                    covered = window[1]
+                on_window(closed, covered)
+
+            if not include_first:
+                candles = closed
+            if candles and (since is not None and candles[0][0] < since or
+                            until is not None and candles[-1][0] > until):
+                candles = [c for c in candles
+                           if (since is None or c[0] >= since) and
+                           (until is None or c[0] <= until)]
+            if candles:
+                q.put(decode(candles), unlock=unlock)
+
+        return True
+
     '''ram
     def config_server(self, symbol: str, timeframe: str) -> None:
         """Set server terminal symbol and time frame"""
@@ -621,7 +1928,8 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
 
         conf = self.oapi.construct_and_send(
             action="TRADE", actionType='POSITION_CLOSE_ID', symbol=symbol, id=oid)
-        print(conf)
+        if self.debug:
+            print(conf)
         # Error handling
         if conf["error"]:
             raise ServerDataError(conf)
@@ -632,7 +1940,8 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
 
         conf = self.oapi.construct_and_send(
             action="TRADE", actionType='ORDER_CANCEL', symbol=symbol, id=oid)
-        print(conf)
+        if self.debug:
+            print(conf)
         # Error handling
         if conf["error"]:
             raise ServerDataError(conf)
@@ -649,8 +1958,8 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         except KeyError:
             raise KeyError(trans)
 
-        # Update balance after transaction
-        # self.get_balance()
+        # Update balance after transaction, from the balance thread
+        self._balance_due.set()
 
         if self.debug:
             print(request, reply, sep='\n')
@@ -675,15 +1984,24 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         else:
             return
 
-        # try:
-        #     oref = self._ordersrev.pop(oid)
-        # except KeyError:
-        #     raise KeyError(oid)
+        with self._orders_lock:
+            known = self._orders.by_ticket(oid) is not None
+            if not known and oid is not None:
+                # the order creation reply may still be on its way
+                self._unmatched.setdefault(oid, []).append((request, reply))
+                while len(self._unmatched) > self._UNMATCHED_SIZE:
+                    self._unmatched.popitem(last=False)
 
-        if oid in self._orders.values():
+        if known:
             # when an order id exists process transaction
             self._process_transaction(oid, request, reply)
         else:
+            # a position of an order of ours closed, by us or in the terminal
+            record = self._orders.by_ticket(request.get('position'))
+            if record is not None and \
+                    reply['result'] == 'TRADE_RETCODE_DONE':
+                self._orders.finish(record.oref, 'closed')
+
             # external order created this transaction
             if self._cancel_flag and reply['result'] == 'TRADE_RETCODE_DONE':
                 self._cancel_flag = False
@@ -698,11 +2016,12 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
                         break
 
     def _process_transaction(self, oid, request, reply):
-        try:
-            # get a reference to a backtrader order based on the order id / trade id
-            oref = self._ordersrev[oid]
-        except KeyError:
+        # get a reference to a backtrader order based on the order id /
+        # trade id
+        record = self._orders.by_ticket(oid)
+        if record is None:
             return
+        oref = record.oref
 
         if request['action'] == 'TRADE_ACTION_PENDING':
             pass
@@ -713,3 +2032,10 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
             if request['type'].endswith('_SELL'):
                 size = -size
             self.broker._fill(oref, size, price, reason=request['type'])
+            order = self.broker.orders.get(oref)
+            if order is None or order.status != bt.Order.Completed:
+                return
+            if record.otype in self._MARKET_TYPES:
+                self._orders.update(oref, 'open')  # kept to close it
+            else:
+                self._orders.finish(oref, 'completed')
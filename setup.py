@@ -12,6 +12,9 @@ with open('HISTORY.rst') as history_file:
 
 requirements = ['Click>=7.0', ]
 
+# faster history decoding, mt5bars falls back to pure Python without it
+extras_requirements = {'fast': ['numpy>=1.16'], }
+
 setup_requirements = [ ]
 
 test_requirements = [ ]
@@ -38,6 +41,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
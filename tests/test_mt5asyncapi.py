@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Tests for `mql5_zmq_backtrader.mt5asyncapi`."""
+
+
+import asyncio
+import json
+import time
+import unittest
+
+from mql5_zmq_backtrader.mt5asyncapi import MTraderAsyncAPI
+from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+
+
+class TestMTraderAsyncAPI(unittest.TestCase):
+    """Drive `MTraderAsyncAPI` against the fake terminal."""
+
+    def setUp(self):
+        """Start a terminal and an event loop."""
+        self.terminal = MTraderFakeTerminal(rate=100.0, latency=0.2).start()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        """Release the ports."""
+        self.loop.close()
+        self.terminal.stop()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_requests(self):
+        """Many requests are awaited concurrently on one loop."""
+        async def fetch():
+            async with MTraderAsyncAPI('127.0.0.1') as api:
+                return await asyncio.gather(*[
+                    api.construct_and_send(
+                        action='HISTORY', actionType='DATA',
+                        symbol='SYM{}'.format(i), chartTF='H1',
+                        fromDate=1577836800, toDate=1577836800)
+                    for i in range(50)])
+
+        start = time.time()
+        replies = self._run(fetch())
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual([r['symbol'] for r in replies],
+                         ['SYM{}'.format(i) for i in range(50)])
+
+    def test_timeout(self):
+        """Timed out requests return None and are forgotten."""
+        async def fetch():
+            async with MTraderAsyncAPI('127.0.0.1') as api:
+                await api.construct_and_send(action='ACCOUNT')  # ids echoed
+                reply = await api.construct_and_send(action='BALANCE',
+                                                     timeout=0.05)
+                return reply, len(api._pending)
+
+        self.assertEqual(self._run(fetch()), (None, 0))
+
+    def test_late_reply_is_counted_once(self):
+        """A late reply does not count out a request still in flight."""
+        async def fetch():
+            async with MTraderAsyncAPI('127.0.0.1') as api:
+                await api.construct_and_send(action='ACCOUNT')  # ids echoed
+                await api.construct_and_send(action='BALANCE', timeout=0.05)
+                self.terminal.latency = 1.0
+                future = api.submit(action='POSITIONS')
+                await asyncio.sleep(0.3)  # the late reply came
+                inflight = api._inflight
+                await future
+                return inflight, api._inflight, len(api._abandoned)
+
+        self.assertEqual(self._run(fetch()), (1, 0, 0))
+
+    def test_timeout_without_ids(self):
+        """Without ids a late reply is still read by nobody else."""
+        self.terminal.echo_ids = False
+
+        async def fetch():
+            async with MTraderAsyncAPI('127.0.0.1') as api:
+                late = await api.construct_and_send(action='BALANCE',
+                                                    timeout=0.05)
+                history, positions = await asyncio.gather(
+                    api.construct_and_send(
+                        action='HISTORY', actionType='DATA', symbol='SYM0',
+                        chartTF='H1', fromDate=1577836800,
+                        toDate=1577836800),
+                    api.construct_and_send(action='POSITIONS'))
+                return late, history, positions, api.echo_ids
+
+        late, history, positions, echo_ids = self._run(fetch())
+        self.assertIsNone(late)
+        self.assertEqual(history['symbol'], 'SYM0')
+        self.assertEqual(positions['positions'], [])
+        self.assertIs(echo_ids, False)
+
+    def test_malformed_reply(self):
+        """A reply which is not an object does not stop the reader."""
+        def decode(buf):
+            msg = json.loads(bytes(buf).decode('utf-8'))
+            return list(msg) if 'equity' in msg and 'currency' not in msg \
+                else msg
+
+        async def fetch():
+            async with MTraderAsyncAPI('127.0.0.1', decoder=decode) as api:
+                await api.construct_and_send(action='ACCOUNT')
+                bad = await api.construct_and_send(action='BALANCE',
+                                                   timeout=0.5)
+                return bad, await api.construct_and_send(action='ACCOUNT')
+
+        bad, account = self._run(fetch())
+        self.assertIsNone(bad)
+        self.assertEqual(account['currency'], 'USD')
+
+    def test_live_stream(self):
+        """Live candles are delivered through an async iterator."""
+        async def consume():
+            async with MTraderAsyncAPI('127.0.0.1') as api:
+                messages = list()
+                async for msg in api.live_stream():
+                    messages.append(msg)
+                    if len(messages) == 3:
+                        break
+                return messages
+
+        messages = self._run(consume())
+        self.assertEqual([m['symbol'] for m in messages], ['EURUSD'] * 3)
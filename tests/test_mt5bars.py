@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""Tests for `mql5_zmq_backtrader.mt5bars`."""
+
+
+from array import array
+import datetime
+import importlib
+import random
+import sys
+import unittest
+from unittest import mock
+
+from backtrader import date2num
+
+from mql5_zmq_backtrader import mt5bars
+from mql5_zmq_backtrader.mt5bars import (TICK_FIELDS, BarAggregator,
+                                         TickBarBuilder, block_bar,
+                                         block_column, block_len, block_range,
+                                         candles_to_block, msc2num, num2ts,
+                                         period_bounds, ticks_to_block,
+                                         ts2num)
+
+
+class TestCandleDecoding(unittest.TestCase):
+    """Epoch seconds to backtrader times, in bulk and one by one."""
+
+    def setUp(self):
+        """Random bar times from 1970 to 2096."""
+        rnd = random.Random(7)
+        self.times = sorted(rnd.randrange(0, 4 * 10 ** 9)
+                            for _ in range(20000))
+        self.expected = [date2num(datetime.datetime.utcfromtimestamp(t))
+                         for t in self.times]
+
+    def _without_numpy(self, func, *args):
+        numpy, mt5bars.np = mt5bars.np, None
+        try:
+            return func(*args)
+        finally:
+            mt5bars.np = numpy
+
+    def test_same_as_date2num(self):
+        """Decoded times are bit for bit those of date2num."""
+        self.assertEqual([ts2num(t) for t in self.times], self.expected)
+
+        candles = [[t, 1, 2, 0, 1, 10] for t in self.times]
+        for block in (candles_to_block(candles),
+                      self._without_numpy(candles_to_block, candles)):
+            self.assertEqual(block_column(block, 0).tolist(),
+                             sorted(set(self.expected)))
+
+    def test_dedup_and_monotonic(self):
+        """Repeated, older and out of order bars are dropped."""
+        candles = [[120, 1, 1, 1, 1, 1], [180, 2, 2, 2, 2, 2],
+                   [180, 3, 3, 3, 3, 3], [60, 4, 4, 4, 4, 4],
+                   [240, 5, 5, 5, 5, 5]]
+        expected = [[ts2num(t), v, v, v, v, v]
+                    for t, v in ((180, 2), (240, 5))]
+
+        for block in (candles_to_block(candles, ts2num(120)),
+                      self._without_numpy(candles_to_block, candles,
+                                          ts2num(120))):
+            self.assertEqual(block_len(block), 2)
+            self.assertEqual([block_bar(block, i) for i in range(2)],
+                             expected)
+
+    def test_compact(self):
+        """Blocks take 8 bytes per value."""
+        candles = [[60 * i, 1.1, 1.2, 1.0, 1.15, 100] for i in range(1000)]
+        block = self._without_numpy(candles_to_block, candles)
+        self.assertIsInstance(block, array)
+        self.assertEqual(len(block.tobytes()), 48 * 1000)
+        self.assertEqual(candles_to_block(candles).nbytes, 48 * 1000)
+
+    def test_numpy_missing(self):
+        """Without NumPy installed candles are decoded one at a time."""
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            importlib.reload(mt5bars)
+        self.addCleanup(importlib.reload, mt5bars)
+        self.assertIsNone(mt5bars.np)
+
+        candles = [[t, 1, 2, 0, 1, 10] for t in self.times]
+        block = mt5bars.candles_to_block(candles)
+        self.assertIsInstance(block, array)
+        self.assertEqual(block.tolist()[::6], sorted(set(self.expected)))
+        ticks = mt5bars.ticks_to_block([[1500, 1.0, 1.1]])
+        self.assertEqual(ticks.tolist(), [1.5, 1.0, 1.1, 0.0, 0.0])
+
+    def test_range(self):
+        """Bars are selected by time with a binary search."""
+        block = candles_to_block([[60 * i, 1, 1, 1, 1, 1]
+                                  for i in range(10)])
+        self.assertEqual(block_range(block, ts2num(120), ts2num(300)),
+                         (2, 6))
+        self.assertEqual(block_range(block, after=ts2num(480)), (9, 10))
+        self.assertEqual(block_range(block, after=float('nan')), (0, 10))
+        self.assertEqual(block_range(block, ts2num(900)), (10, 10))
+
+
+class TestTicks(unittest.TestCase):
+    """Tick blocks and bars built from ticks."""
+
+    def test_ticks_to_block(self):
+        """Ticks keep their order, older ones are dropped and missing
+        fields are zero."""
+        ticks = [[1500, 1.0, 1.1], [1500, 1.2, 1.3, 1.25, 2],
+                 [1000, 9.0, 9.0, 9.0, 9], [2750, 1.4, 1.5, 1.45, 1]]
+        expected = [[1.5, 1.0, 1.1, 0.0, 0.0], [1.5, 1.2, 1.3, 1.25, 2.0],
+                    [2.75, 1.4, 1.5, 1.45, 1.0]]
+        numpy, mt5bars.np = mt5bars.np, None
+        try:
+            fallback = ticks_to_block(ticks)
+        finally:
+            mt5bars.np = numpy
+
+        for block in (ticks_to_block(ticks), fallback):
+            self.assertEqual([block_bar(block, i, TICK_FIELDS)
+                              for i in range(block_len(block, TICK_FIELDS))],
+                             expected)
+        self.assertEqual(len(ticks_to_block(ticks, 2.0)), TICK_FIELDS)
+
+    def test_msc2num(self):
+        """Milliseconds are kept as a fraction of the day."""
+        self.assertEqual(msc2num(86400.0), ts2num(86400))
+        self.assertAlmostEqual((msc2num(60.25) - ts2num(60)) * 86400000.0,
+                               250.0, places=2)
+
+    def test_bar_builder(self):
+        """Bars open on multiples of their length and complete with the
+        first tick of a later bar."""
+        builder = TickBarBuilder(5)
+        bars = [builder.update(t, p, v) for t, p, v in (
+            (10.2, 1.0, 1), (11.0, 1.3, 2), (14.9, 0.8, 0), (13.0, 5.0, 1),
+            (21.0, 1.1, 1), (4.0, 9.0, 1))]
+        self.assertEqual(bars[:4], [None] * 4)
+        self.assertEqual(bars[4], [10.0, 1.0, 5.0, 0.8, 5.0, 5.0])
+        self.assertIsNone(bars[5])  # late tick of a completed bar
+        self.assertIsNone(builder.flush(24.9))
+        self.assertEqual(builder.flush(25.0), [20.0, 1.1, 1.1, 1.1, 1.1, 1.0])
+        self.assertIsNone(builder.bar)
+        self.assertIsNone(builder.update(24.5, 1.0))  # flushed bar
+        self.assertIsNone(builder.bar)
+
+
+class TestBarAggregator(unittest.TestCase):
+    """Coarser bars built from M1 candles."""
+
+    def test_period_bounds(self):
+        """Bars are aligned like the terminal ones."""
+        t = 1578400000  # Tuesday 2020-01-07 12:26:40
+        self.assertEqual(period_bounds(t, 'M5'), (1578399900, 1578400200))
+        self.assertEqual(period_bounds(t, 'H4'), (1578398400, 1578412800))
+        self.assertEqual(period_bounds(t, 'D1'), (1578355200, 1578441600))
+        # weeks start on Sunday, months on the first
+        self.assertEqual(period_bounds(t, 'W1'), (1578182400, 1578787200))
+        self.assertEqual(period_bounds(t, 'MN1'), (1577836800, 1580515200))
+        self.assertEqual(period_bounds(1575158400, 'MN1'),
+                         (1575158400, 1577836800))
+
+    def test_num2ts(self):
+        """Epoch seconds survive a round trip through date2num."""
+        for t in (0, 59, 1578400000, 4 * 10 ** 9 - 1):
+            self.assertEqual(num2ts(ts2num(t)), t)
+
+    def test_update(self):
+        """A bar completes with a later one or once its time is over."""
+        agg = BarAggregator('M5')
+        done = [agg.update(t, o, h, low, c, 10)
+                for t, o, h, low, c in ((60, 1, 3, 1, 2), (120, 2, 2, 0, 1),
+                                        (120, 9, 9, 9, 9), (360, 1, 1, 1, 1))]
+        self.assertEqual(done, [None, None, None, [0, 1, 3, 0, 1, 20]])
+        self.assertIsNone(agg.flush(599))
+        agg.update(540, 1, 2, 1, 2, 10)
+        self.assertEqual(agg.flush(600), [300, 1, 2, 1, 2, 20])
+        self.assertIsNone(agg.bar)
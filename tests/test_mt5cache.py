@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Tests for `mql5_zmq_backtrader.mt5cache`."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mql5_zmq_backtrader.mt5cache import CandleCache, CandleSeries
+
+
+def _candles(begin, end, step=60):
+    return [[t, 1.0 + t, 2.0 + t, 0.5 + t, 1.5 + t, 10.0]
+            for t in range(begin, end + 1, step)]
+
+
+class TestCandleSeries(unittest.TestCase):
+    """Memory-mapped columnar candle files."""
+
+    def setUp(self):
+        """Work in a scratch directory."""
+        self.directory = tempfile.mkdtemp()
+        self.cache = CandleCache(self.directory)
+
+    def tearDown(self):
+        """Remove the files."""
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def _all(self, series):
+        return [c for chunk in series.chunks(size=100) for c in chunk]
+
+    def test_append_and_reopen(self):
+        """Candles and the covered range survive a restart."""
+        series = self.cache.series('EURUSD', 'M1')
+        self.assertIsNone(series.cover)
+        series.append(_candles(6000, 6600), 6659, 5990)
+        self.assertEqual(series.cover, (5990, 6659))
+
+        # overlapping bars are not added twice
+        series.append(_candles(6600, 7200), 7200)
+        self.cache.close()
+
+        series = CandleCache(self.directory).series('EURUSD', 'M1')
+        self.assertEqual(series.cover, (5990, 7200))
+        self.assertEqual(self._all(series), _candles(6000, 7200))
+        series.close()
+
+    def test_growth_and_prepend(self):
+        """Files grow past their capacity and take older bars in front."""
+        series = self.cache.series('EURUSD', 'M1')
+        series.append(_candles(600000, 600000 + 60 * 2999), 780000)
+        self.assertGreaterEqual(series.capacity, 3000)
+
+        series.prepend(_candles(0, 599940), 0)
+        self.assertEqual(series.cover, (0, 780000))
+        self.assertEqual(self._all(series), _candles(0, 600000 + 60 * 2999))
+        self.assertEqual(list(series.chunks(120, 240)), [_candles(120, 240)])
+
+    def test_not_a_cache_file(self):
+        """Foreign files are refused."""
+        path = self.directory + '/foreign.bars'
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 64)
+        self.assertRaises(ValueError, CandleSeries, path)
+
+    def test_in_memory(self):
+        """Without a directory series behave the same, in memory."""
+        cache = CandleCache()
+        series = cache.series('EURUSD', 'M1')
+        self.assertIs(cache.series('EURUSD', 'M1'), series)
+        series.append(_candles(6000, 6600), 6659, 5990)
+        series.append([], 7000)
+        series.prepend(_candles(0, 5940), 0)
+        self.assertEqual(series.cover, (0, 7000))
+        self.assertEqual(self._all(series), _candles(0, 6600))
+        self.assertEqual(list(series.chunks(120, 240)), [_candles(120, 240)])
+        self.assertEqual(os.listdir(self.directory), [])
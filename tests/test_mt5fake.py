@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests for the fake MetaTrader 5 terminal."""
+
+
+import unittest
+
+from click.testing import CliRunner
+
+from mql5_zmq_backtrader import cli
+from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+from mql5_zmq_backtrader.mt5store import MTraderAPI
+
+
+class TestMTraderFakeTerminal(unittest.TestCase):
+    """Drive `MTraderAPI` against the fake terminal."""
+
+    def setUp(self):
+        """Start a terminal and connect an API to it."""
+        self.terminal = MTraderFakeTerminal(symbols=['EURUSD', 'GBPUSD'],
+                                            rate=50.0).start()
+        self.api = MTraderAPI('127.0.0.1')
+
+    def tearDown(self):
+        """Release the ports."""
+        self.api.close()
+        self.terminal.stop()
+
+    def test_account_and_balance(self):
+        """Account replies carry the configured balance."""
+        account = self.api.construct_and_send(action='ACCOUNT')
+        self.assertFalse(account['error'])
+        self.assertEqual(account['currency'], 'USD')
+
+        balance = self.api.construct_and_send(action='BALANCE')
+        self.assertEqual(balance['balance'], 10000.0)
+        self.assertEqual(balance['equity'], 10000.0)
+
+    def test_history_is_deterministic(self):
+        """HISTORY returns contiguous bars that match on every call."""
+        kwargs = dict(action='HISTORY', actionType='DATA', symbol='EURUSD',
+                      chartTF='M5', fromDate=1577836800,
+                      toDate=1577836800 + 3600)
+        bars = self.api.construct_and_send(**kwargs)['data']
+        self.assertEqual(len(bars), 13)
+        self.assertEqual([b[0] - bars[0][0] for b in bars],
+                         [300 * i for i in range(13)])
+        for t, o, h, low, c, v in bars:
+            self.assertTrue(low <= min(o, c) <= max(o, c) <= h)
+
+        self.assertEqual(bars, self.api.construct_and_send(**kwargs)['data'])
+
+    def test_tick_history(self):
+        """HISTORY of TICK returns the ticks of the requested seconds."""
+        ticks = self.api.construct_and_send(
+            action='HISTORY', actionType='DATA', symbol='EURUSD',
+            chartTF='TICK', fromDate=1577836800,
+            toDate=1577836801)['data']
+        self.assertEqual([t[0] for t in ticks],
+                         list(range(1577836800000, 1577836802000, 250)))
+        for t, bid, ask, last, volume in ticks:
+            self.assertTrue(bid < last < ask)
+            self.assertGreater(volume, 0)
+
+    def test_trade_round_trip(self):
+        """Market orders open positions and are streamed as deals."""
+        events = self.api.streaming_socket()
+        events.RCVTIMEO = 2000
+
+        reply = self.api.construct_and_send(
+            action='TRADE', actionType='ORDER_TYPE_BUY', symbol='EURUSD',
+            volume=0.1)
+        self.assertFalse(reply['error'])
+
+        transaction = events.recv_json()
+        self.assertEqual(transaction['request']['action'],
+                         'TRADE_ACTION_DEAL')
+        self.assertEqual(transaction['request']['order'], reply['order'])
+        self.assertEqual(transaction['result']['result'],
+                         'TRADE_RETCODE_DONE')
+
+        positions = self.api.construct_and_send(action='POSITIONS')
+        self.assertEqual([p['id'] for p in positions['positions']],
+                         [reply['order']])
+
+        reply = self.api.construct_and_send(
+            action='TRADE', actionType='POSITION_CLOSE_ID', symbol='EURUSD',
+            id=reply['order'])
+        self.assertFalse(reply['error'])
+        positions = self.api.construct_and_send(action='POSITIONS')
+        self.assertEqual(positions['positions'], [])
+        events.close(linger=0)
+
+    def test_live_stream(self):
+        """Every configured symbol is streamed on the live port."""
+        live = self.api.live_socket()
+        live.RCVTIMEO = 2000
+        symbols = set()
+        for _ in range(6):
+            msg = live.recv_json()
+            self.assertEqual(msg['status'], 'CONNECTED')
+            self.assertEqual(len(msg['data']), 6)
+            symbols.add(msg['symbol'])
+        self.assertEqual(symbols, {'EURUSD', 'GBPUSD'})
+        live.close(linger=0)
+
+    def test_command_line_interface(self):
+        """The fake terminal is reachable from the CLI."""
+        runner = CliRunner()
+        help_result = runner.invoke(cli.main, ['fake-terminal', '--help'])
+        assert help_result.exit_code == 0
+        assert '--latency' in help_result.output
@@ -0,0 +1,1316 @@
+#!/usr/bin/env python
+
+"""Tests for `mql5_zmq_backtrader.mt5store`."""
+
+
+import datetime
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import backtrader as bt
+import zmq
+
+from mql5_zmq_backtrader import mt5bars
+from mql5_zmq_backtrader.mt5bars import block_bar, block_len, candles_to_block
+from mql5_zmq_backtrader.mt5fake import MTraderFakeTerminal
+from mql5_zmq_backtrader.mt5store import (MTraderAPI, MTraderStore,
+                                          HistoryQueue, LiveQueue,
+                                          OrderRegistry, OrderWorkers,
+                                          TickRing,
+                                          JSON_DECODERS, MTraderError,
+                                          get_json_decoder)
+
+
+class TestMTraderAPI(unittest.TestCase):
+    """Request channel behaviour under concurrency."""
+
+    SYMBOLS = ['SYM{}'.format(i) for i in range(8)]
+
+    def tearDown(self):
+        """Release the ports."""
+        self.api.close()
+        self.terminal.stop()
+
+    def _connect(self, latency=0.0, rate=0, decoder=None, **kwargs):
+        self.terminal = MTraderFakeTerminal(rate=rate, latency=latency,
+                                            **kwargs).start()
+        self.api = MTraderAPI('127.0.0.1', decoder=decoder)
+
+    def _concurrent_history(self):
+        replies = dict()
+
+        def fetch(symbol):
+            replies[symbol] = self.api.construct_and_send(
+                action='HISTORY', actionType='DATA', symbol=symbol,
+                chartTF='H1', fromDate=1577836800, toDate=1577836800)
+
+        threads = [threading.Thread(target=fetch, args=(s,))
+                   for s in self.SYMBOLS]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return replies
+
+    def test_requests_are_pipelined(self):
+        """Outstanding requests overlap instead of queueing."""
+        self._connect(latency=0.2)
+        start = time.time()
+        replies = self._concurrent_history()
+        self.assertLess(time.time() - start, 0.2 * len(self.SYMBOLS) / 2)
+        for symbol, reply in replies.items():
+            self.assertEqual(reply['symbol'], symbol)
+        self.assertTrue(self.api.echo_ids)
+
+    def test_replies_without_ids_match_in_order(self):
+        """Terminals which do not echo ids get one request at a time."""
+        self._connect(latency=0.05, echo_ids=False)
+        start = time.time()
+        for symbol, reply in self._concurrent_history().items():
+            self.assertEqual(reply['symbol'], symbol)
+        self.assertGreaterEqual(time.time() - start,
+                                0.05 * len(self.SYMBOLS))
+        self.assertIs(self.api.echo_ids, False)
+
+    def test_timed_out_reply_is_not_delivered_to_next_caller(self):
+        """A late reply is discarded rather than read by another request."""
+        self._connect(latency=0.2)
+        self.assertIsNone(self.api.construct_and_send(action='BALANCE',
+                                                      timeout=0.05))
+        reply = self.api.construct_and_send(
+            action='HISTORY', actionType='DATA', symbol='SYM0',
+            chartTF='H1', fromDate=1577836800, toDate=1577836800)
+        self.assertEqual(reply['symbol'], 'SYM0')
+        self.assertFalse(self.api._pending)
+
+    def test_late_reply_is_counted_once(self):
+        """A late reply does not count out a request still in flight."""
+        self._connect(latency=0.3)
+        self.api.construct_and_send(action='ACCOUNT')  # ids echoed
+        self.assertIsNone(self.api.construct_and_send(action='BALANCE',
+                                                      timeout=0.05))
+        self.terminal.latency = 1.0
+        future = self.api.submit(action='POSITIONS')
+        time.sleep(0.5)  # the late reply came
+        self.assertEqual(self.api._inflight, 1)
+        self.assertEqual(future.result(2)['positions'], [])
+        self.assertEqual(self.api._inflight, 0)
+        self.assertFalse(self.api._abandoned)
+
+    def test_timed_out_reply_without_ids_is_discarded(self):
+        """Without ids a late reply is still read by nobody else."""
+        self._connect(latency=0.2, echo_ids=False)
+        self.assertIsNone(self.api.construct_and_send(action='BALANCE',
+                                                      timeout=0.05))
+        reply = self.api.construct_and_send(
+            action='HISTORY', actionType='DATA', symbol='SYM0',
+            chartTF='H1', fromDate=1577836800, toDate=1577836800)
+        self.assertEqual(reply['symbol'], 'SYM0')
+        reply = self.api.construct_and_send(action='POSITIONS')
+        self.assertEqual(reply['positions'], [])
+        self.assertFalse(self.api._pending)
+
+    def test_lost_reply_without_ids_is_given_up(self):
+        """A reply never received stops blocking the next requests."""
+        self._connect(echo_ids=False)
+        self.api.DATA_TIMEOUT = 200
+        self.terminal.lose_replies(1)
+        self.assertIsNone(self.api.construct_and_send(action='BALANCE'))
+        start = time.time()
+        reply = self.api.construct_and_send(action='POSITIONS', timeout=2)
+        self.assertEqual(reply['positions'], [])
+        self.assertGreater(time.time() - start, 0.1)
+        self.assertFalse(self.api._pending)
+
+    def test_malformed_reply_fails_its_request(self):
+        """A reply which is not an object fails the oldest request."""
+        def decode(buf):
+            msg = json.loads(bytes(buf).decode('utf-8'))
+            return list(msg) if 'equity' in msg and 'currency' not in msg \
+                else msg
+
+        self._connect(echo_ids=False, decoder=decode)
+        with self.assertRaises(MTraderError):
+            self.api.construct_and_send(action='BALANCE', timeout=2)
+        reply = self.api.construct_and_send(action='POSITIONS', timeout=2)
+        self.assertEqual(reply['positions'], [])
+        self.assertFalse(self.api._pending)
+        self.assertEqual(self.api._inflight, 0)
+
+    def test_live_messages_are_batched(self):
+        """Live messages piled up on the socket are handed over at once."""
+        self._connect(rate=1000.0)
+        batches = list()
+        self.api.subscribe(live=batches.append)
+        time.sleep(0.1)
+        self.api.call_soon(time.sleep, 0.2)  # stall the I/O thread
+        time.sleep(0.4)
+        self.assertGreater(max(len(b) for b in batches), 50)
+        self.assertLessEqual(max(len(b) for b in batches),
+                             self.api.LIVE_BATCH)
+        times = [msg['data'][0] for b in batches for msg in b]
+        self.assertEqual(times, sorted(times))
+
+
+class TestJSONDecoders(unittest.TestCase):
+    """Pluggable decoding of received frames."""
+
+    def test_decoders_agree(self):
+        """Every installed decoder reads a frame buffer the same way."""
+        terminal = MTraderFakeTerminal()
+        msg = terminal.live_message('EURUSD', 'M1',
+                                    terminal.candle('EURUSD', 0, 'M1'))
+        buf = memoryview(json.dumps(msg).encode('utf-8'))
+        for name in JSON_DECODERS:
+            self.assertEqual(get_json_decoder(name)(buf), msg)
+        self.assertEqual(get_json_decoder()(buf), msg)
+
+    def test_unknown_decoder(self):
+        """Asking for a decoder which is not installed fails early."""
+        self.assertRaises(ValueError, get_json_decoder, 'nojson')
+
+
+def _bars(block):
+    return [block_bar(block, i) for i in range(block_len(block))]
+
+
+def _blocks(q):
+    # history blocks until the end mark
+    blocks = list()
+    while True:
+        block = q.get()
+        if block is None or not len(block):
+            return blocks
+        blocks.append(block)
+
+
+def _live(t, symbol='EURUSD', timeframe='M1'):
+    return {'status': 'CONNECTED', 'symbol': symbol, 'timeframe': timeframe,
+            'data': [t, 1, 1, 1, 1, 1]}
+
+
+def _tick(tick, symbol='EURUSD'):
+    return {'status': 'CONNECTED', 'symbol': symbol, 'timeframe': 'TICK',
+            'data': tick}
+
+
+class TestLiveQueue(unittest.TestCase):
+    """Overflow policies of the live queue of a feed."""
+
+    def test_unbounded(self):
+        """Every message is kept in order."""
+        q = LiveQueue()
+        q.put_batch([_live(t) for t in range(1000)])
+        self.assertEqual([q.get(0)['data'][0] for _ in range(1000)],
+                         list(range(1000)))
+        self.assertIsNone(q.get(0))
+
+    def test_drop_oldest(self):
+        """Only the newest `maxsize` messages are kept."""
+        q = LiveQueue(3, 'dropoldest')
+        q.put_batch([_live(t) for t in range(5)])
+        q.put_batch([_live(5)])
+        self.assertEqual(q.dropped, 3)
+        self.assertEqual([q.get(0)['data'][0] for _ in range(3)], [3, 4, 5])
+
+    def test_latest(self):
+        """One message per symbol and timeframe is kept."""
+        q = LiveQueue(overflow='latest')
+        q.put_batch([_live(0), _live(0, 'GBPUSD'), _live(1), _live(2)])
+        self.assertEqual(q.merged, 2)
+        self.assertEqual(q.get(0)['symbol'], 'GBPUSD')
+        self.assertEqual(q.get(0)['data'][0], 2)
+        self.assertIsNone(q.get(0))
+
+    def test_latest_status(self):
+        """Status messages are not merged with the bars around them."""
+        q = LiveQueue(overflow='latest')
+        down = {'status': 'DISCONNECTED', 'symbol': 'EURUSD',
+                'timeframe': 'M1'}
+        q.put_batch([_live(0), down, dict(down), _live(1)])
+        self.assertEqual(q.merged, 1)
+        self.assertEqual([q.get(0) for _ in range(3)],
+                         [down, down, _live(1)])
+        self.assertIsNone(q.get(0))
+
+    def test_block(self):
+        """A full queue asks to pause and resumes once half drained."""
+        q = LiveQueue(4, 'block')
+        calls = list()
+        q.on_full = lambda q: calls.append('full')
+        q.on_space = lambda q: calls.append('space')
+        q.put_batch([_live(t) for t in range(3)])
+        self.assertEqual(calls, [])
+        q.put_batch([_live(3), _live(4)])
+        self.assertEqual(calls, ['full'])
+        self.assertEqual(len(q), 5)
+        q.get(0), q.get(0)
+        self.assertEqual(calls, ['full'])
+        q.get(0)
+        self.assertEqual(calls, ['full', 'space'])
+        self.assertEqual(q.dropped, 0)
+
+    def test_unknown_overflow(self):
+        """Misspelt policies fail early."""
+        self.assertRaises(ValueError, LiveQueue, 10, 'dropnewest')
+
+
+class TestTickRing(unittest.TestCase):
+    """Live ticks in a preallocated ring buffer."""
+
+    def test_wrap_around(self):
+        """A reader falling behind loses the oldest ticks only."""
+        ring = TickRing(4)
+        ring.put_batch([_tick([1000 * t, t, t + 1]) for t in range(6)])
+        self.assertEqual(len(ring), 6)
+        slots = [ring.get(0) for _ in range(4)]
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual([ring.time[i] for i in slots], [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual([ring.ask[i] for i in slots], [3.0, 4.0, 5.0, 6.0])
+        self.assertEqual(ring.last[slots[0]], 0.0)
+        self.assertIsNone(ring.get(0))
+
+    def test_status_in_order(self):
+        """Status messages are handed out as they are, after the ticks
+        written before them. A reconnection is seen with its first tick."""
+        ring = TickRing(4)
+        ring.put_batch([_tick([0, 1.0, 1.1, 1.05, 3]),
+                        {'status': 'DISCONNECTED'},
+                        _tick([1000, 1.0, 1.1, 1.05, 4]),
+                        _tick([2000, 1.0, 1.1, 1.05, 5])])
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(ring.volume[ring.get(0)], 3.0)
+        self.assertEqual(ring.get(0), {'status': 'DISCONNECTED'})
+        self.assertEqual(ring.get(0), {'status': 'CONNECTED',
+                                       'symbol': 'EURUSD',
+                                       'timeframe': 'TICK'})
+        self.assertEqual(ring.volume[ring.get(0)], 4.0)
+        self.assertEqual(ring.volume[ring.get(0)], 5.0)
+        self.assertIsNone(ring.get(0))
+
+
+class TestHistoryQueue(unittest.TestCase):
+    """History blocks read ahead of a feed."""
+
+    def _put(self, q, item, **kwargs):
+        t = threading.Thread(target=q.put, args=(item,), kwargs=kwargs)
+        t.daemon = True
+        t.start()
+        return t
+
+    def test_bounded(self):
+        """The download waits for the feed once maxsize blocks are ahead."""
+        q = HistoryQueue(2)
+        q.put(1)
+        q.put(2)
+        t = self._put(q, 3)
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(q.get(), 1)
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual([q.get(), q.get()], [2, 3])
+        self.assertGreater(q.waited, 0.05)
+
+    def test_unlock(self):
+        """A lock held by the download is released while it waits."""
+        q = HistoryQueue(1)
+        q.put(1)
+        lock = threading.Lock()
+
+        def put():
+            with lock:
+                q.put(2, unlock=lock)
+                self.assertTrue(lock.locked())
+
+        t = threading.Thread(target=put, daemon=True)
+        t.start()
+        t.join(0.1)
+        self.assertTrue(lock.acquire(timeout=1))
+        lock.release()
+        self.assertEqual([q.get(), q.get(timeout=1)], [1, 2])
+        t.join(1)
+        self.assertFalse(t.is_alive())
+
+    def test_close(self):
+        """Closing wakes up a waiting download and drops the blocks."""
+        q = HistoryQueue(1)
+        q.put(1)
+        t = self._put(q, 2)
+        q.close()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertTrue(q.empty())
+        q.put(3)
+        self.assertTrue(q.empty())
+
+
+class TestOrderWorkers(unittest.TestCase):
+    """Orders sent concurrently, in order per symbol."""
+
+    def test_per_symbol_order(self):
+        """Orders of a symbol are sent one at a time, in order."""
+        sent = list()
+        busy = set()
+        lock = threading.Lock()
+
+        def send(item):
+            symbol, i = item
+            with lock:
+                self.assertNotIn(symbol, busy)
+                busy.add(symbol)
+            time.sleep(0.01)
+            with lock:
+                busy.discard(symbol)
+                sent.append(item)
+
+        workers = OrderWorkers(send, 4)
+        items = [(symbol, i) for i in range(5) for symbol in 'ABC']
+        for item in items:
+            workers.put(item[0], item)
+        workers.stop()
+        for t in workers._threads:
+            t.join(2)
+
+        for symbol in 'ABC':
+            self.assertEqual([i for s, i in sent if s == symbol],
+                             list(range(5)))
+        self.assertEqual(len(workers.stats), 15)
+        self.assertEqual(len(workers), 0)
+
+    def test_symbols_in_parallel(self):
+        """Orders of different symbols do not wait for each other."""
+        workers = OrderWorkers(lambda item: time.sleep(0.2), 6)
+        start = time.time()
+        for i in range(6):
+            workers.put('S{}'.format(i), i)
+        workers.stop()
+        for t in workers._threads:
+            t.join(2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertTrue(all(s['wait'] < 0.1 for s in workers.stats))
+        self.assertTrue(all(s['latency'] >= 0.2 for s in workers.stats))
+
+
+class TestOrderRegistry(unittest.TestCase):
+    """Orders indexed by ref and ticket."""
+
+    def test_indexes(self):
+        """Orders are found by backtrader ref and by MT5 ticket."""
+        orders = OrderRegistry()
+        orders.add(1, 1001, 'EURUSD', 'ORDER_TYPE_BUY')
+        orders.add(2, 1002, 'GBPUSD', 'ORDER_TYPE_SELL_LIMIT')
+        self.assertEqual(len(orders), 2)
+        self.assertIs(orders.get(2), orders.by_ticket(1002))
+        self.assertEqual(orders.get(1).symbol, 'EURUSD')
+        self.assertEqual(orders.by_ticket(1001).otype, 'ORDER_TYPE_BUY')
+        self.assertIsNone(orders.get(3))
+        self.assertIsNone(orders.by_ticket(1003))
+
+    def test_retention(self):
+        """Finished orders are forgotten once the retention is over."""
+        orders = OrderRegistry(retention=60)
+        for oref in range(5):
+            orders.add(oref, 1000 + oref, 'EURUSD', 'ORDER_TYPE_BUY')
+        orders.finish(0, 'completed')
+        orders.finish(1, 'cancelled')
+        self.assertEqual(orders.get(0).state, 'completed')
+
+        orders.evict(time.time() + 30)
+        self.assertEqual(len(orders), 5)
+        orders.evict(time.time() + 61)
+        self.assertEqual(len(orders), 3)
+        self.assertEqual(orders.evicted, 2)
+        self.assertIsNone(orders.by_ticket(1000))
+        self.assertEqual(orders.get(2).state, 'accepted')
+
+    def test_many_orders(self):
+        """Without retention the registry does not grow."""
+        orders = OrderRegistry(retention=0)
+        for oref in range(10000):
+            orders.add(oref, oref, 'EURUSD', 'ORDER_TYPE_BUY')
+            orders.finish(oref, 'completed')
+        self.assertLessEqual(len(orders), 1)
+        self.assertLessEqual(len(orders._byticket), 1)
+
+    def test_concurrent_changes(self):
+        """Orders added, finished and evicted from several threads."""
+        orders = OrderRegistry(retention=0)
+        errors = list()
+
+        def work(first):
+            try:
+                for oref in range(first, first + 5000):
+                    orders.add(oref, oref, 'EURUSD', 'ORDER_TYPE_BUY')
+                    orders.finish(oref, 'completed')
+                    orders.evict()
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible
+        self.addCleanup(sys.setswitchinterval, interval)
+        threads = [threading.Thread(target=work, args=(10000 * i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(orders.evicted + len(orders), 20000)
+
+
+class RecordBroker(object):
+    """Broker of the orders sent without cerebro"""
+
+    def __init__(self):
+        self.submitted = list()
+        self.rejected = list()
+
+    def _submit(self, oref):
+        self.submitted.append(oref)
+
+    def _reject(self, oref):
+        self.rejected.append(oref)
+
+
+class LiveStrategy(bt.Strategy):
+    """Buy on the first live bar and stop after `live` live bars once the
+    order is completed."""
+
+    params = dict(live=5)
+
+    def __init__(self):
+        self.bars = list()
+        self.orders = list()
+
+    def next(self):
+        self.bars.append((self.data._laststatus, self.data.datetime[0]))
+        live = sum(1 for status, _ in self.bars
+                   if status == self.data.LIVE)
+        if live == 1:
+            self.buy(size=0.1)
+        done = self.orders and self.orders[-1] == 'Completed'
+        if live >= self.p.live and done or live >= 20 * self.p.live:
+            self.env.runstop()
+
+    def notify_order(self, order):
+        self.orders.append(order.getstatusname())
+        self.oref = order.ref
+
+
+class TestMTraderStore(unittest.TestCase):
+    """Run cerebro against the fake terminal."""
+
+    def setUp(self):
+        """Start a terminal and a fresh store."""
+        self.terminal = MTraderFakeTerminal(rate=50.0).start()
+        MTraderStore._singleton = None
+        self.store = MTraderStore(host='127.0.0.1')
+        self.store.debug = False
+
+    def tearDown(self):
+        """Release the ports."""
+        self.store.oapi.close()
+        self.terminal.stop()
+        MTraderStore._singleton = None
+
+    def _run(self, **kwargs):
+        cerebro = bt.Cerebro()
+        cerebro.setbroker(self.store.getbroker())
+        fromdate = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        cerebro.adddata(self.store.getdata(
+            dataname='EURUSD', timeframe=bt.TimeFrame.Minutes,
+            compression=1, fromdate=fromdate, **kwargs))
+        cerebro.addstrategy(LiveStrategy)
+        return cerebro.run()[0]
+
+    def test_history_then_live(self):
+        """History is followed by live bars and orders get filled."""
+        strategy = self._run()
+        dts = [dt for _, dt in strategy.bars]
+        self.assertEqual(dts, sorted(set(dts)))
+        self.assertGreater(len(dts), 100)
+        self.assertEqual(strategy.orders[-1], 'Completed')
+        # a filled market order stands for its position
+        self.assertEqual(self.store._orders.get(strategy.oref).state, 'open')
+
+    def test_gap_backfill(self):
+        """After a reconnection only the missed bars are downloaded and
+        they are loaded in order before the live ones."""
+        terminal = self.terminal
+
+        class Disconnect(bt.Strategy):
+            def __init__(self):
+                self.dts = list()
+                self.live = 0
+
+            def next(self):
+                self.dts.append(self.data.datetime[0])
+                if self.data._laststatus != self.data.LIVE:
+                    return
+                self.live += 1
+                if self.live == 3:
+                    self.requests = terminal.stats['requests']
+                    terminal.disconnect(30)
+                elif self.live >= 40:
+                    self.env.runstop()
+
+        cerebro = bt.Cerebro()
+        cerebro.adddata(self.store.getdata(
+            dataname='EURUSD', timeframe=bt.TimeFrame.Minutes, compression=1,
+            fromdate=datetime.datetime.utcnow() -
+            datetime.timedelta(hours=1)))
+        cerebro.addstrategy(Disconnect)
+        strategy = cerebro.run()[0]
+
+        minutes = [round((dt - strategy.dts[0]) * 1440)
+                   for dt in strategy.dts]
+        self.assertEqual(minutes, list(range(len(minutes))))
+
+        gaps = list(strategy.data.gaps)
+        self.assertEqual(len(gaps), 1)
+        self.assertEqual(gaps[0]['gap'], 31 * 60)
+        self.assertEqual(gaps[0]['bars'], 30)
+        self.assertLess(gaps[0]['elapsed'], 5.0)
+        # a single window is requested
+        self.assertEqual(terminal.stats['requests'] - strategy.requests, 1)
+
+    def test_warmup(self):
+        """Live startup downloads the minimum period of the strategy plus
+        the margin."""
+        class Warmup(bt.Strategy):
+            def __init__(self):
+                self.sma = bt.indicators.SMA(self.data, period=50)
+                self.history = 0
+
+            def prenext(self):
+                self.next()
+
+            def next(self):
+                if self.data._laststatus != self.data.LIVE:
+                    self.history += 1
+                else:
+                    self.env.runstop()
+
+        cerebro = bt.Cerebro()
+        cerebro.adddata(self.store.getdata(
+            dataname='EURUSD', timeframe=bt.TimeFrame.Minutes, compression=1,
+            warmup=True, warmup_margin=10))
+        cerebro.addstrategy(Warmup)
+        requests = self.terminal.stats['requests']
+        strategy = cerebro.run()[0]
+        self.assertEqual(strategy.history, 60)
+        self.assertEqual(self.terminal.stats['requests'] - requests, 1)
+
+    def test_last_candles(self):
+        """The range of the last candles grows until there are enough."""
+        # weeks taken for days: the first guess is far too short
+        self.store._TIMEFRAME_SECONDS = dict(MTraderStore._TIMEFRAME_SECONDS)
+        self.store._TIMEFRAME_SECONDS[bt.TimeFrame.Weeks] = 86400
+        requests = self.terminal.stats['requests']
+        blocks = list(_blocks(self.store.last_candles(
+            'EURUSD', 20, bt.TimeFrame.Weeks, 1)))
+        bars = [bar for block in blocks for bar in _bars(block)]
+        self.assertEqual(len(bars), 20)
+        self.assertGreater(self.terminal.stats['requests'] - requests, 1)
+        self.assertEqual([round((b[0] - bars[0][0]) / 7) for b in bars],
+                         list(range(20)))
+        # the forming week is left out
+        this_week = self.terminal.bar_open(int(time.time()), 'W1')
+        self.assertEqual(bars[-1][0], bt.date2num(
+            datetime.datetime.utcfromtimestamp(this_week - 7 * 86400)))
+
+    def test_live_messages_are_routed_per_feed(self):
+        """Each feed only receives the live bars of its symbol."""
+        datas = [self.store.getdata(dataname=symbol,
+                                    timeframe=bt.TimeFrame.Minutes,
+                                    compression=1)
+                 for symbol in ('EURUSD', 'GBPUSD')]
+        eurusd, gbpusd = [self.store.register_live(d) for d in datas]
+
+        self.store._on_livedata([_live(0), _live(0, 'GBPUSD'),
+                                 _live(0, 'EURUSD', 'H1'), _live(0, 'USDJPY'),
+                                 {'status': 'DISCONNECTED'}])
+        self.assertEqual([eurusd.get(0).get('symbol') for _ in range(2)],
+                         ['EURUSD', None])
+        self.assertEqual([gbpusd.get(0).get('symbol') for _ in range(2)],
+                         ['GBPUSD', None])
+        self.assertIsNone(eurusd.get(0))
+        self.assertEqual(self.store.live_unrouted, 2)
+
+    def test_two_symbols(self):
+        """Feeds of different symbols do not share live bars."""
+        self.terminal.stop()
+        self.terminal = MTraderFakeTerminal(symbols=['EURUSD', 'GBPUSD'],
+                                            rate=50.0).start()
+        cerebro = bt.Cerebro()
+        fromdate = datetime.datetime.utcnow() - datetime.timedelta(minutes=30)
+        for symbol in ('EURUSD', 'GBPUSD'):
+            cerebro.adddata(self.store.getdata(
+                dataname=symbol, timeframe=bt.TimeFrame.Minutes,
+                compression=1, fromdate=fromdate), name=symbol)
+        cerebro.addstrategy(LiveStrategy)
+        strategy = cerebro.run()[0]
+
+        for data in strategy.datas:
+            closes = data.close.array
+            for i, dt in enumerate(data.datetime.array):
+                t = int(round((dt - 719163.0) * 86400))
+                candle = self.terminal.candle(data.p.dataname, t, 'M1')
+                self.assertAlmostEqual(closes[i], candle[4])
+
+    def test_bounded_live_queue(self):
+        """A slow strategy with a bounded queue sheds old live bars."""
+        strategy = self._run(live_qsize=2, live_overflow='dropoldest')
+        self.assertEqual(strategy.orders[-1], 'Completed')
+        self.assertEqual(self.store.oapi._live_options, {zmq.RCVHWM: 2})
+
+    def test_conflate_on_request(self):
+        """The Live socket conflates only when the single feed asks."""
+        key = ('EURUSD', 'M1')
+        self.store._live_routes = {key: [LiveQueue(overflow='latest')]}
+        self.assertEqual(self.store._live_options(), {zmq.RCVHWM: 1})
+        self.store._live_routes = {
+            key: [LiveQueue(overflow='latest', conflate=True)]}
+        self.assertEqual(self.store._live_options(),
+                         {zmq.RCVHWM: 1, zmq.CONFLATE: 1})
+        self.store._live_routes[('GBPUSD', 'M1')] = [
+            LiveQueue(overflow='latest', conflate=True)]
+        self.assertEqual(self.store._live_options(), {zmq.RCVHWM: 2})
+
+    def test_history_windows(self):
+        """Windows are consecutive, inclusive and cover the whole range."""
+        windows = MTraderStore._history_windows(0, 1000, 300)
+        self.assertEqual(windows, [(0, 299), (300, 599), (600, 899),
+                                   (900, 1000)])
+        self.assertEqual(MTraderStore._history_windows(None, 1000, 300),
+                         [(None, 1000)])
+        self.assertEqual(MTraderStore._history_windows(0, 599, 300),
+                         [(0, 299), (300, 599)])
+
+    def test_chunked_history(self):
+        """A long range arrives in order, window by window, up to todate."""
+        self.store.HISTORY_CHUNK = 50
+        begin = datetime.datetime(2020, 1, 6)
+        end = datetime.datetime(2020, 1, 8, 12)
+        q = self.store.candles('EURUSD', begin, end, bt.TimeFrame.Minutes, 5)
+
+        windows = _blocks(q)
+        self.assertEqual(len(windows), 15)
+        self.assertTrue(all(block_len(w) <= 50 for w in windows))
+        bars = [b for w in windows for b in _bars(w)]
+        self.assertEqual(len(bars), 12 * 60 + 1)
+        t0 = int((begin - datetime.datetime(1970, 1, 1)).total_seconds())
+        self.assertEqual(bars, _bars(candles_to_block(self.terminal.candles(
+            'EURUSD', 'M5', t0, t0 + 60 * 60 * 60))))
+
+    def _send_orders(self, orders):
+        # straight to the order workers, (symbol, volume) per order
+        self.store.broker = RecordBroker()
+        self.store.broker_threads()
+        self.addCleanup(self.store.q_orderclose.put, None)
+
+        for oref, (symbol, volume) in enumerate(orders):
+            self.store.q_ordercreate.put(symbol, (oref, dict(
+                action='TRADE', actionType='ORDER_TYPE_BUY', symbol=symbol,
+                volume=volume,
+                comment=dict(cid=self.store._client_id(oref)))))
+        self.store.stop()
+        for t in self.store.q_ordercreate._threads:
+            t.join(10)
+        return self.store.broker
+
+    def test_order_workers(self):
+        """A basket of orders takes about one round-trip."""
+        self.terminal.latency = 0.2
+        start = time.time()
+        self._send_orders([('SYM{}'.format(oref % 4), 0.1)
+                           for oref in range(8)])
+
+        self.assertLess(time.time() - start, 1.2)  # 8 orders in a row: 1.6
+        self.assertEqual(sorted(self.store.broker.submitted), list(range(8)))
+        self.assertEqual(self.store.broker.rejected, [])
+        # per symbol in order
+        tickets = [self.store._orders.get(oref).oid for oref in range(8)]
+        for i in range(4):
+            self.assertLess(tickets[i], tickets[i + 4])
+        stats = self.store.q_ordercreate.stats
+        self.assertEqual(len(stats), 8)
+        self.assertGreaterEqual(min(s['latency'] for s in stats), 0.2)
+
+    def test_order_lost_reply(self):
+        """An order whose reply was lost is found again, not doubled."""
+        self.store.oapi.DATA_TIMEOUT = 300
+        self.store.ORDER_BACKOFF = 0.05
+        self.terminal.lose_replies(1)
+        broker = self._send_orders([('EURUSD', 0.1), ('EURUSD', 0.2)])
+
+        self.assertEqual(broker.submitted, [0, 1])
+        self.assertEqual(self.terminal.stats['lost'], 1)
+        self.assertEqual(sorted(p['volume'] for p in
+                                self.terminal.positions.values()), [0.1, 0.2])
+        self.assertEqual(self.store._orders.get(0).oid,
+                         min(self.terminal.positions))
+
+    def test_order_transport_error(self):
+        """A request failing in transit is sent again."""
+        self.store.ORDER_BACKOFF = 0.05
+        send = self.store.oapi.construct_and_send
+        failures = [zmq.ZMQError(), None]
+
+        def flaky(**kwargs):
+            if kwargs.get('action') == 'TRADE' and failures:
+                error = failures.pop(0)
+                if error is not None:
+                    raise error
+                return None  # timed out
+            return send(**kwargs)
+
+        self.store.oapi.construct_and_send = flaky
+        broker = self._send_orders([('EURUSD', 0.1)])
+        self.assertEqual(broker.submitted, [0])
+        self.assertEqual(len(self.terminal.positions), 1)
+
+    def test_order_error_reply(self):
+        """A rejected order does not stop the next ones."""
+        broker = self._send_orders([('EURUSD', 0.0), ('EURUSD', 0.1)])
+        self.assertEqual(broker.rejected, [0])
+        self.assertEqual(broker.submitted, [1])
+
+    def test_order_unexpected_reply(self):
+        """An order with a reply it cannot read is rejected, not left
+        submitted."""
+        send = self.store.oapi.construct_and_send
+        replies = [{'description': 'no error key'}, ['not', 'a', 'dict']]
+
+        def odd(**kwargs):
+            if kwargs.get('action') == 'TRADE' and replies:
+                return replies.pop(0)
+            return send(**kwargs)
+
+        self.store.oapi.construct_and_send = odd
+        broker = self._send_orders([('EURUSD', 0.1), ('EURUSD', 0.1),
+                                    ('EURUSD', 0.1)])
+        self.assertEqual(broker.rejected, [0, 1])
+        self.assertEqual(broker.submitted, [2])
+
+    def test_client_id_in_comment(self):
+        """The client id is found in the comment, as sent or as kept by the
+        terminal."""
+        has_cid = MTraderStore._has_cid
+        self.assertTrue(has_cid(dict(cid='1a2b3c4d-12'), '1a2b3c4d-12'))
+        self.assertTrue(has_cid('1a2b3c4d-12', '1a2b3c4d-12'))
+        comment = self.terminal._comment(
+            dict(cid='1a2b3c4d-12', stopside=13, takeside=14))
+        self.assertEqual(len(comment), 31)
+        self.assertTrue(has_cid(comment, '1a2b3c4d-12'))
+        self.assertFalse(has_cid(comment, '1a2b3c4d-1'))
+        self.assertFalse(has_cid(comment, '2a2b3c4d-12'))
+        self.assertFalse(has_cid('', '1a2b3c4d-12'))
+        self.assertFalse(has_cid(None, '1a2b3c4d-12'))
+
+    def test_order_comment(self):
+        """A user comment is merged after the client id, it must be a
+        dict."""
+        broker, (data,) = self._broker_datas('EURUSD')
+        order = bt.BuyOrder(owner=None, data=data, size=0.1,
+                            exectype=bt.Order.Market)
+        broker.orders[order.ref] = order
+        with self.assertRaises(ValueError):
+            self.store.order_create(order, comment='mine')
+
+        self.store.order_create(order, comment=dict(cid='mine', tag=7))
+        self._wait_orders([order], bt.Order.Completed)
+        oid = self.store._orders.get(order.ref).oid
+        comment = self.terminal.positions[oid]['comment']
+        cid = self.store._client_id(order.ref)
+        self.assertTrue(comment.startswith('{{"cid": "{}"'.format(cid)))
+        self.assertEqual(self.store._find_order(cid), oid)
+
+    def _broker_datas(self, *names):
+        # a started broker and single bar feeds to trade, without cerebro
+        broker = self.store.getbroker()
+        broker.start()
+        self.addCleanup(self.store.q_orderclose.put, None)
+        self.addCleanup(self.store.stop)
+
+        cerebro = bt.Cerebro()
+        datas = list()
+        for name in names:
+            data = bt.DataBase(dataname=name)
+            cerebro.adddata(data)
+            data._start()
+            data.forward()
+            data.lines.datetime[0] = bt.date2num(datetime.datetime.utcnow())
+            datas.append(data)
+        return broker, datas
+
+    def _wait_orders(self, orders, status):
+        deadline = time.time() + 5
+        while any(o.status != status for o in orders):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_position_outlives_retention(self):
+        """A filled market order is kept until its position is closed."""
+        self.store._orders.retention = 0.1
+        broker, (data,) = self._broker_datas('EURUSD')
+        orders = [broker.buy(None, data, 0.1, exectype=bt.Order.Market)
+                  for _ in range(2)]
+        self._wait_orders(orders, bt.Order.Completed)
+        time.sleep(0.2)
+        self.store._orders.evict()
+        records = [self.store._orders.get(o.ref) for o in orders]
+        self.assertEqual([r.state for r in records], ['open', 'open'])
+
+        broker.cancel(orders[0])  # closes its position
+        self._wait_orders(orders[:1], bt.Order.Canceled)
+        self.assertEqual(list(self.terminal.positions), [records[1].oid])
+
+        # the other position is closed in the terminal
+        self.store.oapi.construct_and_send(
+            action='TRADE', actionType='POSITION_CLOSE_ID', symbol='EURUSD',
+            id=records[1].oid)
+        deadline = time.time() + 5
+        while records[1].state != 'closed':
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+        time.sleep(0.2)
+        self.store._orders.evict()
+        self.assertEqual(len(self.store._orders), 0)
+
+    def test_broker_compaction(self):
+        """Final orders are forgotten by the broker and the store once the
+        retention is over."""
+        self.store._orders.retention = 0.3
+        broker, datas = self._broker_datas('EURUSD', 'GBPUSD')
+        orders = [broker.sell(None, datas[i % 2], 0.1,
+                              exectype=bt.Order.Market) for i in range(6)]
+        self._wait_orders(orders, bt.Order.Completed)
+        for order in orders:
+            broker.cancel(order)  # closes the position
+        self._wait_orders(orders, bt.Order.Canceled)
+        self.assertEqual(self.terminal.positions, {})
+
+        broker.next()
+        self.assertEqual(len(broker.orders), 6)
+        time.sleep(0.35)
+        broker.next()
+        self.assertEqual(len(broker.orders), 0)
+        self.assertEqual(broker.compacted, 6)
+        self.store._orders.evict()  # done by its next operation otherwise
+        self.assertEqual(len(self.store._orders), 0)
+        self.assertEqual(broker.orderstatus(orders[0]), bt.Order.Canceled)
+
+        # late events of forgotten orders are ignored
+        broker._fill(orders[0].ref, 0.1, 1.0, 'ORDER_TYPE_SELL')
+        broker._cancel(orders[0].ref)
+
+    def test_broker_keeps_open_positions(self):
+        """Completed market orders are kept while their position is open,
+        to be closed whenever."""
+        self.store._orders.retention = 0.1
+        broker, (data,) = self._broker_datas('EURUSD')
+        order = broker.buy(None, data, 0.1, exectype=bt.Order.Market)
+        self._wait_orders([order], bt.Order.Completed)
+        time.sleep(0.2)
+        broker.next()
+        self.assertIn(order.ref, broker.orders)
+        self.assertEqual(broker.compacted, 0)
+
+        broker.cancel(order)  # closes the position
+        self._wait_orders([order], bt.Order.Canceled)
+        self.assertEqual(self.terminal.positions, {})
+        time.sleep(0.2)
+        broker.next()
+        self.assertNotIn(order.ref, broker.orders)
+        self.assertEqual(broker.compacted, 1)
+
+    def test_broker_notification_cap(self):
+        """Undelivered notifications are capped, the oldest dropped."""
+        broker, (data,) = self._broker_datas('EURUSD')
+        broker.p.max_notifs = 3
+        orders = [bt.BuyOrder(data=data, size=1, simulated=True)
+                  for _ in range(5)]
+        for order in orders:
+            broker.notify(order)
+        self.assertEqual(broker.notifs_dropped, 2)
+        self.assertEqual([n.ref for n in broker.notifs],
+                         [o.ref for o in orders[2:]])
+
+    def test_broker_mark_to_market(self):
+        """Positions are marked to the feed prices between refreshes."""
+        self.store.BALANCE_TTL = 60.0
+        broker, (data,) = self._broker_datas('EURUSD')
+        self.store.datas.append(data)  # registered by a started feed
+        self.store._balance_due.clear()
+        equity = self.terminal.equity()
+        self.assertEqual(broker.getvalue(), equity)
+
+        broker._fill_external(data, 2.0, 1.1)
+        data.lines.close[0] = 1.15
+        self.assertAlmostEqual(broker.getvalue(), equity + 0.1)
+        broker._fill_external(data, -2.0, 1.2)  # closed, profit realized
+        data.lines.close[0] = 1.3
+        self.assertAlmostEqual(broker.getvalue(), equity + 0.2)
+
+        broker._fill_external(data, 1.0, 1.3)
+        self.assertTrue(self.store.get_balance())
+        self.assertEqual(broker.getvalue(), equity)  # the fake has no position
+        data.lines.close[0] = 1.25
+        self.assertAlmostEqual(broker.getvalue(), equity - 0.05)
+
+    def test_broker_mark_with_multiplier(self):
+        """Marks follow the commission info of the feed."""
+        self.store.BALANCE_TTL = 60.0
+        broker, (data,) = self._broker_datas('EURUSD')
+        broker.setcommission(mult=10.0)
+        self.store.datas.append(data)
+        self.store._balance_due.clear()
+        self.assertTrue(self.store.get_balance())
+        equity = self.terminal.equity()
+        self.assertEqual(self.store.get_value_update(),
+                         (equity, self.store.balance_updates))
+        self.assertEqual(broker.getvalue(), equity)
+
+        broker._fill_external(data, 2.0, 1.1)
+        data.lines.close[0] = 1.15
+        self.assertAlmostEqual(broker.getvalue(), equity + 1.0)
+        broker._fill_external(data, -1.0, 1.2)
+        data.lines.close[0] = 1.1
+        self.assertAlmostEqual(broker.getvalue(), equity + 1.0)
+
+    def test_broker_balance_refresh(self):
+        """The balance is refreshed after trade events, once per burst,
+        and every BALANCE_TTL seconds."""
+        self.store.BALANCE_DEBOUNCE = 0.2
+        broker, (data,) = self._broker_datas('EURUSD')
+        updates = self.store.balance_updates
+        orders = [broker.buy(None, data, 0.1, exectype=bt.Order.Market)
+                  for _ in range(4)]
+        self._wait_orders(orders, bt.Order.Completed)
+
+        deadline = time.time() + 5
+        while self.store.balance_updates == updates:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        time.sleep(0.5)
+        self.assertLessEqual(self.store.balance_updates - updates, 2)
+        self.assertEqual(broker.getcash(), self.terminal.balance)
+
+        self.store.BALANCE_TTL = 0.1
+        self.store._balance_due.set()  # wait again with the new TTL
+        updates = self.store.balance_updates
+        time.sleep(0.7)
+        self.assertGreaterEqual(self.store.balance_updates - updates, 3)
+
+    def test_history_prefetch(self):
+        """The download stays a bounded number of windows ahead."""
+        self.store.HISTORY_CHUNK = 50
+        self.store.HISTORY_INFLIGHT = 1
+        begin = datetime.datetime(2020, 1, 6)
+        end = datetime.datetime(2020, 1, 8, 12)
+        requests = self.terminal.stats['requests']
+        q = self.store.candles('EURUSD', begin, end, bt.TimeFrame.Minutes, 5)
+
+        time.sleep(0.5)  # the feed is busy
+        self.assertEqual(q.qsize(), self.store.HISTORY_PREFETCH)
+        # the queued windows, the one waiting for room and the next one
+        self.assertLessEqual(self.terminal.stats['requests'] - requests,
+                             self.store.HISTORY_PREFETCH + 2)
+
+        windows = _blocks(q)
+        self.assertEqual(len(windows), 15)
+        self.assertEqual(self.terminal.stats['requests'] - requests, 15)
+        self.assertGreater(q.waited, 0.0)
+
+    def test_history_prefetch_closed(self):
+        """A closed queue stops the download."""
+        self.store.HISTORY_CHUNK = 50
+        self.store.HISTORY_INFLIGHT = 1
+        requests = self.terminal.stats['requests']
+        q = self.store.candles('EURUSD', datetime.datetime(2020, 1, 6),
+                               datetime.datetime(2020, 1, 8, 12),
+                               bt.TimeFrame.Minutes, 5)
+        time.sleep(0.3)
+        q.close()
+        time.sleep(0.3)
+        self.assertLess(self.terminal.stats['requests'] - requests, 8)
+        self.assertTrue(q.empty())
+
+    def test_cached_history(self):
+        """A second download only asks the terminal for the missing tail."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        MTraderStore._singleton = None
+        self.store.oapi.close()
+        self.store = MTraderStore(host='127.0.0.1', cachedir=directory)
+        self.store.debug = False
+        self.store.HISTORY_CHUNK = 100
+
+        def download(minutes):
+            begin = datetime.datetime.utcnow() - \
+                datetime.timedelta(minutes=minutes)
+            requests = self.terminal.stats['requests']
+            q = self.store.candles('EURUSD', begin, None,
+                                   bt.TimeFrame.Minutes, 1)
+            bars = [b for w in _blocks(q) for b in _bars(w)]
+            return bars, self.terminal.stats['requests'] - requests
+
+        def terminal(bars):
+            # same range straight from the terminal
+            begin, end = [int(round((b[0] - 719163.0) * 86400))
+                          for b in (bars[0], bars[-1])]
+            return _bars(candles_to_block(self.terminal.candles(
+                'EURUSD', 'M1', begin, end)))
+
+        candles, requests = download(500)
+        self.assertEqual(requests, 6)
+        self.assertEqual(candles, terminal(candles))
+
+        again, requests = download(500)
+        self.assertEqual(requests, 1)
+        self.assertEqual(again[0][0], candles[0][0])
+        self.assertGreaterEqual(len(again), len(candles))
+
+        older, requests = download(1000)
+        self.assertLessEqual(requests, 7)  # head windows and the tail
+        self.assertEqual(older, terminal(older))
+
+    def test_derived_timeframes(self):
+        """Coarser bars are built from M1 candles downloaded once."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.bars = dict((d._name, list()) for d in self.datas)
+
+            def next(self):
+                for d in self.datas:
+                    bar = (d.datetime[0], d.open[0], d.close[0])
+                    bars = self.bars[d._name]
+                    if not bars or bars[-1] != bar:
+                        bars.append(bar)
+
+        def run(derive):
+            cerebro = bt.Cerebro()
+            for compression in (5, 60, 1440):
+                timeframe = bt.TimeFrame.Minutes
+                if compression == 1440:
+                    timeframe, compression = bt.TimeFrame.Days, 1
+                cerebro.adddata(self.store.getdata(
+                    dataname='EURUSD', timeframe=timeframe,
+                    compression=compression, historical=True, derive=derive,
+                    fromdate=datetime.datetime(2020, 1, 6),
+                    todate=datetime.datetime(2020, 1, 9)),
+                    name=str(compression))
+            cerebro.addstrategy(Record)
+            requests = self.terminal.stats['requests']
+            bars = cerebro.run()[0].bars
+            return bars, self.terminal.stats['requests'] - requests
+
+        direct, requests = run(False)
+        derived, derived_requests = run(True)
+        self.assertEqual(requests, 3)
+        self.assertEqual(derived_requests, 1)  # 4320 M1 candles
+        for name, bars in direct.items():
+            # the bar opened at todate is not complete
+            self.assertEqual(derived[name], bars[:-1])
+
+    def _ticks(self, strategy, tick_rate=20.0, **kwargs):
+        # a terminal streaming ticks, the store reconnects to it
+        self.terminal.stop()
+        self.terminal = MTraderFakeTerminal(rate=0,
+                                            tick_rate=tick_rate).start()
+        kwargs.setdefault('timeframe', bt.TimeFrame.Ticks)
+        cerebro = bt.Cerebro()
+        cerebro.adddata(self.store.getdata(dataname='EURUSD', **kwargs))
+        cerebro.addstrategy(strategy)
+        return cerebro.run()[0]
+
+    def test_tick_feed(self):
+        """Tick history is followed by live ticks with bid and ask."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.ticks = list()
+
+            def next(self):
+                d = self.data
+                self.ticks.append((d._laststatus, d.datetime[0], d.bid[0],
+                                   d.close[0], d.ask[0]))
+                if sum(1 for tick in self.ticks if tick[0] == d.LIVE) >= 10:
+                    self.env.runstop()
+
+        start = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+        strategy = self._ticks(Record, fromdate=start)
+        self.assertIsInstance(strategy.data.qlive, TickRing)
+
+        history = [t for t in strategy.ticks if t[0] != strategy.data.LIVE]
+        self.assertGreater(len(history), 80)  # 20 per second
+        self.assertEqual(len(strategy.ticks) - len(history), 10)
+        dts = [t[1] for t in strategy.ticks]
+        self.assertEqual(dts, sorted(dts))
+        self.assertTrue(all(bid < last < ask
+                            for _, _, bid, last, ask in strategy.ticks))
+
+    def test_tick_backfill(self):
+        """The ticks missed while disconnected are downloaded and loaded
+        in order before the live ones."""
+        test = self
+
+        class Disconnect(bt.Strategy):
+            def __init__(self):
+                self.dts = list()
+                self.live = 0
+
+            def next(self):
+                d = self.data
+                self.dts.append(d.datetime[0])
+                if d._laststatus != d.LIVE:
+                    return
+                self.live += 1
+                if self.live == 5:
+                    self.cut = len(self.dts)
+                    test.terminal.disconnect_ticks(1.0)
+                elif self.live >= 80:
+                    self.env.runstop()
+
+        strategy = self._ticks(Disconnect, fromdate=(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=2)))
+
+        self.assertEqual(self.terminal.stats['statuses'], 1)
+        gaps = list(strategy.data.gaps)
+        self.assertEqual(len(gaps), 1)
+        self.assertGreater(gaps[0]['gap'], 0.9)
+        self.assertGreaterEqual(gaps[0]['bars'], 15)  # 20 ticks per second
+        dts = strategy.dts
+        self.assertEqual(dts, sorted(dts))
+        # no tick twice around the reconnection
+        after = dts[strategy.cut:]
+        self.assertEqual(len(set(after)), len(after))
+        steps = [(b - a) * 86400 for a, b in zip(dts, dts[1:])]
+        self.assertLess(max(steps), 0.5)
+
+    def test_tick_bars(self):
+        """Ticks are aggregated into second bars aligned on their length."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.bars = list()
+
+            def next(self):
+                d = self.data
+                self.bars.append((d.datetime[0], d.open[0], d.high[0],
+                                  d.low[0], d.close[0], d.volume[0]))
+
+        begin = datetime.datetime(2020, 1, 6)
+        strategy = self._ticks(Record, bar_seconds=5, historical=True,
+                               fromdate=begin,
+                               todate=begin + datetime.timedelta(minutes=1))
+        self.assertEqual(strategy.data._timeframe, bt.TimeFrame.Seconds)
+        self.assertEqual(strategy.data._compression, 5)
+        # the bar opened at the last second is never completed
+        self.assertEqual(len(strategy.bars), 12)
+
+        t0 = 1578268800
+        ticks = [self.terminal.tick('EURUSD', msc)
+                 for msc in range(1000 * t0, 1000 * (t0 + 5), 50)]
+        prices = [tick[3] for tick in ticks]
+        self.assertEqual(strategy.bars[0], (
+            bt.date2num(begin), prices[0], max(prices), min(prices),
+            prices[-1], sum(tick[4] for tick in ticks)))
+        self.assertEqual(strategy.bars[1][0], bt.date2num(
+            begin + datetime.timedelta(seconds=5)))
+
+    def test_second_bars(self):
+        """Second timeframes are built from ticks and live bars are loaded
+        once their time is over, without waiting for the next tick."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.bars = list()
+
+            def next(self):
+                d = self.data
+                self.bars.append((d._laststatus, d.datetime[0], time.time()))
+                if sum(1 for bar in self.bars if bar[0] == d.LIVE) >= 3:
+                    self.env.runstop()
+
+        start = datetime.datetime.utcnow() - datetime.timedelta(seconds=10)
+        # a tick every 2 seconds
+        strategy = self._ticks(Record, tick_rate=0.5, fromdate=start,
+                               timeframe=bt.TimeFrame.Seconds, compression=1)
+        self.assertEqual(strategy.data._timeframe, bt.TimeFrame.Seconds)
+
+        dts = [bt.num2date(dt) for _, dt, _ in strategy.bars]
+        self.assertGreaterEqual(len(dts), 6)
+        self.assertTrue(all(dt.microsecond == 0 for dt in dts))
+        self.assertEqual(dts, sorted(set(dts)))
+        live = [bar for bar in strategy.bars
+                if bar[0] == strategy.data.LIVE]
+        # the first one may have been built by the history
+        for _, dt, loaded in live[1:]:
+            late = loaded - (dt - 719163.0) * 86400.0 - 1.0
+            self.assertLess(late, 0.8)
+
+        self.assertRaises(ValueError, self.store.get_granularity,
+                          bt.TimeFrame.Seconds, 7)
+
+    def test_history_without_numpy(self):
+        """Without NumPy the same bars are loaded from array blocks."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.bars = list()
+
+            def next(self):
+                d = self.data
+                self.bars.append((d.datetime[0], d.open[0], d.high[0],
+                                  d.low[0], d.close[0], d.volume[0]))
+
+        def run():
+            cerebro = bt.Cerebro()
+            cerebro.adddata(self.store.getdata(
+                dataname='EURUSD', timeframe=bt.TimeFrame.Minutes,
+                compression=5, historical=True,
+                fromdate=datetime.datetime(2020, 1, 6),
+                todate=datetime.datetime(2020, 1, 7)))
+            cerebro.addstrategy(Record)
+            return cerebro.run()[0].bars
+
+        bars = run()
+        numpy, mt5bars.np = mt5bars.np, None
+        try:
+            self.assertEqual(run(), bars)
+        finally:
+            mt5bars.np = numpy
+        self.assertEqual(len(bars), 24 * 12 + 1)
+
+    def test_historical_preload(self):
+        """A historical feed is preloaded with the same bars as bar by bar
+        loading and indicators run vectorized."""
+        class Record(bt.Strategy):
+            def __init__(self):
+                self.sma = bt.indicators.SMA(self.data, period=10)
+                self.bars = list()
+
+            def next(self):
+                self.bars.append((self.data.datetime[0], self.data.close[0],
+                                  self.data.volume[0], self.sma[0]))
+
+        def run(**kwargs):
+            cerebro = bt.Cerebro(**kwargs)
+            data = self.store.getdata(
+                dataname='EURUSD', timeframe=bt.TimeFrame.Minutes,
+                compression=5, historical=True,
+                fromdate=datetime.datetime(2020, 1, 6),
+                todate=datetime.datetime(2020, 1, 10))
+            self.assertFalse(data.islive())
+            cerebro.adddata(data)
+            cerebro.addstrategy(Record)
+            return cerebro.run()[0].bars
+
+        preloaded = run()
+        self.assertEqual(len(preloaded), 4 * 24 * 12 + 1 - 9)
+        self.assertEqual(preloaded, run(preload=False, runonce=False))